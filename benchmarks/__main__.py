@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+
+from . import bench
+
+"""
+Runs the benchmarks and saves the results as JSON. Compares the results with a baseline if it is provided.
+Exits with the 1 code if any benchmark is slower than the baseline more than the tolerance.
+Run it from the project root dir:
+> python -m benchmarks --scales 10000 100000 --baseline benchmarks/baseline.json
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Performance benchmarks of the performance hotspots pipeline.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000, 100000],
+                        help='Numbers of the generated documents, from 10k to 10M.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each benchmark.')
+    parser.add_argument('--only', nargs='+', default=None, help='Run only these benchmarks.')
+    parser.add_argument('--output', default='./data/benchmarks/results.json', help='The results file.')
+    parser.add_argument('--baseline', default=None, help='The baseline results file to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='An allowed slowdown comparing with the baseline, 0.25 means 25%%.')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline.')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'time': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': [],
+    }
+    for benchmark in bench.benchmarks:
+        if args.only and benchmark.name not in args.only:
+            continue
+        for scale in args.scales:
+            r = bench.run(benchmark, scale, args.repeat)
+            results['results'].append(r)
+            if 'error' in r:
+                print(f'{r["name"]:40} {scale:>10,} docs: *** {r["error"]}')
+            else:
+                print(f'{r["name"]:40} {scale:>10,} docs: {r["median_secs"]:10.4f} s, '
+                      f'{r["items_per_sec"]:>14,} items/s')
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saved results into "{args.output}"')
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved baseline into "{args.baseline}"')
+    elif args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = bench.compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f'*** REGRESSION: {r["name"]} {r["scale"]:,} docs: {r["median_secs"]:.4f} s, '
+                  f'baseline: {r["baseline_median_secs"]:.4f} s, x{r["slowdown"]}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions comparing with "{args.baseline}" and {args.tolerance:.0%} tolerance.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import copy
+import statistics
+import time
+from collections import namedtuple
+
+from ph import elastic_api
+from ph import history_storage
+from ph.alert_api import AlertClient, remove_fields, unify_time_formats
+from ph.api_helper import format_alert_to_anomaly
+from ph.model_generic import L7LatencyModel
+from ph.model_processor import aggregate_byte_anomalies
+
+from . import corpora
+from . import fake_es
+
+"""
+Benchmarks of the pipeline stages: download -> aggregate -> train -> detect -> alert.
+Each benchmark has:
+ setup(scale): prepares the state once for a scale (not timed),
+ args(state): prepares the arguments of one run (not timed). Needed for the stages that change their input,
+ run(*args): the timed stage. Returns the number of processed items.
+The download and the alert writing stages run against the local fake ES (see fake_es.py) started by this process.
+"""
+
+Benchmark = namedtuple('Benchmark', 'name setup args run')
+
+_fake_es = {}  # the fake ES of the process: {'store', 'server', 'host'}
+
+
+def _fake_es_host():
+    """Starts the fake ES once per process, it runs until the process exits."""
+    if not _fake_es:
+        _fake_es['store'] = fake_es.Store()
+        _fake_es['server'] = fake_es.serve(_fake_es['store'])
+        _fake_es['host'] = _fake_es['server'].__enter__()
+    return _fake_es['host']
+
+
+def _setup_flows(scale):
+    return corpora.generate('flows', scale)
+
+
+def _setup_aggregated_flows(scale):
+    return elastic_api._aggregate_data(corpora.generate('flows', scale), elastic_api.params.bucket_size_minutes)
+
+
+def _run_aggregate_data(docs):
+    source_docs, dest_docs = elastic_api._aggregate_data(docs, elastic_api.params.bucket_size_minutes)
+    return len(docs)
+
+
+def _run_additional_aggregation(source_docs, dest_docs):
+    elastic_api._additional_aggregation(source_docs, dest_docs)
+    return len(source_docs) + len(dest_docs)
+
+
+def _setup_es_flows(scale):
+    host = _fake_es_host()
+    _fake_es['store'].load('flows', scale)
+    return host
+
+
+def _run_download_and_aggregate_data(host):
+    with fake_es.elastic_client_params(host):
+        data = elastic_api.ElasticClient().download_and_aggregate_data(None, None, max_docs=10 ** 8,
+                                                                       index_name='flows')
+    return len(data['flows'])
+
+
+def _setup_l7(scale):
+    return corpora.generate('l7', scale)
+
+
+def _run_l7_train(samples):
+    L7LatencyModel().train(samples)
+    return len(samples)
+
+
+def _setup_l7_model(scale):
+    samples = corpora.generate('l7', scale)
+    model, aggregators = L7LatencyModel().train(samples)
+    return model, samples, aggregators
+
+
+def _run_l7_find_anomalies(model, samples, aggregators):
+    L7LatencyModel().find_anomalies(model, samples, aggregators)
+    return len(samples)
+
+
+def _setup_byte_anomalies(scale):
+    """
+    The byte anomalies: 1 anomaly per 10 documents, a half of them are 'process_bytes' anomalies.
+    """
+    n = max(1, scale // 10)
+    anomalies = []
+    for i in range(n):
+        start = corpora.window_start + (i // 2) * 300
+        rec = {
+            'start_time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start)),
+            'end_time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start + 300)),
+            'source_namespace': 'namespace', 'source_name_aggr': f'source-{i}', 'dest_namespace': 'namespace',
+            'dest_service_name': f'service-{i}', 'bytes_in': i * 10, 'bytes_out': i * 20, 'confidence': 0.9,
+        }
+        job_name = 'process_bytes' if i % 2 else ('bytes_in' if i % 4 else 'bytes_out')
+        anomalies.append({'type': 'alert', 'alert': f'anomaly_detection.{job_name}', 'severity': 100,
+                          'record': rec, 'description': '', 'time': start})
+    return anomalies
+
+
+def _run_aggregate_byte_anomalies(anomalies):
+    aggregate_byte_anomalies(anomalies)
+    return len(anomalies)
+
+
+def _setup_history(scale):
+    """The number of saved records: 1 per 100 documents, no more than 1000."""
+    return min(1000, max(1, scale // 100))
+
+
+def _run_save_json_in_line(n):
+    op = 'benchmark_history'
+    js = {'result': 'Success', 'jobs': [{'name': 'l7_latency', 'statistics': {'F1': 0.9}}]}
+    for _ in range(n):
+        history_storage.save_json_in_line(op, job='all', js=js)
+    history_storage.remove(op)
+    return n
+
+
+def _setup_alerts(scale):
+    """The alerts: 1 per 10 documents, in the format of the L7LatencyModel alerts."""
+    samples = corpora.generate('l7', max(1, scale // 10))
+    anomalies = [{**s, 'score': -0.9, 'start_time': '2021-01-15 19:40:34.123456',
+                  'end_time': '2021-01-15T19:45:34.123456789Z'} for s in samples]
+    return L7LatencyModel()._format_anomalies(anomalies, {'mean': 1000.0})
+
+
+def _setup_es_alerts(scale):
+    """The alerts written one by one: 1 per 100 documents."""
+    return _fake_es_host(), _setup_alerts(scale // 10)
+
+
+def _run_send_alerts(host, alerts):
+    with fake_es.elastic_client_params(host):
+        AlertClient().send_alerts(alerts)
+    return len(alerts)
+
+
+def _run_alert_formatting(alerts):
+    unify_time_formats([remove_fields(alert, ['host']) for alert in alerts], ['start_time', 'end_time'])
+    format_alert_to_anomaly(alerts)
+    return len(alerts)
+
+
+benchmarks = [
+    Benchmark('ElasticClient.download_and_aggregate_data', _setup_es_flows, lambda host: (host,),
+              _run_download_and_aggregate_data),
+    Benchmark('_aggregate_data', _setup_flows, lambda docs: (docs,), _run_aggregate_data),
+    Benchmark('_additional_aggregation', _setup_aggregated_flows, copy.deepcopy, _run_additional_aggregation),
+    Benchmark('L7LatencyModel.train', _setup_l7, lambda samples: (samples,), _run_l7_train),
+    Benchmark('L7LatencyModel.find_anomalies', _setup_l7_model, lambda state: state, _run_l7_find_anomalies),
+    Benchmark('aggregate_byte_anomalies', _setup_byte_anomalies, lambda a: (copy.deepcopy(a),),
+              _run_aggregate_byte_anomalies),
+    Benchmark('history_storage.save_json_in_line', _setup_history, lambda n: (n,), _run_save_json_in_line),
+    Benchmark('AlertClient.send_alerts', _setup_es_alerts, lambda state: (state[0], copy.deepcopy(state[1])),
+              _run_send_alerts),
+    Benchmark('alert_formatting', _setup_alerts, lambda a: (copy.deepcopy(a),), _run_alert_formatting),
+]
+
+
+def run(benchmark, scale, repeat=3):
+    """
+    Runs a benchmark `repeat` times for a scale.
+    Returns: {'name', 'scale', 'items', 'min_secs', 'median_secs', 'items_per_sec'}
+      or {'name', 'scale', 'error'} if the benchmark failed.
+    """
+    times, items = [], 0
+    try:
+        state = benchmark.setup(scale)
+        for _ in range(repeat):
+            args = benchmark.args(state)
+            start = time.perf_counter()
+            items = benchmark.run(*args)
+            times.append(time.perf_counter() - start)
+    except Exception as ex:
+        return {'name': benchmark.name, 'scale': scale, 'error': f'{type(ex).__name__}: {ex}'}
+    median_secs = statistics.median(times)
+    return {
+        'name': benchmark.name,
+        'scale': scale,
+        'items': items,
+        'min_secs': round(min(times), 6),
+        'median_secs': round(median_secs, 6),
+        'items_per_sec': round(items / median_secs, 1) if median_secs else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the results with the baseline results of the same benchmarks and scales.
+    Returns: a list of regressions: results with median_secs > baseline median_secs * (1 + tolerance).
+    """
+    base = {(r['name'], r['scale']): r for r in baseline.get('results', [])}
+    regressions = []
+    for r in results.get('results', []):
+        b = base.get((r['name'], r['scale']))
+        if b and 'median_secs' in r and 'median_secs' in b and r['median_secs'] > b['median_secs'] * (1 + tolerance):
+            regressions.append({**r, 'baseline_median_secs': b['median_secs'],
+                                'slowdown': round(r['median_secs'] / b['median_secs'], 2)})
+    return regressions
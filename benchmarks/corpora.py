@@ -0,0 +1,140 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from ph.globals import data_dir
+
+"""
+Synthetic flows/l7/dns corpora for the benchmarks. The l7 corpus is modeled on the l7_latency.test_dataset.csv:
+the same (source, destination) pairs with the same frequencies and the latencies resampled from the test dataset.
+The corpora are reproducible: the same seed and scale produce the same documents.
+"""
+
+logs = ['flows', 'l7', 'dns']
+l7_test_dataset = f'{data_dir}/l7_latency.test_dataset.csv'
+window_start = 1610736000  # the start of the test dataset time window
+docs_per_second = 10
+
+
+def _l7_model():
+    df = pd.read_csv(l7_test_dataset, usecols=lambda col: col != 'anomaly')
+    pairs = df.groupby(['src_namespace', 'src_name_aggr', 'dest_namespace', 'dest_service_name',
+                        'dest_name_aggr']).size().reset_index(name='n')
+    return pairs, df['duration_mean'].to_numpy(), df['duration_max'].to_numpy()
+
+
+def _start_times(rng, n):
+    return np.sort(window_start + rng.integers(0, max(1, n // docs_per_second), n))
+
+
+def generate_l7(n, seed=0):
+    rng = np.random.default_rng(seed)
+    pairs, duration_means, duration_maxes = _l7_model()
+    pair_idx = rng.choice(len(pairs), n, p=(pairs['n'] / pairs['n'].sum()).to_numpy())
+    duration_idx = rng.integers(0, len(duration_means), n)
+    noise = rng.uniform(0.9, 1.1, n)
+    start_times = _start_times(rng, n)
+    pairs = pairs.to_dict('records')
+    return [{
+        'start_time': int(start_times[i]),
+        'end_time': int(start_times[i]) + 300,
+        'duration_mean': int(duration_means[duration_idx[i]] * noise[i]),
+        'duration_max': int(duration_maxes[duration_idx[i]] * noise[i]),
+        'bytes_in': int(noise[i] * 1000),
+        'bytes_out': int(noise[i] * 2000),
+        'count': 1,
+        'src_namespace': pairs[pair_idx[i]]['src_namespace'],
+        'src_name_aggr': pairs[pair_idx[i]]['src_name_aggr'],
+        'src_type': 'wep',
+        'dest_service_name': pairs[pair_idx[i]]['dest_service_name'],
+        'dest_service_namespace': pairs[pair_idx[i]]['dest_namespace'],
+        'dest_service_port': 80,
+        'dest_name_aggr': pairs[pair_idx[i]]['dest_name_aggr'],
+        'dest_namespace': pairs[pair_idx[i]]['dest_namespace'],
+        'dest_type': 'wep',
+        'method': 'GET',
+        'user_agent': 'benchmark',
+        'url': f'/{pairs[pair_idx[i]]["dest_service_name"]}',
+        'response_code': 200,
+        'type': 'html/1.1',
+        'host': 'node-0',
+    } for i in range(n)]
+
+
+def generate_flows(n, seed=0, sources=200, services=50):
+    rng = np.random.default_rng(seed)
+    source_idx = rng.integers(0, sources, n)
+    service_idx = rng.integers(0, services, n)
+    bytes_in = rng.integers(0, 100000, n)
+    bytes_out = rng.integers(0, 100000, n)
+    ports = rng.integers(1, 65535, n)
+    start_times = _start_times(rng, n)
+    return [{
+        'start_time': int(start_times[i]),
+        'source_name_aggr': f'source-{source_idx[i]}-*',
+        'source_namespace': f'namespace-{source_idx[i] % 10}',
+        'source_type': 'wep',
+        'dest_ip': f'10.0.{service_idx[i] // 256}.{service_idx[i] % 256}',
+        'dest_name': f'service-{service_idx[i]}-0',
+        'dest_name_aggr': f'service-{service_idx[i]}-*',
+        'dest_namespace': f'namespace-{service_idx[i] % 10}',
+        'dest_service_namespace': f'namespace-{service_idx[i] % 10}',
+        'dest_service_name': f'service-{service_idx[i]}',
+        'dest_service_port': 80,
+        'dest_port': int(ports[i]),
+        'dest_type': 'wep',
+        'proto': 'tcp',
+        'bytes_in': int(bytes_in[i]),
+        'bytes_out': int(bytes_out[i]),
+        'num_flows': 1,
+        'packets_in': int(bytes_in[i] // 1000),
+        'packets_out': int(bytes_out[i] // 1000),
+        'host': 'node-0',
+    } for i in range(n)]
+
+
+def generate_dns(n, seed=0, clients=200, names=1000):
+    rng = np.random.default_rng(seed)
+    client_idx = rng.integers(0, clients, n)
+    name_idx = rng.integers(0, names, n)
+    latency = rng.lognormal(10, 1, n)
+    start_times = _start_times(rng, n)
+    return [{
+        'start_time': int(start_times[i]),
+        'end_time': int(start_times[i]) + 300,
+        'qname': f'name-{name_idx[i]}.example.com',
+        'qtype': 'A',
+        'rcode': 'NoError',
+        'client_name_aggr': f'client-{client_idx[i]}-*',
+        'client_namespace': f'namespace-{client_idx[i] % 10}',
+        'latency_count': 1,
+        'latency_mean': int(latency[i]),
+        'latency_max': int(latency[i] * 1.5),
+    } for i in range(n)]
+
+
+generators = {'flows': generate_flows, 'l7': generate_l7, 'dns': generate_dns}
+
+
+def generate(log, n, seed=0):
+    return generators[log](n, seed)
+
+
+def save(log, n, dir_name, seed=0):
+    """
+    Saves a corpus as a NDJSON file `<dir_name>/<log>.<n>.ndjson`. An existed file is reused.
+    Each document gets the '@timestamp' field (ISO format of the end of the document time interval).
+    Returns the file name.
+    """
+    os.makedirs(dir_name, exist_ok=True)
+    file_name = f'{dir_name}/{log}.{n}.ndjson'
+    if os.path.exists(file_name):
+        return file_name
+    with open(f'{file_name}.tmp', 'w') as f:
+        for doc in generate(log, n, seed):
+            ts = pd.Timestamp(doc.get('end_time', doc['start_time']), unit='s').isoformat()
+            f.write(json.dumps({**doc, '@timestamp': ts}) + '\n')
+    os.replace(f'{file_name}.tmp', file_name)
+    return file_name
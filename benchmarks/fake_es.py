@@ -0,0 +1,494 @@
+import argparse
+import asyncio
+import fnmatch
+import json
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from ph import elastic_api
+from ph.globals import data_dir
+
+from . import corpora
+
+"""
+A local Elasticsearch stand-in for the load tests of the ES client paths. It is a small async app that keeps the
+indices in memory and implements the subset of the ES 7.x REST API used by the ElasticClient and its tools:
+  `_search` with `scroll`, `_search/scroll` (and its DELETE), `_bulk`, `_create`,
+  point-in-time (`_pit`) and `search_after` with `sort`,
+  the `filter_path` parameter, the `match_all`, `range` and `bool` (`filter`, `must`) queries.
+The data indices are loaded from the NDJSON corpora (see corpora.save). Their names are the ElasticClient index
+patterns where '*' is replaced with 'fake', so the ElasticClient finds them with its own patterns.
+The latency of every request and the maximal page size of the search responses can be injected, to emulate a
+remote cluster. Run it from the project root dir:
+> python -m benchmarks.fake_es --scale 100000 --port 9200 --latency-ms 20
+and start the performance hotspots with the ELASTIC_HOST=127.0.0.1 ELASTIC_PORT=9200 environment variables.
+"""
+
+corpora_dir = f'{data_dir}/benchmarks/corpora'
+default_page_size = 10
+shard_doc = '_shard_doc'
+
+
+def index_name(log):
+    return elastic_api.params.indices[log].replace('*', 'fake')
+
+
+def _keep_alive_secs(value, default=60.0):
+    """'20s', '1m', '500ms' -> seconds."""
+    if not value:
+        return default
+    value = str(value)
+    for suffix, factor in [('ms', 0.001), ('s', 1), ('m', 60), ('h', 3600), ('d', 86400)]:
+        if value.endswith(suffix) and value[:-len(suffix)].isdigit():
+            return int(value[:-len(suffix)]) * factor
+    raise ValueError(f'Wrong time value: "{value}"')
+
+
+def _epoch(value):
+    """A date value of the query: ISO string or epoch_millis -> epoch seconds. Naive dates are UTC."""
+    if isinstance(value, (int, float)):
+        return value / 1000
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def _doc_epoch(doc):
+    if '@timestamp' in doc:
+        return _epoch(doc['@timestamp'])
+    if isinstance(doc.get('time'), (int, float)):  # the alerts
+        return doc['time']
+    return time.time()
+
+
+class EsError(Exception):
+    def __init__(self, status, error_type, reason):
+        super().__init__(reason)
+        self.status, self.error_type, self.reason = status, error_type, reason
+
+    def response(self):
+        return JSONResponse({'error': {'root_cause': [{'type': self.error_type, 'reason': self.reason}],
+                                       'type': self.error_type, 'reason': self.reason}, 'status': self.status},
+                            status_code=self.status)
+
+
+class Index:
+    """The documents of an index in the insertion order, with the epoch timestamps and the ids."""
+
+    def __init__(self, name):
+        self.name = name
+        self.docs, self.epochs, self.ids = [], [], []
+        self.id2pos = {}
+
+    def add(self, doc, doc_id=None):
+        doc_id = str(len(self.docs)) if doc_id is None else str(doc_id)
+        if doc_id in self.id2pos:
+            raise EsError(409, 'version_conflict_engine_exception',
+                          f'[{doc_id}]: version conflict, document already exists')
+        self.id2pos[doc_id] = len(self.docs)
+        self.docs.append(doc)
+        self.epochs.append(_doc_epoch(doc))
+        self.ids.append(doc_id)
+        return doc_id
+
+
+class Store:
+    """The in-memory indices, the scroll and the point-in-time contexts and the request counters."""
+
+    def __init__(self, latency_secs=0.0, page_size=None):
+        self.latency_secs = latency_secs
+        self.page_size = page_size  # the maximal page size, None means the requested size
+        self.indices = {}
+        self.scrolls = {}  # scroll_id: {'hits', 'pos', 'size', 'expires'}
+        self.pits = {}  # pit_id: {'indices': {name: docs_number}, 'expires'}
+        self.requests = 0
+
+    def load(self, log, scale, seed=0, dir_name=corpora_dir):
+        """(Re)creates the index of the log with the corpus of the scale."""
+        file_name = corpora.save(log, scale, dir_name, seed)
+        index = Index(index_name(log))
+        with open(file_name) as f:
+            for line in f:
+                index.add(json.loads(line))
+        self.indices[index.name] = index
+        return index
+
+    def index(self, name):
+        if name not in self.indices:
+            self.indices[name] = Index(name)
+        return self.indices[name]
+
+    def resolve(self, patterns):
+        """A comma-separated list of the index names or patterns -> the index names."""
+        names = [n for p in (patterns or '_all').split(',') for n in self.indices
+                 if p in ('_all', '*') or fnmatch.fnmatchcase(n, p)]
+        return list(dict.fromkeys(names))
+
+    def expire(self):
+        now = time.monotonic()
+        for contexts in [self.scrolls, self.pits]:
+            for k in [k for k, v in contexts.items() if v['expires'] < now]:
+                del contexts[k]
+
+    def search(self, names2sizes, body):
+        """
+        Returns the sorted hits of the body query over the first `size` documents of the indices.
+        A hit: (sort_values, index_name, position).
+        """
+        hits = []
+        predicate = _query_predicate(body.get('query', {'match_all': {}}))
+        sort = _sort_spec(body.get('sort'))
+        for name, size in names2sizes.items():
+            index = self.indices[name]
+            for pos in range(size):
+                if predicate(index, pos):
+                    hits.append((_sort_values(index, pos, sort), name, pos))
+        for i, (field, desc) in reversed(list(enumerate(sort))):  # stable multi-key sort
+            hits.sort(key=lambda h: _sort_key(h[0][i]), reverse=desc)
+        if body.get('search_after') is not None:
+            after = [_sort_key(v) for v in body['search_after']]
+            hits = hits[_first_after(hits, after, [desc for _, desc in sort]):]
+        return hits
+
+    def hit(self, hit, source_fields=None):
+        sort_values, name, pos = hit
+        index = self.indices[name]
+        source = index.docs[pos]
+        if isinstance(source_fields, list):
+            source = {k: v for k, v in source.items() if k in source_fields}
+        return {'_index': name, '_type': '_doc', '_id': index.ids[pos], '_score': None, '_source': source,
+                'sort': sort_values}
+
+
+def _query_predicate(query):
+    if not query or 'match_all' in query:
+        return lambda index, pos: True
+    if 'range' in query:
+        (field, conditions), = query['range'].items()
+        checks = []
+        for op, value in conditions.items():
+            if op not in ('gt', 'gte', 'lt', 'lte'):
+                raise EsError(400, 'parsing_exception', f'[range] query does not support [{op}]')
+            checks.append((op, _epoch(value) if field == '@timestamp' else value))
+
+        def in_range(index, pos):
+            v = index.epochs[pos] if field == '@timestamp' else index.docs[pos].get(field)
+            if v is None:
+                return False
+            return all((v > c if op == 'gt' else v >= c if op == 'gte' else v < c if op == 'lt' else v <= c)
+                       for op, c in checks)
+        return in_range
+    if 'bool' in query:
+        clauses = [q for k in ('filter', 'must') for q in _as_list(query['bool'].get(k))]
+        predicates = [_query_predicate(q) for q in clauses]
+        return lambda index, pos: all(p(index, pos) for p in predicates)
+    raise EsError(400, 'parsing_exception', f'Unsupported query: {list(query)}')
+
+
+def _as_list(value):
+    return [] if value is None else value if isinstance(value, list) else [value]
+
+
+def _sort_spec(sort):
+    """The ES sort -> [(field, desc)]. '_doc' and '_shard_doc' are the insertion order."""
+    spec = []
+    for el in _as_list(sort):
+        if isinstance(el, str):
+            field, order = el, 'asc'
+        else:
+            (field, order), = el.items()
+            order = order.get('order', 'asc') if isinstance(order, dict) else order
+        spec.append((shard_doc if field == '_doc' else field, order == 'desc'))
+    return spec or [(shard_doc, False)]
+
+
+def _sort_values(index, pos, sort):
+    values = []
+    for field, _ in sort:
+        if field == shard_doc:
+            values.append(pos)
+        elif field == '@timestamp':
+            values.append(int(index.epochs[pos] * 1000))  # the ES dates are sorted as epoch_millis
+        else:
+            values.append(index.docs[pos].get(field))
+    return values
+
+
+def _sort_key(value):
+    """The missing values are sorted last."""
+    return (1, 0) if value is None else (0, value)
+
+
+def _first_after(hits, after, descs):
+    """The position of the first hit after the `search_after` values, by the binary search on the sorted hits."""
+    def is_after(hit):
+        for v, a, desc in zip(hit[0], after, descs):
+            v = _sort_key(v)
+            if v != a:
+                return v < a if desc else v > a
+        return False
+
+    lo, hi = 0, len(hits)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if is_after(hits[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def _filter(obj, paths):
+    """Applies the `filter_path` paths (the lists of keys, '*' matches any key) to the response."""
+    if any(not p for p in paths):
+        return obj
+    if isinstance(obj, list):
+        res = [_filter(el, paths) for el in obj]
+        res = [el for el in res if el not in (None, {}, [])]
+        return res or None
+    if not isinstance(obj, dict):
+        return None
+    res = {}
+    for k, v in obj.items():
+        sub_paths = [p[1:] for p in paths if p[0] == '*' or p[0] == k]
+        if sub_paths:
+            v = _filter(v, sub_paths)
+            if v not in (None, {}, []):
+                res[k] = v
+    return res
+
+
+def create_app(store):
+    app = FastAPI(title='Fake Elasticsearch', openapi_url=None, docs_url=None, redoc_url=None)
+
+    async def respond(request, body, status_code=200):
+        filter_path = request.query_params.get('filter_path')
+        if filter_path:
+            body = _filter(body, [p.split('.') for p in filter_path.split(',')]) or {}
+        return JSONResponse(body, status_code=status_code)
+
+    async def json_body(request):
+        raw = await request.body()
+        return json.loads(raw) if raw else {}
+
+    @app.exception_handler(EsError)
+    async def es_error(request, ex):
+        return ex.response()
+
+    @app.middleware('http')
+    async def latency(request, call_next):
+        store.requests += 1
+        if store.latency_secs:
+            await asyncio.sleep(store.latency_secs)
+        store.expire()
+        return await call_next(request)
+
+    def page(scroll, started):
+        hits = scroll['hits'][scroll['pos']:scroll['pos'] + scroll['size']]
+        scroll['pos'] += len(hits)
+        return {'took': int((time.perf_counter() - started) * 1000), 'timed_out': False,
+                '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                'hits': {'total': {'value': len(scroll['hits']), 'relation': 'eq'}, 'max_score': None,
+                         'hits': [store.hit(h, scroll['source']) for h in hits]}}
+
+    def page_size(request, body):
+        size = int(request.query_params.get('size', body.get('size', default_page_size)))
+        return min(size, store.page_size) if store.page_size else size
+
+    @app.get('/')
+    async def info():
+        return {'name': 'fake-es', 'cluster_name': 'fake-es', 'version': {'number': '7.10.0'},
+                'tagline': 'You Know, for Search'}
+
+    @app.api_route('/_search', methods=['GET', 'POST'])
+    @app.api_route('/{index}/_search', methods=['GET', 'POST'])
+    async def search(request: Request, index: str = None):
+        started = time.perf_counter()
+        body = await json_body(request)
+        pit = body.get('pit')
+        if pit:
+            if index:
+                raise EsError(400, 'action_request_validation_exception',
+                              '[indices] cannot be used with point in time')
+            if pit['id'] not in store.pits:
+                raise EsError(404, 'search_context_missing_exception', f'No search context found for {pit["id"]}')
+            context = store.pits[pit['id']]
+            context['expires'] = time.monotonic() + _keep_alive_secs(pit.get('keep_alive'), context['keep_alive'])
+            names2sizes = context['indices']
+        else:
+            names2sizes = {name: len(store.indices[name].docs) for name in store.resolve(index)}
+        scroll = {'hits': store.search(names2sizes, body), 'pos': 0, 'size': page_size(request, body),
+                  'source': body.get('_source')}
+        resp = page(scroll, started)
+        if pit:
+            resp['pit_id'] = pit['id']
+        elif request.query_params.get('scroll'):
+            scroll_id = uuid.uuid4().hex
+            scroll['expires'] = time.monotonic() + _keep_alive_secs(request.query_params['scroll'])
+            store.scrolls[scroll_id] = scroll
+            resp = {'_scroll_id': scroll_id, **resp}
+        return await respond(request, resp)
+
+    @app.api_route('/_search/scroll', methods=['GET', 'POST'])
+    async def scroll(request: Request):
+        started = time.perf_counter()
+        body = await json_body(request)
+        scroll_id = body.get('scroll_id') or request.query_params.get('scroll_id')
+        if scroll_id not in store.scrolls:
+            raise EsError(404, 'search_context_missing_exception', f'No search context found for id [{scroll_id}]')
+        context = store.scrolls[scroll_id]
+        keep_alive = body.get('scroll') or request.query_params.get('scroll')
+        context['expires'] = time.monotonic() + _keep_alive_secs(keep_alive)
+        return await respond(request, {'_scroll_id': scroll_id, **page(context, started)})
+
+    @app.delete('/_search/scroll')
+    async def clear_scroll(request: Request):
+        body = await json_body(request)
+        scroll_ids = _as_list(body.get('scroll_id'))
+        freed = [s for s in scroll_ids if store.scrolls.pop(s, None) is not None]
+        if scroll_ids == ['_all']:
+            freed = list(store.scrolls)
+            store.scrolls.clear()
+        return await respond(request, {'succeeded': True, 'num_freed': len(freed)})
+
+    @app.post('/{index}/_pit')
+    async def open_point_in_time(request: Request, index: str):
+        keep_alive = _keep_alive_secs(request.query_params.get('keep_alive'))
+        pit_id = uuid.uuid4().hex
+        store.pits[pit_id] = {'indices': {name: len(store.indices[name].docs) for name in store.resolve(index)},
+                              'keep_alive': keep_alive, 'expires': time.monotonic() + keep_alive}
+        return await respond(request, {'id': pit_id})
+
+    @app.delete('/_pit')
+    async def close_point_in_time(request: Request):
+        body = await json_body(request)
+        freed = store.pits.pop(body.get('id'), None) is not None
+        return await respond(request, {'succeeded': True, 'num_freed': int(freed)}, 200 if freed else 404)
+
+    @app.api_route('/{index}/_create/{doc_id}', methods=['PUT', 'POST'])
+    @app.api_route('/{index}/{doc_type}/{doc_id}/_create', methods=['PUT', 'POST'])
+    async def create(request: Request, index: str, doc_id: str, doc_type: str = '_doc'):
+        doc_id = store.index(index).add(await json_body(request), doc_id)
+        return await respond(request, {'_index': index, '_type': '_doc', '_id': doc_id, '_version': 1,
+                                       'result': 'created', '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                                       '_seq_no': len(store.index(index).docs) - 1, '_primary_term': 1}, 201)
+
+    @app.post('/_bulk')
+    @app.put('/_bulk')
+    @app.post('/{index}/_bulk')
+    @app.put('/{index}/_bulk')
+    async def bulk(request: Request, index: str = None):
+        started = time.perf_counter()
+        lines = [line for line in (await request.body()).decode().split('\n') if line.strip()]
+        items, errors, i = [], False, 0
+        while i < len(lines):
+            (action, meta), = json.loads(lines[i]).items()
+            i += 1
+            name = meta.get('_index', index)
+            if action in ('index', 'create'):
+                doc = json.loads(lines[i])
+                i += 1
+                try:
+                    doc_id = store.index(name).add(doc, meta.get('_id'))
+                    items.append({action: {'_index': name, '_type': '_doc', '_id': doc_id, '_version': 1,
+                                           'result': 'created', 'status': 201}})
+                except EsError as ex:
+                    if action == 'create':
+                        errors = True
+                        items.append({action: {'_index': name, '_id': meta.get('_id'), 'status': ex.status,
+                                               'error': {'type': ex.error_type, 'reason': ex.reason}}})
+                    else:  # 'index' overwrites the document
+                        target = store.index(name)
+                        pos = target.id2pos[str(meta['_id'])]
+                        target.docs[pos], target.epochs[pos] = doc, _doc_epoch(doc)
+                        items.append({action: {'_index': name, '_type': '_doc', '_id': str(meta['_id']),
+                                               'result': 'updated', 'status': 200}})
+            else:
+                if action == 'update':
+                    i += 1
+                errors = True
+                items.append({action: {'_index': name, '_id': meta.get('_id'), 'status': 400,
+                                       'error': {'type': 'illegal_argument_exception',
+                                                 'reason': f'Unsupported bulk action [{action}]'}}})
+        return await respond(request, {'took': int((time.perf_counter() - started) * 1000), 'errors': errors,
+                                       'items': items})
+
+    @app.api_route('/{index}/_count', methods=['GET', 'POST'])
+    async def count(request: Request, index: str):
+        body = await json_body(request)
+        hits = store.search({name: len(store.indices[name].docs) for name in store.resolve(index)}, body)
+        return await respond(request, {'count': len(hits)})
+
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def serve(store, port=None):
+    """Runs the fake ES with the store in a background thread. Yields the 'host:port' of the server."""
+    import uvicorn
+
+    port = port or free_port()
+    server = uvicorn.Server(uvicorn.Config(create_app(store), host='127.0.0.1', port=port, log_level='warning',
+                                           lifespan='off'))
+    thread = threading.Thread(target=server.run, name='fake-es', daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f'The fake ES failed to start on the {port} port.')
+        time.sleep(0.01)
+    try:
+        yield f'127.0.0.1:{port}'
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+@contextmanager
+def elastic_client_params(host):
+    """Points the ElasticClient of this process to the host, without TLS and authentication."""
+    original = elastic_api.params
+    elastic_api.params = original._replace(host=host, cafile=None, http_auth=None)
+    try:
+        yield elastic_api.params
+    finally:
+        elastic_api.params = original
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A local Elasticsearch stand-in with the generated corpora.')
+    parser.add_argument('--logs', nargs='+', default=corpora.logs, choices=corpora.logs)
+    parser.add_argument('--scale', type=int, default=100000, help='The number of documents of every log index.')
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='The latency of every request.')
+    parser.add_argument('--page-size', type=int, default=None, help='The maximal page size of the search responses.')
+    parser.add_argument('--corpora-dir', default=corpora_dir)
+    args = parser.parse_args()
+
+    store = Store(args.latency_ms / 1000, args.page_size)
+    for log in args.logs:
+        index = store.load(log, args.scale, dir_name=args.corpora_dir)
+        print(f'Loaded {len(index.docs):,} documents into the "{index.name}" index.')
+    with serve(store, args.port) as host:
+        print(f'Fake Elasticsearch is listening on {host}. Press Ctrl+C to stop.')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,29 @@
 import os
+import sys
 import logging
 
 from . import ph
-from . import api
 from .globals import APP_NAME
 
 logger = logging.getLogger(APP_NAME)
 
 if __name__ == "__main__":
 
+    # the backfill mode: python -m ph backfill --start ... --end ...
+    if sys.argv[1:2] == ['backfill']:
+        from . import backfill
+        sys.exit(backfill.main(sys.argv[2:]))
+
+    # the hyperparameter search mode: python -m ph tune --job ...
+    if sys.argv[1:2] == ['tune']:
+        from . import tuning
+        sys.exit(tuning.main(sys.argv[2:]))
+
     # start API
     PH_NEED_API = eval(os.getenv('PH_NEED_API', 'False'))
     logger.info(f'PH_NEED_API: {PH_NEED_API}')
     if PH_NEED_API:
+        from . import api  # fastapi, uvicorn, pydantic are loaded only when the API is needed
         api.start()
 
     # start the job scheduler
@@ -1,12 +1,19 @@
+import re
 import logging
 import os
+import functools
+from collections import Counter
 from datetime import datetime
 
 from . import elastic_api
+from . import metrics
+from .instrumentation import traced
 from .globals import APP_NAME
 
 logger = logging.getLogger(APP_NAME)
 
+alert_time_fields = ['start_time', 'end_time']
+
 
 class AlertClient:
     """
@@ -17,6 +24,7 @@ class AlertClient:
         self.removed_fields = os.getenv('PH_ES_FIELDS_NOT_FOR_ALERT', 'host').split(',')
         logger.info(f'Initialized AlertClient.')
 
+    @traced('send_alerts', count='alerts')
     def send_alerts(self, alerts):
         """
         Send alerts to the Elasticsearch.
@@ -31,18 +39,54 @@ class AlertClient:
             nothing
         """
         if not alerts: return
+        alerts = unify_time_formats([remove_fields(a, self.removed_fields) for a in alerts], alert_time_fields)
         for anomaly in alerts:
-            anomaly = remove_fields(anomaly, self.removed_fields)
-            anomaly = unify_time_format(anomaly, ['start_time', 'end_time'])
-            self.elastic_client.write_alert(anomaly)
+            with metrics.timer('ph_alert_write_seconds'):
+                self.elastic_client.write_alert(anomaly)
         logger.info(f'AlertClient: sent {len(alerts):,} alerts with anomalies.')
 
+    @traced('send_alerts_in_bulk', count='alerts')
+    def send_alerts_in_bulk(self, alerts, ids=None, chunk_size=500):
+        """
+        Sends alerts to the Elasticsearch with the bulk API. The alerts are prepared as in send_alerts().
+        ids: the alert ids, the alerts with the ids of already sent alerts are not sent again.
+        chunk_size: the number of alerts in one bulk request.
+        Returns: (sent, duplicates)
+        """
+        if not alerts: return 0, 0
+        alerts = unify_time_formats([remove_fields(a, self.removed_fields) for a in alerts], alert_time_fields)
+        sent, duplicates = self.elastic_client.write_alerts(alerts, ids, chunk_size)
+        logger.info(f'AlertClient: sent {sent:,} alerts with anomalies in bulk, {duplicates:,} duplicates skipped.')
+        return sent, duplicates
+
+
+# the formats of the time strings: "2021-03-22T16:34:16.228614279Z", "2021-02-03 08:10:00.12", "2020-12-21 08:25:00"
+_time_pattern = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.\d*)?Z?')
+time_format_failures = Counter()  # {field name: the number of the values not parsed}
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_time(value):
+    """
+    Returns the time string as int(timestamp) or None if the format is unknown. The alerts of a bucket share
+    the same time strings, so the results are memoized.
+    The strings without the time zone are the local times, as the strptime(...).timestamp() parsed them before.
+    """
+    match = _time_pattern.fullmatch(value)
+    if match:
+        return int(datetime(*map(int, match.groups())).timestamp())
+    try:  # the other ISO 8601 formats, as with the time zone offset
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        return None
+
 
 def unify_time_format(alert, unified_fields):
     """
     Replace unified_fields values with int(value.timestamp()).
-    Values can be in the list of predefined datetime formats.
-    If format is not found, we use the utcnow().timestamp() instead of the values.
+    Values can be in the ISO 8601 formats.
+    If format is not found, we use the utcnow().timestamp() instead of the values and count the failure in
+    the time_format_failures.
     We unify fields because the ES needs the above format (in our case).
     Args:
         alert: dict. The unified_fields kept inside the alert['record'] dict.
@@ -55,25 +99,27 @@ def unify_time_format(alert, unified_fields):
         return alert
     root_field = alert['record']
     for field_name in unified_fields:
-        if field_name not in root_field:
-            continue
-        field = root_field[field_name]
-        if type(field) == int:  # timestamp format, as 1615431612. Do nothing.
-            continue
-        elif type(field) == str:
-            res = int(datetime.utcnow().timestamp())  # if nothing works use now() at last :()
-            # formats with Z and T appeared in the python 3.7+ only
-            for frmt in ["%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"]:
-                try:
-                    # strptime doesn't work well with 'T', 'Z' and long msec part.
-                    res = int(datetime.strptime(field.replace('T', ' ').replace('Z', '')[:26], frmt).timestamp())
-                    break
-                except ValueError:
-                    continue
+        field = root_field.get(field_name)
+        if type(field) == str:  # int is the timestamp format, as 1615431612. Do nothing.
+            res = parse_time(field)
+            if res is None:
+                time_format_failures[field_name] += 1
+                res = int(datetime.utcnow().timestamp())  # if nothing works use now() at last :()
             root_field[field_name] = res
     return alert
 
 
+def unify_time_formats(alerts, unified_fields):
+    """unify_time_format() of the alert batch. Logs the number of the values not parsed in the batch."""
+    failures = sum(time_format_failures.values())
+    alerts = [unify_time_format(alert, unified_fields) for alert in alerts]
+    failures = sum(time_format_failures.values()) - failures
+    if failures:
+        logger.warning(f'  *** {failures:,} time values of {len(alerts):,} alerts are in unknown formats, replaced '
+                       f'with now(). All failures: {dict(time_format_failures)}')
+    return alerts
+
+
 def remove_fields(alert, removed_fields):
     """
     Removes removed_fields from the 'record' element of the alert.
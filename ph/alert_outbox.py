@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+
+from .globals import APP_NAME, data_dir
+from . import metrics
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+The durable outbox of the alerts. The detection cycle only enqueues its alerts (a local SQLite insert), the sender
+thread of the scheduler process writes them into the events index, so a slow or unavailable index does not
+stretch the detection cycle and the alerts are not lost on an error.
+  - the sender writes the alerts in bulk, PH_alert_outbox_batch_size alerts per request, it never loads the whole
+    queue into memory,
+  - the failed alerts of a batch are retried with the exponential backoff: PH_alert_outbox_retry_seconds *
+    2 ** attempts, at most PH_alert_outbox_max_retry_seconds. The written alerts of the batch are removed,
+  - an alert that failed PH_alert_outbox_max_attempts times is moved into the dead-letter table (`dead_letters`),
+  - the alert id is the hash of the alert record (see backfill.alert_id). A retried batch, that was partially
+    written, does not write its alerts twice (the ES rejects the written ids), the same alert is not enqueued twice,
+  - the queue is bounded with PH_alert_outbox_max_alerts, the oldest alerts are dropped on overflow.
+The sender observes the lag (from the enqueueing to the writing) of the alerts and sets the gauges of the queue depth
+and of the age of the oldest alert in the metrics.
+Only one sender drains the outbox at a time, the others skip the draining (a file lock).
+"""
+
+Params = namedtuple('Params', 'PH_alert_outbox PH_alert_outbox_batch_size PH_alert_outbox_poll_seconds '
+                              'PH_alert_outbox_retry_seconds PH_alert_outbox_max_retry_seconds '
+                              'PH_alert_outbox_max_alerts PH_alert_outbox_max_attempts')
+params = Params(
+    eval(os.getenv('PH_alert_outbox', 'True')),
+    int(os.getenv('PH_alert_outbox_batch_size', 500)),
+    float(os.getenv('PH_alert_outbox_poll_seconds', 5)),
+    float(os.getenv('PH_alert_outbox_retry_seconds', 5)),
+    float(os.getenv('PH_alert_outbox_max_retry_seconds', 600)),
+    int(os.getenv('PH_alert_outbox_max_alerts', 100000)),
+    int(os.getenv('PH_alert_outbox_max_attempts', 20)),
+)
+logger.info('Initialized params for the alert_outbox.py: ' + ', '.join(
+    [f'{n}: {el}' for el, n in zip(params, params._fields)]))
+
+db_file_name = f'{data_dir}/alert_outbox.sqlite'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, alert_id TEXT NOT NULL UNIQUE, enqueued REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, alert TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt, id);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY, alert_id TEXT NOT NULL, enqueued REAL NOT NULL, attempts INTEGER NOT NULL,
+    failed REAL NOT NULL, error TEXT NOT NULL, alert TEXT NOT NULL);
+"""
+
+
+def _connect():
+    os.makedirs(os.path.dirname(db_file_name), exist_ok=True)
+    connection = sqlite3.connect(db_file_name, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(_schema)
+    return connection
+
+
+@contextmanager
+def _connection():
+    connection = _connect()
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+@contextmanager
+def _sender_lock():
+    """Yields True if this sender holds the lock, False if another sender drains the outbox."""
+    os.makedirs(os.path.dirname(db_file_name), exist_ok=True)
+    with open(f'{db_file_name}.lock', 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def enqueue(alerts, now=None):
+    """Saves the alerts into the outbox. Returns: the number of the enqueued (not duplicated) alerts."""
+    from .backfill import alert_id
+
+    if not alerts:
+        return 0
+    now = now or time.time()
+    rows = [(alert_id(a), now, now, json.dumps(a, default=lambda o: o.item() if hasattr(o, 'item') else str(o)))
+            for a in alerts]
+    with _connection() as connection:
+        enqueued = connection.executemany(
+            'INSERT OR IGNORE INTO outbox (alert_id, enqueued, next_attempt, alert) VALUES (?, ?, ?, ?)',
+            rows).rowcount
+        depth = connection.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+        if depth > params.PH_alert_outbox_max_alerts:
+            dropped = connection.execute(
+                'DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)',
+                (depth - params.PH_alert_outbox_max_alerts,)).rowcount
+            logger.warning(f'  *** The alert outbox is full. Dropped {dropped:,} oldest alerts.')
+    logger.info(f'Enqueued {enqueued:,} of {len(alerts):,} alerts into the outbox.')
+    return enqueued
+
+
+def depth():
+    """
+    Returns: (the number of the queued alerts, the age of the oldest alert in seconds or 0).
+    They are set as the gauges of the metrics.
+    """
+    with _connection() as connection:
+        count, oldest = connection.execute('SELECT COUNT(*), MIN(enqueued) FROM outbox').fetchone()
+    age = time.time() - oldest if oldest else 0
+    metrics.set_gauge('ph_alert_outbox_depth', count)
+    metrics.set_gauge('ph_alert_outbox_oldest_alert_seconds', age)
+    return count, age
+
+
+def dead_letters():
+    """Returns: the alerts that failed PH_alert_outbox_max_attempts times."""
+    with _connection() as connection:
+        return [json.loads(r[0]) for r in connection.execute('SELECT alert FROM dead_letters ORDER BY id')]
+
+
+def _backoff(attempts):
+    return min(params.PH_alert_outbox_retry_seconds * 2 ** attempts, params.PH_alert_outbox_max_retry_seconds)
+
+
+def drain(alert_client=None, now=None):
+    """
+    Writes the due alerts of the outbox in batches, till the outbox has no due alerts or a batch fails.
+    The written (or already written) alerts of a failed batch are removed, the failed ones are retried.
+    alert_client: an AlertClient, it is created on the first batch if None.
+    Returns: the number of the written alerts.
+    """
+    written = 0
+    with _sender_lock() as locked:
+        if not locked:
+            return written
+        while True:
+            now_ = now or time.time()
+            with _connection() as connection:
+                rows = connection.execute(
+                    'SELECT id, alert_id, enqueued, attempts, alert FROM outbox WHERE next_attempt <= ? '
+                    'ORDER BY next_attempt, id LIMIT ?', (now_, params.PH_alert_outbox_batch_size)).fetchall()
+            if not rows:
+                return written
+            if alert_client is None:
+                from .alert_api import AlertClient
+                alert_client = AlertClient()
+            failed_ids, error = (), None
+            try:
+                alert_client.send_alerts_in_bulk([json.loads(r[4]) for r in rows], [r[1] for r in rows],
+                                                 chunk_size=params.PH_alert_outbox_batch_size)
+            except Exception as ex:
+                # a bulk error lists its not written alerts, other errors fail the whole batch
+                failed_ids, error = set(getattr(ex, 'failed_ids', None) or [r[1] for r in rows]), str(ex)
+            failed = [r for r in rows if r[1] in failed_ids]
+            sent_rows = [r for r in rows if r[1] not in failed_ids]
+            if failed:
+                _fail(failed, error, now_)
+            with _connection() as connection:
+                connection.executemany('DELETE FROM outbox WHERE id = ?', [(r[0],) for r in sent_rows])
+            sent = time.time()
+            for r in sent_rows:
+                metrics.observe('ph_alert_outbox_lag_seconds', sent - r[2])
+            written += len(sent_rows)
+            if failed:
+                return written
+
+
+def _fail(rows, error, now):
+    """
+    Schedules the next attempts of the failed alerts. The alerts failed PH_alert_outbox_max_attempts times are
+    moved into the dead letters.
+    """
+    retried = [r for r in rows if r[3] + 1 < params.PH_alert_outbox_max_attempts]
+    dead = [r for r in rows if r[3] + 1 >= params.PH_alert_outbox_max_attempts]
+    with _connection() as connection:
+        connection.executemany('UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?',
+                               [(r[3] + 1, now + _backoff(r[3]), r[0]) for r in retried])
+        connection.executemany('INSERT INTO dead_letters (alert_id, enqueued, attempts, failed, error, alert) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', [(r[1], r[2], r[3] + 1, now, error, r[4]) for r in dead])
+        connection.executemany('DELETE FROM outbox WHERE id = ?', [(r[0],) for r in dead])
+    logger.error(f'  *** Exception: "{error}". {len(rows):,} alerts are not sent, the next attempt of '
+                 f'{len(retried):,} alerts in {_backoff(rows[0][3]):,.0f} secs.')
+    if dead:
+        logger.error(f'  *** {len(dead):,} alerts failed {params.PH_alert_outbox_max_attempts} times, they are moved '
+                     f'into the dead letters of the outbox.')
+
+
+def _send_loop():
+    while True:
+        try:
+            drain()
+            depth()
+            metrics.flush()
+        except Exception as ex:
+            logger.error(f'  *** Exception: "{str(ex)}" in the alert outbox sender.')
+        time.sleep(params.PH_alert_outbox_poll_seconds)
+
+
+def start_sender():
+    """Starts the sender thread, that drains the outbox every PH_alert_outbox_poll_seconds."""
+    threading.Thread(target=_send_loop, name='ph_alert_outbox', daemon=True).start()
+    logger.info('Started the alert outbox sender.')
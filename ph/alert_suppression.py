@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import fcntl
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+
+from .globals import APP_NAME, data_dir, job_name2job
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+The alert suppression stage between the detection and the AlertClient.
+Consecutive detection cycles re-detect the same hot spot. The anomalies are grouped by the suppression key:
+the namespace of the models, the job and the values of the job group_fields without the time fields and the value
+field (the same `src_namespace/src_name_aggr -> dest_service_name` for the l7_latency).
+  - the anomalies of a key in one cycle are coalesced into one alert: the alert with the highest confidence,
+    with the 'count', 'first_start_time' and 'last_start_time' fields in its record,
+  - an alert of a key sent less than PH_alert_suppression_minutes ago is suppressed, the suppressed anomalies are
+    counted in the next alert of the key.
+The state is {key: {'sent', 'seen', 'count', 'first', 'last'}}, the keys not seen for PH_alert_suppression_minutes
+expire, at most PH_alert_suppression_max_keys least recently seen keys are kept. It is a JSON file replaced atomically
+under a file lock, so it survives the restarts.
+"""
+
+Params = namedtuple('Params', 'PH_alert_suppression PH_alert_suppression_minutes PH_alert_suppression_max_keys')
+params = Params(
+    eval(os.getenv('PH_alert_suppression', 'True')),
+    int(os.getenv('PH_alert_suppression_minutes', 120)),
+    int(os.getenv('PH_alert_suppression_max_keys', 10000)),
+)
+logger.info('Initialized params for the alert_suppression.py: ' + ', '.join(
+    [f'{n}: {el}' for el, n in zip(params, params._fields)]))
+
+file_name = f'{data_dir}/alert_suppression.json'
+time_fields = {'start_time', 'end_time'}
+
+
+def _read():
+    if not os.path.isfile(file_name):
+        return {}
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def _write(state):
+    with open(f'{file_name}.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(f'{file_name}.tmp', file_name)
+
+
+@contextmanager
+def _lock():
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(f'{file_name}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def key_fields(job_name):
+    """The group_fields of the job without the time fields and the value field."""
+    job = job_name2job[job_name]
+    value_field = job.field.split('.')[-1]
+    return [f for f in job.group_fields if f not in time_fields and f != value_field]
+
+
+def alert_key(alert, namespace):
+    job_name = alert['alert'].split('.')[1]
+    if job_name in job_name2job:
+        fields = key_fields(job_name)
+    else:  # the aggregated jobs: all record fields without the times and the scores
+        fields = sorted(f for f in alert['record'] if f not in time_fields | {'confidence', 'score'})
+    return json.dumps([namespace, job_name] + [alert['record'].get(f) for f in fields], default=str)
+
+
+def _epoch(start_time):
+    """The record 'start_time' in epoch seconds, to compare the times of different formats."""
+    from .alert_api import unify_time_format
+    return unify_time_format({'record': {'start_time': start_time}}, ['start_time'])['record']['start_time']
+
+
+def suppress(alerts, namespace, now=None):
+    """
+    Coalesces the alerts by the suppression key and suppresses the recently sent ones.
+    Returns: the alerts to be sent. The input alerts are not changed.
+    """
+    if not params.PH_alert_suppression or not alerts:
+        return alerts
+    now = now or time.time()
+    window = params.PH_alert_suppression_minutes * 60
+    groups = {}
+    for alert in alerts:
+        groups.setdefault(alert_key(alert, namespace), []).append(alert)
+
+    sent = []
+    with _lock():
+        state = {k: v for k, v in _read().items() if now - v['seen'] < window}
+        for key, group in groups.items():
+            starts = [_epoch(a['record']['start_time']) for a in group if a['record'].get('start_time') is not None]
+            entry = state.setdefault(key, {'sent': None, 'count': 0, 'first': None, 'last': None})
+            entry['seen'] = now
+            entry['count'] += len(group)
+            if starts:
+                entry['first'] = min([s for s in [entry['first']] if s is not None] + starts)
+                entry['last'] = max([s for s in [entry['last']] if s is not None] + starts)
+            if entry['sent'] is not None and now - entry['sent'] < window:
+                continue
+            alert = max(group, key=lambda a: a['record'].get('confidence') or 0)
+            sent.append({**alert, 'record': {**alert['record'], 'count': entry['count'],
+                                             'first_start_time': entry['first'], 'last_start_time': entry['last']}})
+            entry.update(sent=now, count=0, first=None, last=None)
+        if len(state) > params.PH_alert_suppression_max_keys:  # the least recently seen keys are removed
+            state = dict(sorted(state.items(), key=lambda kv: kv[1]['seen'])[-params.PH_alert_suppression_max_keys:])
+        _write(state)
+    logger.info(f'Alert suppression: {len(alerts):,} anomalies, {len(groups):,} keys, {len(sent):,} alerts to send.')
+    return sent
@@ -1,31 +1,173 @@
+import asyncio
+import functools
 import itertools
+import json
 import logging
+import os
+import threading
 import uuid
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional, List, Union
 from multiprocessing import Process
-import uvicorn
 
-from fastapi import BackgroundTasks, FastAPI, Response, status
+from fastapi import BackgroundTasks, FastAPI, Query, Request, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
+from . import elastic_api
 from . import model_processor
+from . import metrics
+from . import instrumentation
+from . import profiler
+from . import response_cache
+from . import job_manager
+from . import result_store
+from . import dataset_cache
 from .ph import self_diagnostics
-from .api_classes import JobNames, OperationDataRq, Anomaly, JobParams
+from .api_classes import JobNames, OperationDataRq, Anomaly, JobParams, ProfileTargets, CalibrationRq, \
+    TuneRq
 from .api_helper import prepare_samples, prepare_all_samples, set_envvars, get_envvars, format_alert_to_anomaly
-from .globals import APP_NAME, jobs
+from .globals import APP_NAME, jobs, production_namespace, diagnostics_namespace, diagnostics_real_life_namespace
 from .history_storage import read_id_json
 
 logger = logging.getLogger(APP_NAME)
 
+"""
+The operation handlers are async. The blocking work never runs in the event loop: the ES downloads and the dataset
+reading run in the io executor, the model scoring runs in the cpu executor. Each executor is bounded, so the
+concurrent requests queue up in it and the light endpoints (ping, parameters, metrics) stay responsive.
+The streamed detection scores the samples chunk by chunk: the download pages of the logs or the
+PH_api_stream_chunk_size samples, so the time to the first anomalies does not grow with the window.
+"""
+Params = namedtuple('Params', 'PH_api_io_workers PH_api_cpu_workers PH_api_stream_chunk_size')
+params = Params(
+    int(os.getenv('PH_api_io_workers', 8)),
+    int(os.getenv('PH_api_cpu_workers', min(4, os.cpu_count() or 1))),
+    int(os.getenv('PH_api_stream_chunk_size', 10000)),
+)
+
+_io_executor = ThreadPoolExecutor(params.PH_api_io_workers, thread_name_prefix='ph_api_io')
+_cpu_executor = ThreadPoolExecutor(params.PH_api_cpu_workers, thread_name_prefix='ph_api_cpu')
+
 local_jobs = jobs()
 job_name2data_type = {job.name: job.data_type for job in local_jobs}
 dynamic_jobs = {job.name for job in local_jobs if job.dynamic_model}
+job_params = {job.name: job.params for job in local_jobs}
+ndjson_media_type = 'application/x-ndjson'
 
 app = FastAPI()
 
 
+async def _run(executor, func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def _prepare_samples(rq: OperationDataRq):
+    return prepare_all_samples(rq, local_jobs) if rq.job.name == 'all' else prepare_samples(rq, local_jobs)
+
+
+def _detect_all(samples, namespace):
+    anomalies = [model_processor.detect(job.name, samples[job.data_type], namespace=namespace)
+                 for job in local_jobs]
+    anomalies = list(itertools.chain(*anomalies))  # flatten List[list] -> list
+    return model_processor.aggregate_byte_anomalies(anomalies)
+
+
+def _json_default(obj):
+    return obj.item() if hasattr(obj, 'item') else str(obj)  # numpy scalars
+
+
+def _ndjson(anomalies):
+    return ''.join(json.dumps(a, default=_json_default) + '\n' for a in anomalies)
+
+
+def _page_chunks(pages, data_type):
+    """The chunks of the download pages. Closing the chunks closes the pages, it clears the ES scroll."""
+    try:
+        for page in pages:
+            if page:
+                yield {data_type: page}
+    finally:
+        pages.close()
+
+
+def _stream_chunks(rq: OperationDataRq):
+    """
+    The iterator of the sample chunks {data_type: samples} of the streamed detection. A single job, which scores
+    the log documents as they are (not aggregated), gets the download pages of the logs. The other requests get
+    the prepared samples in chunks of PH_api_stream_chunk_size.
+    """
+    job = next((j for j in local_jobs if j.name == rq.job.name), None)
+    if rq.data_source.name == 'logs' and job and job.data_type == job.source_log:
+        start, end = getattr(rq.data, 'start', None), getattr(rq.data, 'end', None)
+        max_docs = rq.max_log_records or int(os.getenv('PH_max_docs', 500000))
+        pages = elastic_api.ElasticClient().iter_pages(job.source_log, start, end, max_docs)
+        return _page_chunks(pages, job.data_type)
+    data_types = {j.data_type for j in local_jobs if rq.job.name in ('all', j.name)}
+    samples, size = _prepare_samples(rq), params.PH_api_stream_chunk_size
+    return ({data_type: samples[data_type][i:i + size]} for data_type in samples if data_type in data_types
+            for i in range(0, len(samples[data_type]), size))
+
+
+def _stream_chunking():
+    """The chunk sizes of the streamed detection: the download page size of the logs and the samples chunk size."""
+    return 'stream', elastic_api.params.query_size, params.PH_api_stream_chunk_size
+
+
+async def _stream_anomalies(job_name, chunks, namespace, first=None, cache_key=None, end=None):
+    """
+    Yields the NDJSON lines of the anomalies as soon as a chunk of the samples is scored (see _stream_chunks).
+    first: the first chunk, already taken from the chunks.
+    The confidence of an anomaly is relative to the most anomalous sample of its chunk. The anomalies of the byte
+    jobs of the 'all' job are aggregated together, so they are yielded at the end.
+    The chunks are closed if the client disconnects, so the download (the ES scroll) is stopped and cleared. The
+    chunks are read and closed under a lock, the close waits for the chunk being read.
+    """
+    stream_jobs = local_jobs if job_name == 'all' else [j for j in local_jobs if j.name == job_name]
+    detected, byte_anomalies, job_chunks = [], [], Counter()
+    chunks_lock = threading.Lock()
+
+    def next_chunk():
+        with chunks_lock:
+            return next(chunks, None)
+
+    def close_chunks():
+        with chunks_lock:
+            chunks.close()
+
+    try:
+        samples = first if first is not None else await _run(_io_executor, next_chunk)
+        while samples is not None:
+            for job in stream_jobs:
+                if not samples.get(job.data_type):
+                    continue
+                job_chunks[job.name] += 1
+                anomalies = await _run(_cpu_executor, model_processor.detect, job.name, samples[job.data_type],
+                                       namespace=namespace)
+                if job_name == 'all' and job.name in model_processor.byte_jobs:
+                    byte_anomalies += anomalies
+                    continue
+                anomalies = format_alert_to_anomaly(anomalies)
+                detected += anomalies
+                if anomalies:
+                    yield _ndjson(anomalies)
+            samples = await _run(_io_executor, next_chunk)
+    finally:
+        await _run(_io_executor, close_chunks)
+    if byte_anomalies:
+        anomalies = format_alert_to_anomaly(model_processor.aggregate_byte_anomalies(byte_anomalies))
+        detected += anomalies
+        yield _ndjson(anomalies)
+    logger.info(f"Stop streaming Detection with '{job_name}'. {len(detected):,} anomalies in "
+                f"{sum(job_chunks.values()):,} chunks.")
+    if cache_key:
+        response_cache.put(cache_key, detected, end)
+
+
 def start():
     logger.info(f'START: API')
+    import uvicorn
     kwargs = {'host': "0.0.0.0", 'port': 8000}
     api_proc = Process(target=uvicorn.run, args=(app,), kwargs=kwargs)
     api_proc.start()
@@ -37,6 +179,19 @@ def stop(api_proc):
     logger.info(f'STOP: API')
 
 
+def _valid_namespace(namespace, response: Response):
+    """The self-diagnostics namespaces are reserved, the API callers cannot train or use their models."""
+    try:
+        model_processor.namespace_dir(namespace)
+        if namespace in (diagnostics_namespace, diagnostics_real_life_namespace):
+            raise ValueError(f'*** Error: the model namespace "{namespace}" is reserved for the self-diagnostics.')
+    except ValueError as ex:
+        logger.error(str(ex))
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return False
+    return True
+
+
 @app.get("/ph/ping")
 async def ping():
     """
@@ -47,48 +202,53 @@ async def ping():
     return {"service": "performance_hotspots_service", "utcnow": datetime.utcnow()}
 
 
+@app.get("/ph/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Metrics of the service in the Prometheus text format: histograms of the download, aggregation, training,
+    scoring, model loading and alert writing times and the peak RSS of the cycles.
+
+    It includes the metrics of the train and detection cycles, that run in the scheduler processes.
+    """
+    return PlainTextResponse(metrics.collect(), media_type='text/plain; version=0.0.4')
+
+
 # region Operations:
 @app.post("/ph/ops/train", tags=["Operations"], status_code=202)
-async def train(rq: OperationDataRq, background_tasks: BackgroundTasks, response: Response):
+async def train(rq: OperationDataRq, response: Response):
     """
     Train all or a single model.
 
     It can use training data from the Elasticsearch indexes OR directly from the request OR
     from the internal labeled test datasets.
 
+    The training runs as a job in the worker processes with the current parameters. A training request for
+    the same namespace and job sent while the previous one is not finished returns the job of the previous request,
+    so the same model is not trained concurrently.
+
     - **param rq:** A request. See an example.
 
-    **return:**   Returns status_code=202 `Accepted` because the self-diagnostics operation is a long-running operation and we
-    do not wait till the end of the operation.
+    **return:**   Returns status_code=202 `Accepted` and the job state because the training is a long-running
+    operation and we do not wait till the end of the operation. Use the `/ph/ops/jobs/{id}` endpoint to get
+    the job progress and result. The samples are loaded by the job, so a request without samples does not return
+    404, its job `failed` with the "No samples" `error`.
 
     """
     job_name = rq.job.name
-    samples = prepare_all_samples(rq, local_jobs) if job_name == 'all' else prepare_samples(rq, local_jobs)
-    if not samples:
-        msg = f"* NO training of '{job_name}'. No samples - No training :("
-        response.status_code = status.HTTP_404_NOT_FOUND
-    elif job_name == 'all':
-        _ = [background_tasks.add_task(model_processor.train_job, job.name, samples[job.data_type])
-             for job in local_jobs if job.dynamic_model]
-        # _ = [model_processor.train_job(job.name, samples[job.data_type]) for job in jobs if job.dynamic_model]
-        msg = f'STOP training all models.  Retrained models will replace the old models.'
-    elif job_name not in dynamic_jobs:
+    namespace = rq.namespace or production_namespace
+    if not _valid_namespace(namespace, response):
+        return f"* NO training of '{job_name}'. Wrong model namespace '{namespace}'."
+    if job_name != 'all' and job_name not in dynamic_jobs:
         msg = f"* NO training of '{job_name}'. The model is static and we do not train it here."
         response.status_code = status.HTTP_404_NOT_FOUND
-    elif job_name2data_type[job_name] not in samples:
-        msg = f"* NO training of '{job_name}'. No samples - No training :("
-        response.status_code = status.HTTP_404_NOT_FOUND
-    else:
-        background_tasks.add_task(model_processor.train_job, job_name, samples[job_name2data_type[job_name]])
-        # model_processor.train_job(job_name, samples[job_name2data_type[job_name]])
-        msg = f"STOP training '{job_name}' model with {len(samples[job_name2data_type[job_name]]):,} " \
-              f"samples. Retrained model will replace the old model."
-    logger.info(msg)
-    return msg
+        logger.info(msg)
+        return msg
+    state, _ = job_manager.submit('train', rq, job_manager.train, key=f'{namespace}:{job_name}')
+    return state
 
 
 @app.post("/ph/ops/detect", tags=["Operations"], response_model=List[Anomaly])
-def detect_anomalies(rq: OperationDataRq, response: Response):
+async def detect_anomalies(rq: OperationDataRq, request: Request, response: Response, background: bool = False):
     """
     Detect anomalies using all or just a single model. Use the `job` request field to define it.
 
@@ -97,30 +257,141 @@ def detect_anomalies(rq: OperationDataRq, response: Response):
 
     - **param rq:** A request.
 
+    The responses of the `logs` data_source are cached until the model or the job parameters are changed.
+    A response of the interval that includes "now" is cached for the `PH_detect_cache_ttl_seconds` seconds.
+
+    With the `Accept: application/x-ndjson` header the anomalies are streamed, one JSON object per line, as soon as
+    each chunk of the samples is scored: each download page of the logs or `PH_api_stream_chunk_size` samples.
+    The confidence of a streamed anomaly is relative to its chunk. The streamed anomalies are not validated with
+    the `Anomaly` model. The streamed responses are cached apart from the not streamed ones.
+
+    - **param background:** Run the detection as a job in the worker processes, for the large windows.
+      Returns status_code=202 `Accepted` and the job state, use the `/ph/ops/jobs/{id}` endpoint to get
+      the anomalies.
+
     **return:** A list of anomalies.
     """
+    stream = ndjson_media_type in request.headers.get('accept', '')
     anomalies = []
     job_name = rq.job.name
-    samples = prepare_all_samples(rq, local_jobs) if job_name == 'all' else prepare_samples(rq, local_jobs)
+    namespace = rq.namespace or production_namespace
+    if not _valid_namespace(namespace, response):
+        return anomalies
+    if background:
+        state, _ = job_manager.submit('detect', rq, job_manager.detect)
+        return JSONResponse(state, status_code=status.HTTP_202_ACCEPTED)
+    cache_key, end = None, None
+    if rq.data_source.name == 'logs':  # the responses for the same log interval are cached
+        start, end = getattr(rq.data, 'start', None), getattr(rq.data, 'end', None)
+        max_docs = rq.max_log_records or int(os.getenv('PH_max_docs', 500000))
+        cache_key = response_cache.make_key(job_name, namespace, start, end, max_docs,
+                                            _stream_chunking() if stream else None)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Detection with '{job_name}': {len(cached):,} anomalies from the response cache.")
+            return StreamingResponse(iter([_ndjson(cached)]), media_type=ndjson_media_type) if stream else cached
+    if stream:
+        chunks = await _run(_io_executor, _stream_chunks, rq)
+        first = await _run(_io_executor, next, chunks, None)
+        if first is not None:
+            return StreamingResponse(_stream_anomalies(job_name, chunks, namespace, first, cache_key, end),
+                                     media_type=ndjson_media_type)
+        msg = f"* NO detection with '{job_name}'. No samples - No detection :("
+        response.status_code = status.HTTP_404_NOT_FOUND
+        logger.info(msg)
+        return anomalies
+    samples = await _run(_io_executor, _prepare_samples, rq)
     if not samples:
         msg = f"* NO detection with '{job_name}'. No samples - No detection :("
         response.status_code = status.HTTP_404_NOT_FOUND
-    elif job_name == 'all':
-        anomalies = [model_processor.detect(job.name, samples[job.data_type]) for job in local_jobs]
-        anomalies = list(itertools.chain(*anomalies))  # flatten List[list] -> list
-        anomalies = model_processor.aggregate_byte_anomalies(anomalies)
-        msg = f'Stop Detection with all models. {len(anomalies):,} anomalies.'
-    elif job_name2data_type[job_name] not in samples:
+    elif job_name != 'all' and job_name2data_type[job_name] not in samples:
         msg = f"* NO detection with '{job_name}'. No samples - No training :("
         response.status_code = status.HTTP_404_NOT_FOUND
+    elif job_name == 'all':
+        anomalies = await _run(_cpu_executor, _detect_all, samples, namespace)
+        msg = f'Stop Detection with all models. {len(anomalies):,} anomalies.'
     else:
-        anomalies = model_processor.detect(job_name, samples[job_name2data_type[job_name]])
+        anomalies = await _run(_cpu_executor, model_processor.detect, job_name, samples[job_name2data_type[job_name]],
+                               namespace=namespace)
         msg = f"Stop Detection with '{job_name}' model with {len(samples[job_name2data_type[job_name]]):,} samples. {len(anomalies):,} anomalies."
     logger.info(msg)
     anomalies = format_alert_to_anomaly(anomalies)
+    if cache_key and response.status_code in (None, status.HTTP_200_OK):
+        response_cache.put(cache_key, anomalies, end)
     return anomalies
 
 
+def _labeled_samples(rq: CalibrationRq):
+    """Returns: (samples, labels) of the calibration request."""
+    if rq.data_source.name == 'test_dataset':
+        dataset = dataset_cache.load(rq.job.name)
+        return dataset.records, dataset.df['anomaly'].tolist()
+    records = rq.data.records if rq.data else []
+    return [{k: v for k, v in r.items() if k != 'anomaly'} for r in records], [r.get('anomaly', 0) for r in records]
+
+
+@app.post("/ph/ops/calibrate", tags=["Operations"])
+async def calibrate(rq: CalibrationRq, response: Response):
+    """
+    Calibrate the score threshold of the job model on the labeled samples.
+
+    The samples are scored once with the job model of the namespace, the precision, recall and F1 of all
+    candidate thresholds are calculated in one sweep over the sorted scores.
+
+    - **param rq:** A request. The labeled samples are the internal test dataset or the records of the request.
+
+    **return:** The precision/recall/F1 `curve`, the `best` threshold (the maximum F1) and if it `meets_tolerance`
+    (the F1 tolerance of the job), the metrics of the `current` threshold. With `apply`, the best threshold
+    that meets the tolerance is set as the job parameter (`applied`).
+    """
+    from . import calibration
+
+    job_name = rq.job.name
+    namespace = rq.namespace or production_namespace
+    if not _valid_namespace(namespace, response):
+        return f"* NO calibration of '{job_name}'. Wrong model namespace '{namespace}'."
+    if job_name == 'all' or rq.data_source.name == 'logs':
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return f"* NO calibration of '{job_name}'. It needs one job and the labeled samples, the logs are not labeled."
+    samples, labels = await _run(_io_executor, _labeled_samples, rq)
+    try:
+        result = await _run(_cpu_executor, calibration.calibrate, job_name, samples, labels, namespace, rq.points)
+    except ValueError as ex:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        logger.info(str(ex))
+        return f"* NO calibration of '{job_name}'. {ex}"
+    result['applied'] = bool(rq.apply and result['meets_tolerance'])
+    if result['applied']:
+        set_envvars(JobParams(job=job_name, params={result['param']: result['best']['threshold']}))
+        logger.info(f"Set {result['param']}={result['best']['threshold']} by the calibration.")
+    return result
+
+
+@app.post("/ph/ops/tune", tags=["Operations"], status_code=202)
+async def tune(rq: TuneRq, response: Response):
+    """
+    Search the job parameters on the labeled test dataset: a grid or a random search over the `space`.
+
+    Each trial trains the model with the trial parameters in a pool of processes and evaluates it with
+    the self-diagnostics F1. The finished trials are checkpointed, an interrupted search resumes.
+
+    - **param rq:** A request.
+
+    **return:** Returns status_code=202 `Accepted` and the job state. The `result` of the finished job is the table
+    of the trials ranked by the F1, with the fit and score times of each trial. Use the `/ph/ops/jobs/{id}` endpoint.
+    """
+    job_name = rq.job.name
+    if job_name not in dynamic_jobs:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return f"* NO tuning of '{job_name}'. Only a single trained job can be tuned."
+    unknown = set(rq.space or {}) - set(job_params[job_name])
+    if unknown:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return f"* NO tuning of '{job_name}'. The job has no {sorted(unknown)} params."
+    state, _ = job_manager.submit('tune', rq, job_manager.tune)
+    return state
+
+
 @app.get("/ph/ops/start_self_diagnostics", tags=["Operations"], status_code=202)
 async def start_self_diagnostics(background_tasks: BackgroundTasks):
     """
@@ -134,6 +405,8 @@ async def start_self_diagnostics(background_tasks: BackgroundTasks):
     The second cycle uses the Elasticsearch data. It verifies that performance hotspot detection works properly
     with the data from the Elasticsearch indexes.
 
+    Both cycles use their own model namespaces, so the self-diagnostics never replaces the production models.
+
     A result of the self-diagnostics is saved. Use the `get_self_diagnostics_result` endpoint
     to get this result.
 
@@ -143,7 +416,7 @@ async def start_self_diagnostics(background_tasks: BackgroundTasks):
     do not wait till the end of the operation.
    """
     id = str(uuid.uuid4())
-    background_tasks.add_task(self_diagnostics, lock=None, id=id)
+    background_tasks.add_task(self_diagnostics, lock=None, id=id, real_life_namespace=diagnostics_real_life_namespace)
     return id
 
 
@@ -168,8 +441,139 @@ async def get_self_diagnostics_result(id: str = '-1'):
     return read_id_json(op='self_diagnostics', id=id)
 
 
+@app.get("/ph/ops/jobs", tags=["Operations"])
+def get_jobs():
+    """
+    Returns the states of the train and detect jobs, the newest first, without the job results.
+    """
+    return job_manager.list_jobs()
+
+
+@app.get("/ph/ops/jobs/{id}", tags=["Operations"])
+def get_job(id: str, response: Response):
+    """
+    Returns the state of the job: `status` (queued, running, done, failed), the current `stage`, the timing
+    and the `result` of the finished job. The result of a detect job is a list of anomalies.
+    """
+    state = job_manager.get(id)
+    if state is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return f"No job '{id}'."
+    return state
+
+
+@app.get("/ph/ops/traces", tags=["Operations"])
+def get_traces(limit: Optional[int] = None):
+    """
+    Returns the last traces of the train and detection cycles, the newest first.
+
+    Each trace is a tree of spans (download, aggregation, training, detection, alerts, saving data)
+    with the span durations and the numbers of processed items.
+
+    - **param limit:** A maximum number of the returned traces. The `PH_traces_number` env variable value by default.
+    """
+    return instrumentation.read_traces(limit)
+
+
+@app.get("/ph/ops/profile", tags=["Operations"], response_class=PlainTextResponse)
+def profile(target: ProfileTargets, response: Response, seconds: int = Query(10, ge=1, le=600)):
+    """
+    Profile the service with a sampling profiler.
+
+    - **param target:** `api` samples the stacks of the API process for `seconds` seconds and returns them.
+      `detect` or `train` arms the profiling of the next scheduled cycle.
+    - **param seconds:** A duration of the profiling.
+
+    **return:** The collapsed stacks (flamegraph-ready) for the `api` target. For the `detect` and `train` targets
+    returns status_code=202 `Accepted`, use the `/ph/ops/profile/{target}/last` endpoint to get the result after
+    the cycle.
+    """
+    if target.name == 'api':
+        return profiler.profile(seconds)
+    profiler.arm(target.name, seconds)
+    response.status_code = status.HTTP_202_ACCEPTED
+    return f"Armed profiling of the next '{target.name}' cycle for {seconds} seconds."
+
+
+@app.get("/ph/ops/profile/{target}/last", tags=["Operations"], response_class=PlainTextResponse)
+def get_last_profile(target: ProfileTargets, response: Response):
+    """
+    Returns the collapsed stacks of the last profiled `detect` or `train` cycle.
+    """
+    collapsed = profiler.read_profile(target.name)
+    if collapsed is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return f"No profile of the '{target.name}' cycle yet."
+    return collapsed
+
+
 # endregion Operations:
 
+# region Results:
+
+
+def _results_page(response: Response, table, start, end, limit, cursor, **filter_values):
+    """A page of the result_store table, status_code=400 for a wrong cursor."""
+    try:
+        return result_store.page(table, start, end, limit, cursor, **filter_values)
+    except ValueError as ex:
+        logger.error(str(ex))
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return str(ex)
+
+
+@app.get("/ph/results/history", tags=["Results"])
+def get_history(response: Response, op: str = 'self_diagnostics', job: Optional[str] = None,
+                start: Optional[datetime] = None, end: Optional[datetime] = None,
+                limit: int = Query(100, ge=1, le=result_store.max_page_size), cursor: Optional[str] = None):
+    """
+    Returns a page of the operation results history (the self-diagnostics results), the newest first.
+
+    - **param start, end:** A time interval of the results.
+    - **param cursor:** The `cursor` of the previous page. The last page has no cursor. A wrong cursor returns
+      status_code=400.
+
+    **return:** `{"items": [...], "cursor": ...}`
+    """
+    return _results_page(response, 'history', start, end, limit, cursor, op=op, job=job)
+
+
+@app.get("/ph/results/cycles", tags=["Results"])
+def get_cycles(response: Response, namespace: Optional[str] = None, start: Optional[datetime] = None,
+               end: Optional[datetime] = None, limit: int = Query(100, ge=1, le=result_store.max_page_size),
+               cursor: Optional[str] = None):
+    """
+    Returns a page of the detection cycle summaries, the newest first: the number of anomalies, the duration,
+    the failed and truncated indices of each cycle.
+
+    - **param namespace:** A model namespace of the cycles.
+    - **param cursor:** The `cursor` of the previous page.
+    """
+    return _results_page(response, 'cycles', start, end, limit, cursor, namespace=namespace)
+
+
+@app.get("/ph/results/anomalies", tags=["Results"])
+def get_detected_anomalies(response: Response, job: Optional[JobNames] = None, model_namespace: Optional[str] = None,
+                           namespace: Optional[str] = None, service: Optional[str] = None,
+                           cycle_id: Optional[int] = None, start: Optional[datetime] = None,
+                           end: Optional[datetime] = None,
+                           limit: int = Query(100, ge=1, le=result_store.max_page_size), cursor: Optional[str] = None):
+    """
+    Returns a page of the anomalies detected by the detection cycles, the newest first.
+
+    - **param job:** A job name.
+    - **param model_namespace:** A model namespace of the detection cycles.
+    - **param namespace, service:** The namespace and service of the anomaly record.
+    - **param cycle_id:** The anomalies of the detection cycle.
+    - **param start, end:** A time interval of the anomaly records.
+    - **param cursor:** The `cursor` of the previous page.
+    """
+    return _results_page(response, 'anomalies', start, end, limit, cursor, job=job.name if job else None,
+                         model_namespace=model_namespace, namespace=namespace, service=service, cycle_id=cycle_id)
+
+
+# endregion Results:
+
 # region Configuration:
 
 
@@ -1,6 +1,6 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Dict
 
 from pydantic import BaseModel, Field
 
@@ -9,6 +9,8 @@ from ph.globals import jobs, logs
 JobNames = Enum('JobNames', [(j.name, j.name) for j in jobs()] + [('all', 'all')])
 LogNames = Enum('LogNames', [(log, log) for log in logs])
 DataSources = Enum('DataSources', [(d, d) for d in ['request', 'logs', 'test_dataset']])
+ProfileTargets = Enum('ProfileTargets', [(t, t) for t in ['detect', 'train', 'api']])
+SearchModes = Enum('SearchModes', [(m, m) for m in ['grid', 'random']])
 
 
 class DtInterval(BaseModel):
@@ -63,6 +65,11 @@ class OperationDataRq(BaseModel):
         None,
         title='A maximum number of the log records used for training or detection.',
         description='If the field missed, the `PH_max_docs` env variable value used instead.')
+    namespace: Optional[str] = Field(
+        None,
+        title='A model namespace used for training or detection.',
+        description='If the field missed, the `production` models used. Models of other namespaces are kept '
+                    'separately, so training in such namespace never replaces the production models.')
 
     class Config:
         schema_extra = {
@@ -91,3 +98,57 @@ class JobParams(BaseModel):
     """
     job: JobNames
     params: dict
+
+
+class CalibrationRq(BaseModel):
+    """A request for the calibration of the job score threshold on the labeled samples."""
+    job: JobNames = Field(
+        ...,
+        title='A name of the performance hotspot detector.',
+        description='The job model must have a score threshold parameter. `all` is not permitted.')
+    data_source: DataSources = Field(
+        DataSources.test_dataset,
+        title='A source of the labeled samples.',
+        description='`test_dataset` - the internal **[job].test_dataset.csv** file with the `anomaly` labels. '
+                    '`request` - the log records in the "data" field of this request, the `anomaly` field of '
+                    'a record is its label (1 - anomaly, 0 or missed - normal). '
+                    '`logs` are not labeled, they cannot be used.')
+    data: Optional[LogData] = Field(
+        None,
+        title='The labeled log records for the `request` data_source.')
+    namespace: Optional[str] = Field(
+        None,
+        title='A model namespace of the scoring model.',
+        description='If the field missed, the `production` model used.')
+    points: int = Field(
+        100,
+        title='A maximum number of the points of the returned precision/recall/F1 curve.')
+    apply: bool = Field(
+        False,
+        title='Set the best threshold as the job parameter if it meets the job tolerance.',
+        description='As with the `/ph/conf/set_parameters`, the change does not survive the pod restarts.')
+
+
+class TuneRq(BaseModel):
+    """A request for the hyperparameter search of the job on its labeled test dataset."""
+    job: JobNames = Field(
+        ...,
+        title='A name of the performance hotspot detector.',
+        description='`all` is not permitted.')
+    space: Optional[Dict[str, List[Union[int, float]]]] = Field(
+        None,
+        title='The search space: {job param: [candidate values]}.',
+        description='If the field missed, a few values around the defaults of the job params are used.')
+    mode: SearchModes = Field(
+        SearchModes.grid,
+        title='`grid` tries all combinations of the values, `random` tries `trials` random combinations.')
+    trials: int = Field(
+        20,
+        title='A number of the trials of the `random` mode.')
+    workers: Optional[int] = Field(
+        None,
+        title='A number of the processes running the trials.',
+        description='If the field missed, the `PH_tune_workers` env variable value used instead.')
+    seed: int = Field(
+        0,
+        title='A seed of the `random` mode.')
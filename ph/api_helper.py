@@ -1,11 +1,10 @@
 import os
 import logging
 
-import pandas as pd
-
 from ph import elastic_api
+from ph import dataset_cache
 from ph.api_classes import OperationDataRq, JobParams
-from ph.globals import data_dir, APP_NAME
+from ph.globals import APP_NAME
 
 logger = logging.getLogger(APP_NAME)
 
@@ -24,10 +23,9 @@ def prepare_samples(rq: OperationDataRq, local_jobs):
     source_log = [j.source_log for j in local_jobs if j.name == job_name][0]  # we assume the list always has one element
     data_type2samples = {}
     if rq.data_source.name == 'test_dataset':
-        file_name = f'{data_dir}/{job_name}.test_dataset.csv'
+        file_name = dataset_cache.file_name(job_name)
         assert os.path.exists(file_name)
-        data_type2samples[data_type] = pd.read_csv(file_name, usecols=lambda col: col != 'anomaly',
-                                                   low_memory=False).to_dict('records')[:max_docs]
+        data_type2samples[data_type] = dataset_cache.records(job_name)[:max_docs]
         logger.info(
             f'Loaded "{job_name}" data {len(data_type2samples[data_type]):,} from "{file_name}" for "{data_type}" data_type')
     elif rq.data_source.name == 'logs':
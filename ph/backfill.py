@@ -0,0 +1,210 @@
+import os
+import json
+import hashlib
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+import logging
+
+from .globals import APP_NAME, data_dir, jobs, logs, production_namespace
+from . import metrics
+from . import instrumentation
+from .log_cache import to_epoch, to_datetime
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+The backfill mode: the detection over a historical time range, say, after an outage or to tune the thresholds.
+  > python -m ph backfill --start "2021-01-15 00:00:00" --end "2021-01-22 00:00:00"
+The range is split into chunks. The download+detection of the chunks runs in a process pool with bounded
+concurrency, at most `workers` chunks are in flight. The models are not retrained, the backfill uses the models
+of the namespace.
+The progress is checkpointed in the checkpoint_dir after every chunk, so an interrupted backfill resumes from the
+not finished chunks when it is started again with the same start and chunk size. The run is keyed on them, not on
+the end, so a run with the default end (the last chunk boundary before now) resumes too and its range grows.
+The alerts are deduplicated and written in bulk. The alert id is the hash of the alert record, so the alerts
+written before an interruption are not written again. The sent alerts are saved with their ids in the
+append-only `<run>.alerts.jsonl` file, the ids are read from it on the resume.
+The backfill does not move the last timestamp of the scheduled detection.
+"""
+
+Params = namedtuple('Params', 'PH_backfill_chunk_minutes PH_backfill_workers PH_backfill_bulk_size')
+params = Params(
+    int(os.getenv('PH_backfill_chunk_minutes', 60)),
+    int(os.getenv('PH_backfill_workers', min(4, os.cpu_count() or 1))),
+    int(os.getenv('PH_backfill_bulk_size', 500)),
+)
+
+checkpoint_dir = f'{data_dir}/backfill'
+
+
+def chunks(start, end, chunk_minutes):
+    """[start, end) epoch seconds -> a list of [chunk_start, chunk_end) intervals."""
+    step = chunk_minutes * 60
+    return [(s, min(s + step, end)) for s in range(int(start), int(end), step)]
+
+
+def alert_id(alert):
+    """The hash of the alert name and the record. The alert 'time' is the time of the detection, it is not used."""
+    key = json.dumps([alert.get('alert'), alert.get('record')], sort_keys=True, default=str)
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def _run_name(start, chunk_minutes):
+    return f'{to_datetime(start):%Y%m%dT%H%M%S}_{chunk_minutes}m'
+
+
+def default_end(start, chunk_minutes, now=None):
+    """
+    The last chunk boundary before now, so the resumed run does not detect a partial chunk again.
+    now if the range is shorter than a chunk.
+    """
+    step = chunk_minutes * 60
+    now = to_epoch(now or datetime.utcnow())
+    boundary = start + int(now - start) // step * step
+    return to_datetime(boundary if boundary > start else int(now))
+
+
+def _load_checkpoint(file_name):
+    if not os.path.isfile(file_name):
+        return {'done': {}}
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def _load_alert_ids(file_name):
+    if not os.path.isfile(file_name):
+        return set()
+    with open(file_name) as f:
+        return {json.loads(line)['id'] for line in f if line.strip()}
+
+
+def _save_checkpoint(file_name, checkpoint):
+    with open(f'{file_name}.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(f'{file_name}.tmp', file_name)
+
+
+def detect_chunk(start, end, max_docs, namespace=production_namespace):
+    """
+    Downloads the data of the [start, end) chunk (epoch seconds) and detects anomalies in it.
+    It runs in a process of the pool. An exception of a job fails the chunk.
+    Returns: (alerts, truncated_indices)
+    """
+    from . import model_processor, elastic_api
+
+    try:
+        with instrumentation.trace(f'backfill {to_datetime(start)} - {to_datetime(end)} ({namespace})'):
+            data = elastic_api.ElasticClient().download_and_aggregate_data(to_datetime(start), to_datetime(end),
+                                                                           max_docs=max_docs)
+            anomalies = []
+            for job in jobs():
+                if data.get(job.data_type):
+                    anomalies += model_processor.detect(job.name, data[job.data_type], namespace=namespace,
+                                                        raise_errors=True)
+            anomalies = model_processor.aggregate_byte_anomalies(anomalies)
+        return anomalies, [i for i in logs if len(data.get(i, [])) >= max_docs]
+    finally:
+        metrics.record_cycle('backfill')
+
+
+def run(start_time, end_time, chunk_minutes=params.PH_backfill_chunk_minutes, workers=params.PH_backfill_workers,
+        send_alerts=True, namespace=production_namespace, restart=False, max_docs=None):
+    """
+    Runs the backfill detection over the [start_time, end_time) range.
+    restart: ignore the checkpoint and process all chunks again. The already written alerts are not written again,
+    the ES skips the alerts with the ids of the written ones.
+    A chunk is done if its detection and the sending of its alerts succeeded. A done chunk that ended before the
+    end_time (the last chunk of a shorter run) is processed again.
+    Returns: the checkpoint: {'done': {chunk_start: {'end', 'alerts', 'sent', 'truncated'}}, 'alerts', 'failed'}
+    """
+    from .model_processor import params as detection_params
+
+    max_docs = max_docs or detection_params.PH_max_docs
+    start, end = to_epoch(start_time), to_epoch(end_time)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    run_name = _run_name(start, chunk_minutes)
+    checkpoint_file = f'{checkpoint_dir}/{run_name}.json'
+    alerts_file = f'{checkpoint_dir}/{run_name}.alerts.jsonl'
+    checkpoint = {'done': {}} if restart else _load_checkpoint(checkpoint_file)
+    if restart and os.path.exists(alerts_file):
+        os.remove(alerts_file)
+    checkpoint.update({'start': to_datetime(start).isoformat(), 'end': to_datetime(end).isoformat(),
+                       'chunk_minutes': chunk_minutes, 'namespace': namespace, 'failed': []})
+    done_ends = {int(s): c['end'] for s, c in checkpoint['done'].items()}
+    todo = [c for c in chunks(start, end, chunk_minutes) if done_ends.get(c[0], 0) < c[1]]
+    logger.info(f'Backfill "{run_name}": {len(todo):,} chunks to process, {len(checkpoint["done"]):,} done before, '
+                f'{workers} workers.')
+    alert_ids = _load_alert_ids(alerts_file)
+    alert_client = None
+    if send_alerts:
+        from . import alert_api
+        alert_client = alert_api.AlertClient()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        while todo or in_flight:
+            while todo and len(in_flight) < workers:
+                chunk = todo.pop(0)
+                in_flight[executor.submit(detect_chunk, *chunk, max_docs, namespace)] = chunk
+            completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in completed:
+                chunk_start, chunk_end = in_flight.pop(future)
+                try:
+                    alerts, truncated = future.result()
+                except Exception as ex:
+                    logger.error(f'*** Backfill chunk [{to_datetime(chunk_start)}, {to_datetime(chunk_end)}) '
+                                 f'failed: "{ex}". It is processed again on the next backfill run.')
+                    checkpoint['failed'].append(chunk_start)
+                    continue
+                if truncated:
+                    logger.warning(f'The chunk [{to_datetime(chunk_start)}, {to_datetime(chunk_end)}) downloads of '
+                                   f'{truncated} are truncated by the max_docs {max_docs:,}. Use smaller chunks.')
+                ids = [alert_id(a) for a in alerts]
+                new = {i: a for i, a in zip(ids, alerts) if i not in alert_ids}  # dedup inside and across chunks
+                sent = 0
+                if new:
+                    if alert_client:
+                        try:
+                            sent, _ = alert_client.send_alerts_in_bulk(list(new.values()), list(new),
+                                                                       params.PH_backfill_bulk_size)
+                        except Exception as ex:
+                            logger.error(f'*** Backfill chunk [{to_datetime(chunk_start)}, {to_datetime(chunk_end)}) '
+                                         f'alerts are not sent: "{ex}". It is processed again on the next run.')
+                            checkpoint['failed'].append(chunk_start)
+                            continue
+                    with open(alerts_file, 'a') as f:
+                        f.writelines(json.dumps({'id': i, 'alert': a}, default=str) + '\n' for i, a in new.items())
+                alert_ids.update(new)
+                checkpoint['alerts'] = len(alert_ids)
+                checkpoint['done'][str(chunk_start)] = {'end': chunk_end, 'alerts': len(new), 'sent': sent,
+                                                        'truncated': truncated}
+                _save_checkpoint(checkpoint_file, checkpoint)
+                logger.info(f'Backfill chunk [{to_datetime(chunk_start)}, {to_datetime(chunk_end)}): '
+                            f'{len(alerts):,} alerts, {len(new):,} new, {sent:,} sent. '
+                            f'{len(checkpoint["done"]):,} chunks done.')
+    checkpoint['alerts'] = len(alert_ids)
+    _save_checkpoint(checkpoint_file, checkpoint)
+    logger.info(f'Backfill "{run_name}" finished: {len(checkpoint["done"]):,} chunks done, '
+                f'{len(checkpoint["failed"]):,} failed, {len(alert_ids):,} alerts.')
+    return checkpoint
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ph backfill',
+                                     description='Detects anomalies over a historical time range.')
+    parser.add_argument('--start', required=True, help='The range start (UTC), "YYYY-mm-dd HH:MM:SS".')
+    parser.add_argument('--end', default=None,
+                        help='The range end (UTC), "YYYY-mm-dd HH:MM:SS". Default: the last chunk boundary before now.')
+    parser.add_argument('--chunk-minutes', type=int, default=params.PH_backfill_chunk_minutes)
+    parser.add_argument('--workers', type=int, default=params.PH_backfill_workers)
+    parser.add_argument('--namespace', default=production_namespace, help='The model namespace.')
+    parser.add_argument('--no-alerts', action='store_true', help='Do not send the alerts, only save them.')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of the previous run.')
+    args = parser.parse_args(argv)
+
+    end = args.end or default_end(to_epoch(args.start), args.chunk_minutes)
+    checkpoint = run(args.start, end, args.chunk_minutes,
+                     args.workers, send_alerts=not args.no_alerts, namespace=args.namespace, restart=args.restart)
+    return 1 if checkpoint['failed'] else 0
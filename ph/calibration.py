@@ -0,0 +1,90 @@
+import logging
+
+import numpy as np
+
+from .globals import APP_NAME, job_name2job, get_param, production_namespace
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+The calibration of the score threshold of a job model on the labeled samples.
+The samples are scored once. A sample is an anomaly if its score < threshold, so after sorting the scores in
+the ascending order every candidate threshold predicts a prefix of the sorted samples as the anomalies, and
+the cumulative sum of the labels gives the TP of all candidates at once: O(n log n) for the whole
+precision/recall/F1 curve.
+The candidate thresholds are the midpoints between the neighbouring distinct scores (and a value above the maximum
+score). The best threshold has the maximum F1, it meets the job tolerance if this F1 >= Job.tolerance
+(the tolerance of the self-diagnostics).
+The F1 is counted by the samples, the self-diagnostics counts it by the unique anomaly keys.
+"""
+
+
+def sweep(scores, labels):
+    """
+    Returns: the arrays of (the candidate thresholds, precision, recall, F1).
+    scores: the anomaly scores, the lower the more anomalous. labels: 1 for the anomaly, 0 for the normal sample.
+    """
+    scores, labels = np.asarray(scores, dtype=float), np.asarray(labels) != 0
+    order = np.argsort(scores, kind='stable')
+    scores, labels = scores[order], labels[order]
+    tp = np.cumsum(labels)
+    fp = np.arange(1, len(labels) + 1) - tp
+    last = np.append(scores[1:] != scores[:-1], True)  # the last sample of the distinct score
+    scores, tp, fp = scores[last], tp[last], fp[last]
+    thresholds = np.append((scores[:-1] + scores[1:]) / 2, scores[-1] + max(1e-9, abs(scores[-1]) * 1e-9))
+    return (thresholds,) + _metrics(tp, fp, labels.sum())
+
+
+def _metrics(tp, fp, positives):
+    """(precision, recall, F1), 0 without the TP."""
+    return tp / np.maximum(1, tp + fp), tp / max(1, positives), 2 * tp / np.maximum(1, tp + fp + positives)
+
+
+def _point(threshold, precision, recall, f1):
+    return {'threshold': float(threshold), 'precision': round(float(precision), 3),
+            'recall': round(float(recall), 3), 'F1': round(float(f1), 3)}
+
+
+def calibrate(job_name, samples, labels, namespace=production_namespace, points=100):
+    """
+    Scores the labeled samples with the job model of the namespace and sweeps the thresholds.
+    Returns: {'job', 'param', 'tolerance', 'samples', 'anomalies', 'best': point, 'meets_tolerance',
+              'current': the point of the current threshold, 'curve': at most `points` points + the best point}
+    The point: {'threshold', 'precision', 'recall', 'F1'}
+    Raises: ValueError if the job has no score threshold or no model.
+    """
+    from .model_processor import ModelProcessor, _load_model
+
+    model_cls = ModelProcessor.str2class(job_name)()
+    if not hasattr(model_cls, 'score'):
+        raise ValueError(f"The '{job_name}' model has no score threshold to calibrate.")
+    model, _ = _load_model(job_name, namespace)
+    if not model:
+        raise ValueError(f"No '{job_name}' model in the '{namespace}' namespace. Train it first.")
+    if not samples:
+        raise ValueError(f"No samples to calibrate the '{job_name}' model.")
+    scores = model_cls.score(model, samples)
+    thresholds, precision, recall, f1 = sweep(scores, labels)
+
+    best = int(np.argmax(f1))
+    current_threshold = get_param(job_name, model_cls.threshold_param, param_type=float)
+    labels = np.asarray(labels) != 0
+    predicted = np.asarray(scores) < current_threshold
+    current_point = _point(current_threshold, *_metrics(np.sum(predicted & labels), np.sum(predicted & ~labels),
+                                                        labels.sum()))
+    selected = sorted(set(np.linspace(0, len(thresholds) - 1, min(points, len(thresholds))).astype(int)) | {best})
+    tolerance = job_name2job[job_name].tolerance
+    result = {
+        'job': job_name,
+        'param': model_cls.threshold_param,
+        'tolerance': tolerance,
+        'samples': len(samples),
+        'anomalies': int(labels.sum()),
+        'best': _point(thresholds[best], precision[best], recall[best], f1[best]),
+        'meets_tolerance': bool(f1[best] >= tolerance),
+        'current': current_point,
+        'curve': [_point(thresholds[i], precision[i], recall[i], f1[i]) for i in selected],
+    }
+    logger.info(f"Calibrated '{job_name}' on {len(samples):,} samples: the best {result['best']}, "
+                f"the current {result['current']}.")
+    return result
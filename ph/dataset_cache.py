@@ -0,0 +1,125 @@
+import os
+import pickle
+import threading
+from collections import namedtuple
+import logging
+
+from .globals import APP_NAME, data_dir, job_name2job
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+A process-wide cache of the parsed `<job>.test_dataset.csv` test datasets.
+The self-diagnostics train and detection, its report and the API `test_dataset` requests use the same datasets.
+A dataset is parsed once per process into:
+  - the DataFrame (the columnar form) with the 'anomaly' labels,
+  - the records without the 'anomaly' column, the samples of the models,
+  - the labeled anomalies: a DataFrame of the records with the 'anomaly' label and their 'key' column, the values
+    of the job group_fields joined with '^' (see label_keys).
+The cache entry is invalidated when the modification time or the size of the CSV file is changed.
+The parsed DataFrame is also persisted as a pickle next to the CSV file (PH_dataset_cache_persist), so the other
+processes (the scheduler cycles, the API job workers) do not parse the CSV again.
+The records are shared, the callers must not change them.
+"""
+
+Params = namedtuple('Params', 'PH_dataset_cache_persist')
+params = Params(
+    eval(os.getenv('PH_dataset_cache_persist', 'True')),
+)
+
+Dataset = namedtuple('Dataset', 'df records labeled')
+
+_datasets = {}  # {job_name: (the CSV file version, Dataset)}
+_datasets_lock = threading.Lock()
+
+
+def file_name(job_name):
+    return f'{data_dir}/{job_name}.test_dataset.csv'
+
+
+def _persisted_file_name(job_name):
+    return f'{data_dir}/{job_name}.test_dataset.pkl'
+
+
+def _version(job_name):
+    stat = os.stat(file_name(job_name))
+    return stat.st_mtime_ns, stat.st_size
+
+
+def label_keys(df, group_fields):
+    """The anomaly keys of the records: the values of the group_fields (presented in the df) joined with '^'."""
+    import pandas as pd
+
+    fields = [f for f in group_fields if f in df]
+    if df.empty or not fields:
+        return pd.Series('', index=df.index, dtype=object)
+    keys = df[fields[0]].astype(str)
+    for field in fields[1:]:
+        keys = keys + '^' + df[field].astype(str)
+    return keys
+
+
+def _read(job_name, version):
+    """Reads the persisted DataFrame of the CSV file version or parses the CSV file."""
+    import pandas as pd
+
+    persisted = _persisted_file_name(job_name)
+    if params.PH_dataset_cache_persist and os.path.isfile(persisted):
+        try:
+            with open(persisted, 'rb') as f:
+                persisted_version, df = pickle.load(f)
+            if tuple(persisted_version) == version:
+                return df
+        except Exception as ex:
+            logger.warning(f'  *** Exception: "{str(ex)}". Cannot read "{persisted}", the CSV is parsed.')
+    df = pd.read_csv(file_name(job_name), low_memory=False)
+    if params.PH_dataset_cache_persist:
+        try:
+            with open(f'{persisted}.tmp', 'wb') as f:
+                pickle.dump((version, df), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f'{persisted}.tmp', persisted)
+        except OSError as ex:
+            logger.warning(f'  *** Exception: "{str(ex)}". The parsed "{file_name(job_name)}" is not persisted.')
+    return df
+
+
+def _labeled(job_name, df):
+    import pandas as pd
+
+    job = job_name2job[job_name]
+    df = df[df['anomaly'] != 0].drop(columns='anomaly')
+    if job_name in ['port_scan', 'ip_sweep']:
+        # these jobs keep the 'start_time' in different format, so we transform it to default format.
+        df = df.assign(start_time=df['start_time'].apply(
+            lambda t: int(pd.to_datetime(t).timestamp()) if type(t) == str and t.count(':') else t))
+    return df.assign(key=label_keys(df, job.group_fields))
+
+
+def make_dataset(job_name, df):
+    """The Dataset of the job test dataset DataFrame."""
+    return Dataset(df, df.drop(columns='anomaly', errors='ignore').to_dict('records'),
+                   _labeled(job_name, df) if 'anomaly' in df else df.iloc[:0].assign(key=''))
+
+
+def load(job_name):
+    """Returns the Dataset of the job test dataset, it is parsed once per the CSV file version."""
+    version = _version(job_name)
+    with _datasets_lock:
+        cached = _datasets.get(job_name)
+        if cached and cached[0] == version:
+            return cached[1]
+        dataset = make_dataset(job_name, _read(job_name, version))
+        _datasets[job_name] = (version, dataset)
+        logger.info(f'Loaded "{file_name(job_name)}": {len(dataset.records):,} records, '
+                    f'{len(dataset.labeled):,} labeled anomalies.')
+        return dataset
+
+
+def records(job_name):
+    """The samples of the job test dataset without the 'anomaly' column. The list is a copy, the records are not."""
+    return list(load(job_name).records)
+
+
+def clear():
+    with _datasets_lock:
+        _datasets.clear()
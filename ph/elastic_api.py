@@ -1,16 +1,17 @@
 # import json
 import uuid
 import os
+import time
 from operator import itemgetter
 
-from elasticsearch import Elasticsearch
 from ssl import create_default_context
-import pandas as pd
 from datetime import datetime
 from collections import namedtuple
 
 import logging
 from .globals import APP_NAME
+from . import metrics
+from .instrumentation import traced
 
 logger = logging.getLogger(APP_NAME)
 logging.getLogger('elasticsearch').setLevel(logging.CRITICAL)
@@ -227,6 +228,7 @@ def _additional_aggregation(aggregated_source_samples, aggregated_dest_samples):
     return source_out, dest_out
 
 
+@traced(count='docs')
 def _aggregate_data(docs, bucket_size_minutes):
     if not docs: return [], []
     aggregated_source_samples, aggregated_dest_samples = [], []
@@ -265,6 +267,34 @@ def aggregate_samples(docs):
     return {'source': source_docs, 'dest': dest_docs}
 
 
+def _range_query(start_time, end_time, sort_by_time=False):
+    """The query of the documents within [start_time, end_time) interval, a missed bound is open."""
+    def format_dt(dt):
+        t = datetime.strptime(dt, '%Y-%m-%d %H:%M:%S') if type(dt) == str else dt
+        return t.isoformat()  # requirement for Elasticsearch ?
+
+    query = {"size": params.query_size}
+    if not any([start_time, end_time]):
+        query['query'] = {"match_all": {}}
+    else:
+        query['query'] = {'range': {"@timestamp": {}}}
+        if start_time:
+            query['query']['range']["@timestamp"]["gte"] = format_dt(start_time)
+        if end_time:
+            query['query']['range']["@timestamp"]["lt"] = format_dt(end_time)
+    if sort_by_time:
+        query['sort'] = [{'@timestamp': 'asc'}]
+    return query
+
+
+class AlertsNotWritten(Exception):
+    """Some alerts of the bulk are not written. failed_ids: the ids of the not written alerts."""
+
+    def __init__(self, message, failed_ids):
+        super().__init__(message)
+        self.failed_ids = failed_ids
+
+
 class ElasticClient:
     def __init__(self):
         logger.info('Initialized ElasticClient with params: ' + ', '.join(
@@ -273,43 +303,69 @@ class ElasticClient:
         context = create_default_context(cafile=params.cafile) if using_ssl else None
         host = "https://" + params.host if using_ssl else "http://" + params.host
 
+        from elasticsearch import Elasticsearch
         self.es = Elasticsearch(host, http_auth=params.http_auth, ssl_context=context, verify_certs=using_ssl)
 
     def write_alert(self, alert):
         return self.es.create(index=params.indices['events'], id=str(uuid.uuid4()), body=alert, doc_type="_doc")
 
-    def download_and_aggregate_data(self, start_time, end_time, max_docs=500000, index_name=None):
+    def write_alerts(self, alerts, ids=None, chunk_size=500):
+        """
+        Writes the alerts with the bulk API, chunk_size alerts per request.
+        ids: the alert ids. An alert with the id of an already written alert is not written again, it is counted as
+        a duplicate. Without the ids, the random ids are used.
+        Raises AlertsNotWritten with the ids of the not written alerts, the other alerts are written.
+        Returns: (written, duplicates)
+        """
+        from elasticsearch import helpers
+        ids = ids or [str(uuid.uuid4()) for _ in alerts]
+        actions = ({'_op_type': 'create', '_index': params.indices['events'], '_id': alert_id, '_source': alert}
+                   for alert, alert_id in zip(alerts, ids))
+        written, errors = helpers.bulk(self.es, actions, chunk_size=chunk_size, raise_on_error=False)
+        duplicates = sum(1 for e in errors if e.get('create', {}).get('status') == 409)
+        failed = [e for e in errors if e.get('create', {}).get('status') != 409]
+        if failed:
+            raise AlertsNotWritten(f'*** Failed to write {len(failed):,} of {len(alerts):,} alerts. '
+                                   f'The first error: {failed[0]}', [e.get('create', {}).get('_id') for e in failed])
+        return written, duplicates
+
+    def iter_pages(self, index_name, start_time, end_time, max_docs=500000):
+        """
+        Downloads the ES data of one index within [start_time, end_time) interval page by page, without the
+        aggregation. Yields the documents of each page as soon as it is downloaded (used by the streamed detection).
+        """
+        logger.info(f'Start downloading "{index_name}" ES data in pages: start_time: {start_time} - '
+                    f'end_time: {end_time}, max_docs: {max_docs}')
+        resp = self._search(params.indices[index_name], _range_query(start_time, end_time), filter_paths[index_name])
+        if resp is not None:
+            yield from self._scroll(resp, filter_paths[index_name], max_docs)
+
+    @traced('download_and_aggregate_data', count=lambda data_type2docs: sum(len(v) for v in data_type2docs.values()))
+    def download_and_aggregate_data(self, start_time, end_time, max_docs=500000, index_name=None,
+                                    with_timestamp=False, sort_by_time=False):
         """
         Downloads the ES data from one index in pages with params.query_size size and
         within [start_time, end_time] interval.
         If index_name==None, download all indexes!
+        If with_timestamp==True, the documents keep the '@timestamp' field (used by the log_cache).
+        If sort_by_time==True, the documents are downloaded in the '@timestamp' order, so the download truncated by
+        the max_docs has all documents before its last document (used by the detection watermarks).
         Returns: {'flows': all_flow_docs, 'source': all_source_aggr, 'dest': all_dest_aggr,
         'l7': all_l7_docs, 'dns': all_dns_docs}
         """
-        def format_dt(dt):
-            t = datetime.strptime(dt, '%Y-%m-%d %H:%M:%S') if type(dt) == str else dt
-            return t.isoformat()  # requirement for Elasticsearch ?
-
-        query = {"size": params.query_size}
-        if not any([start_time, end_time]):
-            query['query'] = {"match_all": {}}
-        else:
-            query['query'] = {'range': {"@timestamp": {}}}
-            if start_time:
-                query['query']['range']["@timestamp"]["gte"] = format_dt(start_time)
-            if end_time:
-                query['query']['range']["@timestamp"]["lt"] = format_dt(end_time)
+        query = _range_query(start_time, end_time, sort_by_time)
         logger.info(f'Start downloading ES data: start_time: {start_time} - end_time: {end_time}, max_docs: {max_docs}')
         data_indices = {k: v for k, v in params.indices.items() if k != 'events'}
         if index_name:
             data_indices = {k: v for k, v in params.indices.items() if k == index_name}
         data_type2docs = {}
         for index_name, index in data_indices.items():
-            index_data_dict = self._download_and_aggregate_index(index_name, index, query, max_docs=max_docs)
+            index_data_dict = self._download_and_aggregate_index(index_name, index, query, max_docs=max_docs,
+                                                                 with_timestamp=with_timestamp)
             data_type2docs = {**data_type2docs, **index_data_dict}
         return data_type2docs
 
-    def _download_and_aggregate_index(self, index_name, index, query, max_docs):
+    def _download_and_aggregate_index(self, index_name, index, query, max_docs, with_timestamp=False):
         """
         Downloads the ES data from one index in pages.
         The 'flow' index data immediately aggregated by 'source' and 'dest' groups in the time buckets.
@@ -320,54 +376,38 @@ class ElasticClient:
         Returns: {'<index_name>': index_records}
           for 'flows' index : {'flows': flow_records, 'source': source_aggr_records, 'dest': dest_aggr_records}
         """
-        scroll_id = '_scroll_id'
-        resp = self.es.search(
-            index=index,
-            body=query,
-            filter_path=filter_paths[index_name],
-            scroll=params.scroll_time  # length of time to keep search context
-        )
-        if not resp or scroll_id not in resp: # empty index!
-            logger.info(f'Index "{index}" empty.')
+        filter_path = filter_paths[index_name] + (['hits.hits._source.@timestamp'] if with_timestamp else [])
+        start = time.perf_counter()
+        aggregation_secs = 0.0
+        resp = self._search(index, query, filter_path)
+        if resp is None:
             return {}
-        old_scroll_id = resp[scroll_id]
 
         all_docs = []
         all_source_docs, all_dest_docs = [], []
-        first_resp = True
-        while (
-                'hits' in resp
-                and 'hits' in resp['hits']
-                and resp['hits']['hits']
-                and len(all_docs) < max_docs
-        ):
-            if not first_resp:
-                resp = self.es.scroll(
-                    scroll_id=old_scroll_id,
-                    filter_path=filter_paths[index_name],
-                    scroll=params.scroll_time  # length of time to keep search context
-                )
-            first_resp = False
-            if old_scroll_id != resp[scroll_id]:
-                logger.error("*** NEW SCROLL ID:", resp[scroll_id])
-            old_scroll_id = resp[scroll_id]
-
-            if 'hits' in resp and 'hits' in resp['hits']:
-                docs = [el['_source'] for el in resp['hits']['hits']]
-                all_docs += docs
-                logger.info(f'  Downloaded {len(docs):,} -> {len(all_docs):,} "{index_name}" samples from the "{index}" index.')
-                if index_name == 'flows':
-                    source_docs, dest_docs = _aggregate_data(docs,  params.bucket_size_minutes)
-                    all_source_docs += source_docs
-                    all_dest_docs += dest_docs
-                    logger.info(
-                        f'    Aggregated data:: source: {len(source_docs):,} -> {len(all_source_docs):,}, '
-                        f'dest: {len(dest_docs):,} -> {len(all_dest_docs):,}.')
+        for docs in self._scroll(resp, filter_path, max_docs):
+            all_docs += docs
+            logger.info(f'  Downloaded {len(docs):,} -> {len(all_docs):,} "{index_name}" samples from the "{index}" index.')
+            if index_name == 'flows':
+                aggregation_start = time.perf_counter()
+                source_docs, dest_docs = _aggregate_data(docs,  params.bucket_size_minutes)
+                aggregation_secs += time.perf_counter() - aggregation_start
+                all_source_docs += source_docs
+                all_dest_docs += dest_docs
+                logger.info(
+                    f'    Aggregated data:: source: {len(source_docs):,} -> {len(all_source_docs):,}, '
+                    f'dest: {len(dest_docs):,} -> {len(all_dest_docs):,}.')
 
         logger.info(f'Downloaded {len(all_docs):,} "{index_name}" samples from the "{index}" index.')
         data_type2docs = {index_name: all_docs}
 
+        aggregation_start = time.perf_counter()
         all_source_docs, all_dest_docs = _additional_aggregation(all_source_docs, all_dest_docs)
+        aggregation_secs += time.perf_counter() - aggregation_start
+        download_secs = time.perf_counter() - start - aggregation_secs
+        metrics.observe('ph_download_seconds', download_secs, index=index_name)
+        metrics.observe('ph_download_docs_per_second', len(all_docs) / max(download_secs, 1e-6), index=index_name)
+        metrics.observe('ph_aggregation_seconds', aggregation_secs, index=index_name)
         if index_name == 'flows':
             data_type2docs['source'] = all_source_docs
             data_type2docs['dest'] = all_dest_docs
@@ -381,10 +421,62 @@ class ElasticClient:
                 self._save_data(all_dest_docs, 'dest', suffix)
         return data_type2docs
 
+    def _search(self, index, query, filter_path):
+        """Returns the first response of the scrolled search, None for the empty index."""
+        resp = self.es.search(
+            index=index,
+            body=query,
+            filter_path=filter_path,
+            scroll=params.scroll_time  # length of time to keep search context
+        )
+        if not resp or '_scroll_id' not in resp: # empty index!
+            logger.info(f'Index "{index}" empty.')
+            return None
+        return resp
+
+    def _scroll(self, resp, filter_path, max_docs):
+        """
+        Yields the documents of the pages of the search response till the max_docs documents are downloaded.
+        The scroll context is cleared when the generator is finished or closed (a consumer stopped reading it).
+        """
+        scroll_id = '_scroll_id'
+        old_scroll_id = resp[scroll_id]
+
+        downloaded = 0
+        first_resp = True
+        try:
+            while (
+                    'hits' in resp
+                    and 'hits' in resp['hits']
+                    and resp['hits']['hits']
+                    and downloaded < max_docs
+            ):
+                if not first_resp:
+                    resp = self.es.scroll(
+                        scroll_id=old_scroll_id,
+                        filter_path=filter_path,
+                        scroll=params.scroll_time  # length of time to keep search context
+                    )
+                first_resp = False
+                if old_scroll_id != resp[scroll_id]:
+                    logger.error("*** NEW SCROLL ID:", resp[scroll_id])
+                old_scroll_id = resp[scroll_id]
+
+                if 'hits' in resp and 'hits' in resp['hits']:
+                    docs = [el['_source'] for el in resp['hits']['hits']]
+                    downloaded += len(docs)
+                    yield docs
+        finally:
+            try:
+                self.es.clear_scroll(scroll_id=old_scroll_id)
+            except Exception as ex:  # the context expires after the scroll_time anyway
+                logger.warning(f'  The scroll context is not cleared: "{str(ex)}".')
+
     @staticmethod
     def _save_data(dct_lst, name, suffix):
         if not dct_lst: return
         file = f'./data/{name}.{suffix}.csv'
+        import pandas as pd
         pd.DataFrame(dct_lst).to_csv(file, index=False)
         logger.info(f'Saved {len(dct_lst):,} into "{file}"')
         return
@@ -12,6 +12,11 @@ logs = ['flows', 'l7', 'dns']
 data_dir = './data'
 model_dir = './models'
 
+# model namespaces. The production models are kept in the model_dir, models of other namespaces - in the sub-folders.
+production_namespace = 'production'
+diagnostics_namespace = 'diagnostics'  # the self-diagnostics tests cycle
+diagnostics_real_life_namespace = 'diagnostics_real_life'  # the self-diagnostics real-life cycle started by the API
+
 
 Job = namedtuple('Job', 'name params field model_name  data_type source_log group_fields tolerance dynamic_model')
 """
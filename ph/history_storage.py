@@ -1,19 +1,138 @@
 from datetime import datetime
 import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
 from .globals import data_dir, APP_NAME
 import logging
-import jsonlines
 import uuid
 
 logger = logging.getLogger(APP_NAME)
 
+"""
+The history of the operation results. One append-only file per operation, one JSON record per line.
+Each file has an index file `<op>.jsonl.idx`: a header line with the inode of the data file, then one
+[id, offset, length] line per record. Both files are only appended, so a save is O(1). The index is kept in memory
+and only its new lines are read, so a lookup by id or by a negative index is a dict lookup and one seek.
+Only the last PH_HISTORY_RETENTION_NUMBER records are visible. When the files hold twice as many records, they are
+compacted in a background thread: the visible records are copied into new files that replace the old ones.
+Crash safety: the record is written (and fsync-ed) before its index line, so the index never points to a partially
+written record. A partially written record is truncated by the next save. The replaced index does not match
+the inode of the old data file, so a data file replaced without its index is detected and re-indexed.
+The saves, compactions and reads of different processes are serialized with a file lock.
+"""
+
 PH_HISTORY_RETENTION_NUMBER = int(os.getenv("PH_HISTORY_RETENTION_NUMBER", 100))
 
+# the in-memory indices: {op: {'ino': index file inode, 'size': bytes read, 'data_ino': data file inode,
+#   'entries': [(id, offset, length)], 'positions': {id: entry position}}}
+_indices = {}
+_indices_lock = threading.Lock()
+
 
 def get_file_name(op):
     return f'{data_dir}/{op}.jsonl'
 
 
+def _index_file_name(op):
+    return f'{get_file_name(op)}.idx'
+
+
+@contextmanager
+def _lock(op, exclusive=True):
+    os.makedirs(data_dir, exist_ok=True)
+    with open(f'{get_file_name(op)}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _new_index(data_ino):
+    return {'ino': None, 'size': 0, 'data_ino': data_ino, 'entries': [], 'positions': {}}
+
+
+def _add_entry(index, id, offset, length):
+    index['positions'][str(id)] = len(index['entries'])
+    index['entries'].append((str(id), offset, length))
+
+
+def _write_index(op, index):
+    """Writes the index file of the data file atomically."""
+    file_name = _index_file_name(op)
+    with open(f'{file_name}.tmp', 'w') as f:
+        f.write(json.dumps({'data_ino': index['data_ino']}) + '\n')
+        f.writelines(json.dumps(list(e)) + '\n' for e in index['entries'])
+    os.replace(f'{file_name}.tmp', file_name)
+    index.update(ino=os.stat(file_name).st_ino, size=os.path.getsize(file_name))
+
+
+def _rebuild_index(op):
+    """Indexes the records of the data file (an old history file or a data file replaced without its index)."""
+    file_name = get_file_name(op)
+    index = _new_index(os.stat(file_name).st_ino)
+    offset = 0
+    with open(file_name, 'rb') as f:
+        for line in f:
+            if line.endswith(b'\n'):  # the partially written record is not indexed
+                try:
+                    _add_entry(index, json.loads(line)['id'], offset, len(line))
+                except (ValueError, KeyError):
+                    logger.warning(f'Skipped a corrupted record at {offset} of "{file_name}".')
+            offset += len(line)
+    _write_index(op, index)
+    logger.info(f'Indexed {len(index["entries"]):,} records of "{file_name}".')
+    return index
+
+
+def _load_index(op, rebuild=False):
+    """
+    Returns the up-to-date index of the op, reading only the new lines of the index file. Call it under the lock.
+    rebuild: re-index the data file if the index is missing or does not match the data file, it needs the exclusive
+    lock. Without the rebuild, returns None in this case.
+    """
+    file_name, index_file_name = get_file_name(op), _index_file_name(op)
+    if not os.path.exists(file_name):
+        return _new_index(None)
+    data_ino = os.stat(file_name).st_ino
+    with _indices_lock:
+        index = _indices.get(op)
+        if os.path.exists(index_file_name):
+            stat = os.stat(index_file_name)
+            if not index or index['ino'] != stat.st_ino or index['size'] > stat.st_size:
+                index = {**_new_index(None), 'ino': stat.st_ino}
+            with open(index_file_name, 'rb') as f:
+                f.seek(index['size'])
+                lines = f.read().split(b'\n')[:-1]  # the last line is empty or partially written
+            for line in lines:
+                item = json.loads(line)
+                if isinstance(item, dict):  # the header
+                    index['data_ino'] = item['data_ino']
+                else:
+                    _add_entry(index, *item)
+            index['size'] += sum(len(line) + 1 for line in lines)
+        if not os.path.exists(index_file_name) or index['data_ino'] != data_ino:
+            if not rebuild:
+                return None
+            index = _rebuild_index(op)
+        _indices[op] = index
+        return index
+
+
+@contextmanager
+def _indexed(op):
+    """Yields the index under the shared lock or, if the data file must be re-indexed, under the exclusive lock."""
+    with _lock(op, exclusive=False):
+        index = _load_index(op)
+        if index is not None:
+            yield index
+            return
+    with _lock(op):
+        yield _load_index(op, rebuild=True)
+
+
 def save_json_in_line(op: str, job: str, js: dict, id: str = None):
     """
     Save a json into the history file for an operation and a job.
@@ -33,19 +152,64 @@ def save_json_in_line(op: str, job: str, js: dict, id: str = None):
         'job': job,
         'result': js
     }
+    line = (json.dumps(new_item) + '\n').encode()
 
-    existed_items = read_job_jsons(op) # all json-s
-    if existed_items and len(existed_items) >= PH_HISTORY_RETENTION_NUMBER:
-        # remove first (oldest) elements
-        existed_items = existed_items[-PH_HISTORY_RETENTION_NUMBER:]
-
-    with jsonlines.open(file_name, 'w') as writer:
-        for item in existed_items + [new_item]:
-            writer.write(item)
+    with _lock(op):
+        if not os.path.exists(file_name):
+            open(file_name, 'ab').close()
+        index = _load_index(op, rebuild=True)
+        end = index['entries'][-1][1] + index['entries'][-1][2] if index['entries'] else 0
+        with open(file_name, 'r+b') as f:
+            f.truncate(end)  # a partially written record
+            f.seek(end)
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(_index_file_name(op), 'ab') as f:
+            f.write((json.dumps([id, end, len(line)]) + '\n').encode())
+        records_num = len(_load_index(op)['entries'])
     logger.info(f'Saved [op: "{op}", job: "{job}", id: {id}] result into "{file_name}"')
+    if records_num >= 2 * PH_HISTORY_RETENTION_NUMBER:
+        threading.Thread(target=compact, args=(op,), name=f'ph_compact_{op}').start()
     return id
 
 
+def compact(op: str):
+    """Keeps only the last PH_HISTORY_RETENTION_NUMBER records of the op. The files are replaced atomically."""
+    file_name = get_file_name(op)
+    with _lock(op):
+        if not os.path.exists(file_name):
+            return
+        index = _load_index(op, rebuild=True)
+        entries = index['entries'][-PH_HISTORY_RETENTION_NUMBER:]
+        if len(entries) == len(index['entries']):
+            return
+        with open(file_name, 'rb') as f:
+            f.seek(entries[0][1] if entries else 0)
+            records = f.read(entries[-1][1] + entries[-1][2] - entries[0][1]) if entries else b''
+        with open(f'{file_name}.tmp', 'wb') as f:
+            f.write(records)
+            f.flush()
+            os.fsync(f.fileno())
+        compacted = _new_index(os.stat(f'{file_name}.tmp').st_ino)
+        for id, offset, length in entries:
+            _add_entry(compacted, id, offset - entries[0][1], length)
+        os.replace(f'{file_name}.tmp', file_name)
+        _write_index(op, compacted)
+        with _indices_lock:
+            _indices[op] = compacted
+    logger.info(f'Compacted "{file_name}" from {len(index["entries"]):,} to {len(entries):,} records.')
+
+
+def _read_records(op, entries):
+    if not entries:
+        return []
+    with open(get_file_name(op), 'rb') as f:
+        f.seek(entries[0][1])
+        data = f.read(entries[-1][1] + entries[-1][2] - entries[0][1])
+    return [json.loads(line) for line in data.splitlines()]
+
+
 def read_id_json(op: str, id: str = '-1'):
     """
     Read a json from a file.
@@ -53,31 +217,24 @@ def read_id_json(op: str, id: str = '-1'):
     @param id: id of the previously saved dictionary.
     @return: a dictionary. Can be {} if didn't find any.
     """
-    file_name = get_file_name(op)
-    if not os.path.exists(file_name):
-        return {}
-    with jsonlines.open(file_name) as reader:
-        records = list(reader)
-
-    if not records:
+    if not os.path.exists(get_file_name(op)):
         return {}
+    with _indexed(op) as index:
+        first = max(0, len(index['entries']) - PH_HISTORY_RETENTION_NUMBER)
+        entries = index['entries'][first:]
+        if not entries:
+            return {}
 
-    # if id is an int, we assume id < 0 (a record index back from the tail of the list)
-    # any other non-int id we treat as the uuid.
-    # if uuid didn't found, we use -1 index.
-    # try:
-    #     back_id = int(id)
-    #     if back_id >= 0:
-    #         back_id = -1
-    # except (ValueError, TypeError):
-    back_id = -1
-    if str(id).lstrip('-+').isnumeric():
-        back_id = int(id)
+        # if id is an int, we assume id < 0 (a record index back from the tail of the list)
+        # any other non-int id we treat as the uuid.
+        # if uuid didn't found, we use -1 index.
+        back_id = -1
+        if str(id).lstrip('-+').isnumeric():
+            back_id = int(id)
 
-    for js in records:
-        if str(js['id']) == id:
-            return js
-    return records[back_id]
+        position = index['positions'].get(str(id))
+        entry = index['entries'][position] if position is not None and position >= first else entries[back_id]
+        return _read_records(op, [entry])[0]
 
 
 def read_job_jsons(op: str, job: str = None):
@@ -87,11 +244,18 @@ def read_job_jsons(op: str, job: str = None):
     @param job: a job name.
     @return: a List[json] if id is None. Can be [] if didn't find any.
     """
-    file_name = get_file_name(op)
-    if not os.path.exists(file_name):
+    if not os.path.exists(get_file_name(op)):
         return []
-    with jsonlines.open(file_name) as reader:
-        if not job:
-            return list(reader)
-        else:
-            return [el for el in reader if el['job'] == job]
+    with _indexed(op) as index:
+        records = _read_records(op, index['entries'][-PH_HISTORY_RETENTION_NUMBER:])
+    return records if not job else [el for el in records if el['job'] == job]
+
+
+def remove(op: str):
+    """Removes the history of the op."""
+    with _lock(op):
+        for file_name in [get_file_name(op), _index_file_name(op)]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        with _indices_lock:
+            _indices.pop(op, None)
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import uuid
+import inspect
+import threading
+import functools
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+
+from .globals import APP_NAME, data_dir
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+Lightweight tracing of the hot paths. A cycle (train or detection) opens a trace, the traced functions open spans
+inside it. Each span keeps its duration, number of processed items and the child spans.
+Spans outside a trace are not recorded, so the traced functions do not pay for tracing when they are called
+by the API.
+The cycles run in the scheduler processes, so the finished traces are saved into the traces_dir (the last
+PH_traces_number traces) and kept in memory of the process.
+"""
+
+Params = namedtuple('Params', 'PH_traces_number')
+params = Params(
+    int(os.getenv('PH_traces_number', 50)),
+)
+
+traces_dir = f'{data_dir}/traces'
+
+_local = threading.local()
+_traces = deque(maxlen=params.PH_traces_number)
+
+
+class Span:
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.duration = None
+        self.items = None
+        self.error = None
+        self.children = []
+
+    def add_items(self, n):
+        self.items = (self.items or 0) + n
+
+    def to_dict(self, trace_start):
+        return {
+            'name': self.name,
+            'start_offset_secs': round(self.start - trace_start, 6),
+            'duration_secs': round(self.duration, 6) if self.duration is not None else None,
+            'items': self.items,
+            'error': self.error,
+            'children': [c.to_dict(trace_start) for c in self.children],
+        }
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current_span():
+    """Returns the innermost open span of this thread or None if no trace is open."""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def trace(name):
+    """
+    Opens a trace, the root span of the cycle. The finished trace is saved in the ring buffer.
+    A trace inside another trace works as a span.
+    """
+    if current_span():
+        with span(name) as s:
+            yield s
+        return
+    root = Span(name, time.perf_counter())
+    started = datetime.utcnow()
+    _stack().append(root)
+    try:
+        yield root
+    except Exception as ex:
+        root.error = str(ex)
+        raise
+    finally:
+        root.duration = time.perf_counter() - root.start
+        _stack().pop()
+        _save_trace({
+            'id': str(uuid.uuid4()),
+            'name': name,
+            'pid': os.getpid(),
+            'time': started.isoformat(),
+            'duration_secs': round(root.duration, 6),
+            'spans': root.to_dict(root.start),
+        })
+
+
+@contextmanager
+def span(name):
+    """Opens a child span of the current span. Does nothing if no trace is open."""
+    parent = current_span()
+    if not parent:
+        yield None
+        return
+    s = Span(name, time.perf_counter())
+    parent.children.append(s)
+    _stack().append(s)
+    try:
+        yield s
+    except Exception as ex:
+        s.error = str(ex)
+        raise
+    finally:
+        s.duration = time.perf_counter() - s.start
+        _stack().pop()
+
+
+def traced(name=None, count=None):
+    """
+    A decorator, it wraps a function call into a span.
+    name: the span name. The function qualified name is used by default.
+    count: the number of items processed by the call. It is a name of the function argument (counted with len())
+    or a function of the call result.
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not current_span():
+                return func(*args, **kwargs)
+            with span(span_name) as s:
+                result = func(*args, **kwargs)
+                try:
+                    if isinstance(count, str):
+                        s.add_items(len(signature.bind(*args, **kwargs).arguments.get(count) or []))
+                    elif count:
+                        s.add_items(count(result))
+                except (TypeError, ValueError):
+                    pass
+                return result
+        return wrapper
+    return decorator
+
+
+def _save_trace(js):
+    _traces.append(js)
+    try:
+        os.makedirs(traces_dir, exist_ok=True)
+        file_name = f'{traces_dir}/{js["time"].replace(":", "")}_{js["id"]}.json'
+        with open(f'{file_name}.tmp', 'w') as f:
+            json.dump(js, f)
+        os.replace(f'{file_name}.tmp', file_name)
+        # keep only the last traces
+        files = sorted(f for f in os.listdir(traces_dir) if f.endswith('.json'))
+        for f in files[:-params.PH_traces_number]:
+            os.remove(f'{traces_dir}/{f}')
+    except OSError as ex:
+        logger.error(f'  *** Exception: "{str(ex)}". Trace "{js["name"]}" not saved.')
+
+
+def read_traces(limit=None):
+    """
+    Returns the last traces of all processes, the newest first.
+    """
+    limit = limit or params.PH_traces_number
+    out = {t['id']: t for t in _traces}
+    if os.path.isdir(traces_dir):
+        for f in sorted((f for f in os.listdir(traces_dir) if f.endswith('.json')), reverse=True)[:limit]:
+            try:
+                with open(f'{traces_dir}/{f}') as fp:
+                    js = json.load(fp)
+                    out[js['id']] = js
+            except (OSError, ValueError):
+                continue
+    return sorted(out.values(), key=lambda t: t['time'], reverse=True)[:limit]
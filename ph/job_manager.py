@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import uuid
+import threading
+import functools
+import multiprocessing
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import logging
+
+from .globals import APP_NAME, jobs, production_namespace
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+The job manager of the long-running API operations: the training, the detection over large windows and
+the hyperparameter search.
+A job runs in a bounded pool of worker processes (PH_job_workers), so the training CPU never blocks the API process
+and at most PH_job_workers jobs run concurrently, the others are queued.
+The API process has threads, so the workers are spawned, not forked. The workers keep the environment of their
+start, so each job carries the snapshot of the PH_ parameters of the API process (see /ph/conf/set_parameters) and
+the worker applies it before running the job.
+An identical request (the same operation and the same request key, the request body by default) submitted while
+the previous one is queued or running is not run again, it gets the job of the previous request.
+The workers report the job progress through a queue, the API process keeps the job states in memory:
+  {'id', 'op', 'job', 'namespace', 'status': queued|running|done|failed, 'stage',
+   'submitted', 'started', 'finished', 'duration_secs', 'result', 'error'}
+The last PH_jobs_number finished jobs are kept.
+"""
+
+Params = namedtuple('Params', 'PH_job_workers PH_jobs_number')
+params = Params(
+    int(os.getenv('PH_job_workers', 2)),
+    int(os.getenv('PH_jobs_number', 100)),
+)
+
+_jobs = OrderedDict()  # {job_id: state}
+_in_flight = {}  # {request key: job_id}
+_jobs_lock = threading.Lock()
+_executor = None
+_progress_queue = None
+_worker_queue = None  # the progress queue in the worker process
+
+
+def _utcnow():
+    return datetime.utcnow().isoformat()
+
+
+def _init_worker(queue):
+    global _worker_queue
+    _worker_queue = queue
+
+
+def progress(job_id, stage):
+    """Reports the stage of the job from the worker process."""
+    if _worker_queue is not None:
+        _worker_queue.put((job_id, stage, time.time()))
+
+
+def _read_progress(queue):
+    while True:
+        job_id, stage, ts = queue.get()
+        with _jobs_lock:
+            state = _jobs.get(job_id)
+            if state is None or state['status'] in ('done', 'failed'):
+                continue
+            if state['status'] == 'queued':
+                state.update(status='running', started=datetime.utcfromtimestamp(ts).isoformat(), _start=ts)
+            state['stage'] = stage
+
+
+def _get_executor():
+    global _executor, _progress_queue
+    if _executor is None:
+        context = multiprocessing.get_context('spawn')
+        _progress_queue = context.Queue()
+        _executor = ProcessPoolExecutor(params.PH_job_workers, mp_context=context, initializer=_init_worker,
+                                        initargs=(_progress_queue,))
+        threading.Thread(target=_read_progress, args=(_progress_queue,), name='ph_job_progress', daemon=True).start()
+    return _executor
+
+
+def _finish(job_id, key, future):
+    with _jobs_lock:
+        _in_flight.pop(key, None)
+        state = _jobs[job_id]
+        try:
+            state.update(status='done', result=future.result())
+        except Exception as ex:
+            state.update(status='failed', error=str(ex))
+            logger.error(f'*** Job {job_id} ({state["op"]} "{state["job"]}") failed: "{ex}"')
+        now = time.time()
+        state.update(stage=state['status'], finished=datetime.utcfromtimestamp(now).isoformat(),
+                     duration_secs=round(now - state.pop('_start', now), 3))
+    logger.info(f'Job {job_id} ({state["op"]} "{state["job"]}") {state["status"]} in {state["duration_secs"]} secs.')
+
+
+def _evict():
+    finished = [i for i, s in _jobs.items() if s['status'] in ('done', 'failed')]
+    for job_id in finished[:max(0, len(finished) - params.PH_jobs_number)]:
+        del _jobs[job_id]
+
+
+def _envvars():
+    """The snapshot of the parameters (the PH_ environment variables) of the API process."""
+    return {name: value for name, value in os.environ.items() if name.startswith('PH_')}
+
+
+def _run(func, job_id, rq, envvars):
+    """Runs the job in the worker process with the parameters of the API process."""
+    for name in [n for n in os.environ if n.startswith('PH_') and n not in envvars]:
+        del os.environ[name]
+    os.environ.update(envvars)
+    return func(job_id, rq)
+
+
+def submit(op, rq, func, key=None):
+    """
+    Submits the func(job_id, rq) as the `op` job. rq: an OperationDataRq.
+    key: the key of the identical requests, the request body by default.
+    Returns: (the job state, True if the job is new or False if it is the identical in-flight job)
+    """
+    key = f'{op}:{key or rq.json()}'
+    with _jobs_lock:
+        if key in _in_flight:
+            return _public(_jobs[_in_flight[key]]), False
+        job_id = str(uuid.uuid4())
+        _jobs[job_id] = {'id': job_id, 'op': op, 'job': rq.job.name,
+                         'namespace': getattr(rq, 'namespace', None) or production_namespace,
+                         'status': 'queued', 'stage': 'queued', 'submitted': _utcnow(), 'started': None,
+                         'finished': None, 'duration_secs': None, 'result': None, 'error': None,
+                         '_start': time.time()}
+        _in_flight[key] = job_id
+        _evict()
+    future = _get_executor().submit(_run, func, job_id, rq, _envvars())
+    future.add_done_callback(functools.partial(_finish, job_id, key))
+    logger.info(f'Job {job_id} ({op} "{rq.job.name}") submitted.')
+    return get(job_id), True
+
+
+def _public(state, skip=()):
+    return {k: v for k, v in state.items() if k not in skip and not k.startswith('_')}
+
+
+def get(job_id):
+    """Returns a copy of the job state or None."""
+    with _jobs_lock:
+        state = _jobs.get(job_id)
+        return _public(state) if state else None
+
+
+def list_jobs():
+    """Returns the job states without the results, the newest first."""
+    with _jobs_lock:
+        return [_public(s, skip=('result',)) for s in reversed(_jobs.values())]
+
+
+def _samples(job_id, rq):
+    from .api_helper import prepare_samples, prepare_all_samples
+
+    progress(job_id, 'loading data')
+    local_jobs = jobs()
+    samples = prepare_all_samples(rq, local_jobs) if rq.job.name == 'all' else prepare_samples(rq, local_jobs)
+    progress(job_id, f'loaded {sum(len(s) for s in samples.values()):,} samples')
+    return samples
+
+
+def train(job_id, rq):
+    """The training job. It runs in the worker process."""
+    from . import metrics
+    from .model_processor import train_job
+
+    try:
+        samples = _samples(job_id, rq)
+        names = [j.name for j in jobs() if j.dynamic_model and (rq.job.name in ('all', j.name))]
+        trained = []
+        for job in jobs():
+            if job.name in names and samples.get(job.data_type):
+                progress(job_id, f'training "{job.name}"')
+                train_job(job.name, samples[job.data_type], namespace=rq.namespace or production_namespace)
+                trained.append(job.name)
+        if not trained:
+            raise ValueError(f"NO training of '{rq.job.name}'. No samples - No training :(")
+        return f'Trained {trained} models.'
+    finally:
+        metrics.flush()
+
+
+def detect(job_id, rq):
+    """The detection job. It runs in the worker process. Returns the anomalies."""
+    from . import metrics
+    from .api_helper import format_alert_to_anomaly
+    from .model_processor import detect as detect_job, aggregate_byte_anomalies
+
+    try:
+        samples = _samples(job_id, rq)
+        anomalies = []
+        for job in jobs():
+            if rq.job.name in ('all', job.name) and samples.get(job.data_type):
+                progress(job_id, f'detection with "{job.name}"')
+                anomalies += detect_job(job.name, samples[job.data_type], namespace=rq.namespace or production_namespace)
+        if rq.job.name == 'all':
+            anomalies = aggregate_byte_anomalies(anomalies)
+        # the numpy scalars of the records are converted, the result is sent as JSON
+        return json.loads(json.dumps(format_alert_to_anomaly(anomalies),
+                                     default=lambda obj: obj.item() if hasattr(obj, 'item') else str(obj)))
+    finally:
+        metrics.flush()
+
+
+def tune(job_id, rq):
+    """The hyperparameter search job. It runs in the worker process. Returns the ranked table of the trials."""
+    from . import tuning
+
+    progress(job_id, 'tuning')
+    return tuning.tune(rq.job.name, rq.space, rq.mode.name, rq.trials, rq.workers or tuning.params.PH_tune_workers,
+                       rq.seed, progress=lambda done, total: progress(job_id, f'{done}/{total} trials'))
@@ -1,53 +1,123 @@
 import os
+import json
+import fcntl
+import hashlib
 from collections import namedtuple
+from contextlib import contextmanager
 from pathlib import Path
-import pickle
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import logging
-from ph.globals import APP_NAME
+from ph.globals import APP_NAME, logs
 
 logger = logging.getLogger(APP_NAME)
 
-file_name = Path('./models') / 'last_timestamp.pkl'
+file_name = Path('./models') / 'last_timestamp.json'
 
 """
-The last_timestamp file is used to store the time of the last detection cycle.
-If the detection cycle was not successful then the next cycle runs on the time interval starting
-from the last successful detection cycle and we do not miss any anomalies. So in case of the unsuccessful detection 
-cycle we do not miss anomalies but only postpone the performance hotspot detection for anomalies from the failed detection time
-interval.
-If no last_timestamp file existed, we use the doubled PH_search_interval_minutes. 
+The last_timestamp file is a watermark store: it keeps the time of the last successful detection cycle per index.
+If the detection cycle of an index was not successful (a job failed) then its watermark is not moved and the next
+cycle runs on the time interval starting from the last successful detection cycle, so we do not miss any anomalies
+but only postpone the detection of the failed time interval.
+If the download was truncated by the max_docs, the documents are downloaded in the '@timestamp' order, so the
+watermark is moved to the '@timestamp' of the last downloaded document and the next window starts at it, without
+the overlap (the overlap can have more than max_docs documents). The late documents of the truncated windows are not
+detected.
+If no watermark saved, we use the doubled PH_search_interval_minutes.
 The files does not exist probably when the app [re]started. To take in account restarting time we double the time.
+
+The documents can be indexed in the ES later than their '@timestamp'. So the detection window of an index starts
+PH_search_overlap_minutes before its watermark, and the documents of the overlap are downloaded again.
+The keys of the scored documents of the overlap are kept in the store (the dedup index), so each document is scored
+exactly once. The ES '_id' is not downloaded, so the document key is the hash of the document content.
+The store is a JSON file:
+  {index_name: {'watermark': iso_datetime, 'truncated': bool, 'scored': {iso_window_end: [doc_key, ...]}}}.
+It is replaced atomically under a file lock.
 """
 
-Params = namedtuple('Params', 'PH_search_interval_minutes')
+Params = namedtuple('Params', 'PH_search_interval_minutes PH_search_overlap_minutes')
 params = Params(
     int(os.getenv('PH_search_interval_minutes', 30)),
+    int(os.getenv('PH_search_overlap_minutes', 5)),
 )
 logger.info('Initialized params for the last_timestamp.py: ' + ', '.join(
     [f'{n}: {el}' for el, n in zip(params, params._fields)]))
 
 
-def load():
+def _read():
+    if not os.path.isfile(file_name):
+        return {}
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def _write(state):
+    with open(f'{file_name}.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(f'{file_name}.tmp', file_name)
+
+
+@contextmanager
+def _lock():
+    os.makedirs(file_name.parent, exist_ok=True)
+    with open(f'{file_name}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load(index_name=None):
     """
+    Returns the watermark of the index. Without the index_name, the earliest watermark of all indices.
     Important! we use UTC datetime because logs use it! So it is utcnow() not now()
     """
-    if os.path.isfile(file_name):
-        with open(file_name, 'rb') as f:
-            ts = pickle.load(f)
-            logger.info(f'Loaded Last Timestamp {ts} from "{file_name}".')
-            assert isinstance(ts, datetime)
-            return ts
-    else:
-        back_minutes = params.PH_search_interval_minutes * 2
-        logger.info(f'Last Timestamp is not saved yet. We take {back_minutes} minutes back from now.')
-        return datetime.utcnow()-timedelta(minutes=back_minutes)
+    state = _read()
+    watermarks = [state.get(i, {}).get('watermark') for i in ([index_name] if index_name else logs)]
+    if watermarks and all(watermarks):
+        ts = datetime.fromisoformat(min(watermarks))
+        logger.info(f'Loaded Last Timestamp {ts} of the "{index_name or "all"}" index from "{file_name}".')
+        return ts
+    back_minutes = params.PH_search_interval_minutes * 2
+    logger.info(f'Last Timestamp is not saved yet. We take {back_minutes} minutes back from now.')
+    return datetime.utcnow() - timedelta(minutes=back_minutes)
+
+
+def window_start(index_name):
+    """
+    The start of the next detection window of the index: the watermark minus the overlap, the watermark itself after
+    the truncated download.
+    """
+    overlap = 0 if _read().get(index_name, {}).get('truncated') else params.PH_search_overlap_minutes
+    return load(index_name) - timedelta(minutes=overlap)
 
 
-def save(data):
-    with open(file_name, 'wb') as f:
-        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
-        logger.info(f'Saved Last Timestamp {data} into "{file_name}".')
+def save(data, index_name=None, scored_keys=(), advance=True, truncated=False):
+    """
+    Saves the watermark `data` (a naive UTC datetime, the end of the detection window) of the index.
+    Without the index_name, saves it for all indices.
+    scored_keys: the keys of the scored documents of the window which can be downloaded again by the next overlapped
+    window (see dedup()).
+    advance: if False, the watermark is not moved, only the scored_keys are saved.
+    truncated: the watermark is the last document time of the truncated download.
+    """
+    window_end = data.isoformat()
+    with _lock():
+        state = _read()
+        for name in [index_name] if index_name else logs:
+            entry = state.setdefault(name, {'watermark': None, 'scored': {}})
+            if advance:
+                entry['watermark'] = window_end
+                entry['truncated'] = truncated
+            if scored_keys:
+                entry['scored'][window_end] = sorted(set(entry['scored'].get(window_end, [])) | set(scored_keys))
+            if entry['watermark']:  # the keys of the windows before the next window start are not needed
+                overlap = 0 if entry.get('truncated') else params.PH_search_overlap_minutes
+                start = (datetime.fromisoformat(entry['watermark']) - timedelta(minutes=overlap)).isoformat()
+                entry['scored'] = {k: v for k, v in entry['scored'].items() if k >= start}
+        _write(state)
+    logger.info(f'Saved Last Timestamp {data} of the "{index_name or "all"}" index into "{file_name}"'
+                f'{"" if advance else " (not advanced)"}, {len(scored_keys):,} scored keys.')
 
 
 def remove():
@@ -55,3 +125,53 @@ def remove():
         os.remove(file_name)
         logger.info(f'Removed the "{file_name}" file.')
 
+
+def doc_key(doc):
+    """The key of the document: the hash of its content."""
+    return hashlib.blake2b(json.dumps(doc, sort_keys=True, default=str).encode(), digest_size=12).hexdigest()
+
+
+def _epoch(doc):
+    ts = doc.get('@timestamp')
+    if not ts:
+        return None
+    dt = datetime.fromisoformat(ts.replace('Z', '+00:00'))
+    return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+
+
+def last_doc_time(docs):
+    """The '@timestamp' of the last document as a naive UTC datetime, None if the docs have no '@timestamp'."""
+    epochs = [e for e in map(_epoch, docs) if e is not None]
+    return datetime.fromtimestamp(max(epochs), timezone.utc).replace(tzinfo=None) if epochs else None
+
+
+def dedup(index_name, docs, window_end, truncated=False):
+    """
+    Removes the already scored documents from the documents of the [window_start, window_end) detection window.
+    The docs must have the '@timestamp' field (see ElasticClient with_timestamp).
+    window_end: the next watermark, the end of the window or the last document time of the truncated download.
+    truncated: the download was truncated, the next window starts at the window_end.
+    Returns: (new_docs, keys) where the keys are of the new documents to be remembered with save(): the documents
+    which will be downloaded again by the next window. They are the documents of the next overlap or the documents
+    of the last document time of the truncated download.
+    """
+    scored_windows = _read().get(index_name, {}).get('scored', {})
+    scored = {k for keys in scored_windows.values() for k in keys}
+    # the documents after the last scored window end were never scored
+    scored_end = _epoch({'@timestamp': max(scored_windows)}) if scored else None
+    next_overlap_start = (window_end.replace(tzinfo=timezone.utc).timestamp()
+                          - (0 if truncated else params.PH_search_overlap_minutes * 60))
+    new_docs, keys = [], []
+    for doc in docs:
+        ts = _epoch(doc)
+        was_scored = scored_end is not None and (ts is None or ts <= scored_end)
+        remembered = ts is None or ts >= next_overlap_start
+        key = doc_key(doc) if was_scored or remembered else None
+        if was_scored and key in scored:
+            continue
+        new_docs.append(doc)
+        if remembered:
+            keys.append(key)
+    if len(new_docs) < len(docs):
+        logger.info(f'Skipped {len(docs) - len(new_docs):,} already scored "{index_name}" docs.')
+    return new_docs, keys
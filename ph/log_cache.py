@@ -0,0 +1,297 @@
+import os
+import json
+import fcntl
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import logging
+
+from .globals import APP_NAME, data_dir, logs
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+A local time-partitioned columnar cache of the downloaded log documents.
+Each detection cycle downloads the new documents of the flows/l7/dns indices and puts them into the cache. The
+training assembles its time window from the cache and downloads from the ES only the missing parts of the window.
+The cache of an index is a folder in the cache_dir with:
+  one partition file per hour: a pickled pandas DataFrame with the documents with the '@timestamp' in this hour,
+    the '@timestamp' is kept as the epoch seconds in the '_ts' column,
+  the coverage.json file: the merged [start, end) time intervals (epoch seconds) which were downloaded completely.
+A downloaded window is covered only if it was not truncated by the max_docs. The documents of the already covered
+intervals are not added again, so the overlapped windows do not produce duplicates.
+The partitions keep the types of the fields: an integer field with the missing values is kept as the nullable
+integer, so the cached docs are the same as the downloaded ones.
+The partitions older than the PH_log_cache_retention_hours are evicted. Without the PH_train_start_time the
+training window is open as before: its part older than the retention window is downloaded from the ES, it is
+not cached.
+The scheduler processes use the cache concurrently, so the updates are serialized with a file lock per index and
+the files are replaced atomically.
+"""
+
+Params = namedtuple('Params', 'PH_log_cache PH_log_cache_retention_hours')
+params = Params(
+    eval(os.getenv('PH_log_cache', 'True')),
+    int(os.getenv('PH_log_cache_retention_hours', 7 * 24)),
+)
+logger.info('Initialized params for the log_cache.py: ' + ', '.join(
+    [f'{n}: {el}' for el, n in zip(params, params._fields)]))
+
+cache_dir = f'{data_dir}/log_cache'
+hour_secs = 3600
+ts_column = '_ts'
+
+
+def to_epoch(t):
+    """None, 'YYYY-mm-dd HH:MM:SS' or a datetime (naive means UTC, as in the ES queries) -> epoch seconds."""
+    if t is None:
+        return None
+    if isinstance(t, str):
+        t = datetime.fromisoformat(t)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return t.timestamp()
+
+
+def to_datetime(epoch):
+    """Epoch seconds -> a naive UTC datetime, as the ElasticClient expects."""
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+
+
+def _index_dir(index_name):
+    return f'{cache_dir}/{index_name}'
+
+
+def _partition_file(index_name, hour):
+    return f'{_index_dir(index_name)}/{time.strftime("%Y%m%d%H", time.gmtime(hour))}.pkl'
+
+
+def _partition_hour(file_name):
+    return datetime.strptime(file_name[:-len('.pkl')], '%Y%m%d%H').replace(tzinfo=timezone.utc).timestamp()
+
+
+@contextmanager
+def _lock(index_name, exclusive=True):
+    os.makedirs(_index_dir(index_name), exist_ok=True)
+    with open(f'{_index_dir(index_name)}/.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _load_coverage(index_name):
+    file_name = f'{_index_dir(index_name)}/coverage.json'
+    if not os.path.isfile(file_name):
+        return []
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def _save_coverage(index_name, coverage):
+    file_name = f'{_index_dir(index_name)}/coverage.json'
+    with open(f'{file_name}.tmp', 'w') as f:
+        json.dump(coverage, f)
+    os.replace(f'{file_name}.tmp', file_name)
+
+
+def _merge(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        elif start < end:
+            merged.append([start, end])
+    return merged
+
+
+def _subtract(start, end, intervals):
+    """The parts of the [start, end) interval not covered by the merged intervals."""
+    gaps = []
+    for s, e in intervals:
+        if e <= start or s >= end:
+            continue
+        if s > start:
+            gaps.append((start, s))
+        start = max(start, e)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+def gaps(index_name, start, end):
+    """The parts of the [start, end) window (epoch seconds) which are not in the cache."""
+    with _lock(index_name, exclusive=False):
+        return _subtract(start, end, _load_coverage(index_name))
+
+
+def _frame(docs):
+    """The DataFrame of the docs with the types of the fields, the integer fields with the missing values are Int64."""
+    import pandas as pd
+
+    df = pd.DataFrame(docs)
+    for column in df.columns[df.dtypes == float]:
+        if df[column].isna().any() and pd.api.types.infer_dtype(
+                [d.get(column) for d in docs], skipna=True) == 'integer':
+            df[column] = pd.array([d.get(column) for d in docs], dtype='Int64')
+    return df
+
+
+def _epochs(timestamps):
+    """The '@timestamp' values -> the numpy array of the epoch seconds, NaN for the missing values."""
+    import pandas as pd
+
+    return ((pd.to_datetime(pd.Series(timestamps, dtype=object), utc=True) - pd.Timestamp(0, tz='UTC'))
+            / pd.Timedelta(seconds=1)).to_numpy()
+
+
+def _with_epochs(docs):
+    """Replaces the '@timestamp' of the docs with its epoch seconds in the ts_column, 0 if it is missing."""
+    for d, epoch in zip(docs, _epochs([d.pop('@timestamp', None) for d in docs])):
+        d[ts_column] = 0 if epoch != epoch else epoch
+    return docs
+
+
+def put(index_name, docs, start, end, max_docs=None):
+    """
+    Caches the documents downloaded from the [start, end) window (epoch seconds).
+    The docs must have the '@timestamp' field, it is removed from the docs.
+    The docs of a truncated download (len(docs) >= max_docs) are not cached, the window is not covered completely.
+    Returns: True if the window is cached.
+    """
+    timestamps = [d.pop('@timestamp', None) for d in docs]
+    if not params.PH_log_cache or (max_docs and len(docs) >= max_docs):
+        return False
+    import numpy as np
+    import pandas as pd
+
+    epochs = _epochs(timestamps)
+    with _lock(index_name):
+        coverage = _load_coverage(index_name)
+        in_window = (epochs >= start) & (epochs < end)
+        if coverage:  # skip the docs of the already covered intervals
+            starts, ends = np.array(coverage).T
+            idx = np.searchsorted(starts, epochs, 'right') - 1
+            in_window &= ~((idx >= 0) & (epochs < ends[np.maximum(idx, 0)]))
+        new_docs = 0
+        if in_window.any():
+            df = _frame([d for d, keep in zip(docs, in_window) if keep])
+            df[ts_column] = epochs[in_window]
+            new_docs = len(df)
+            for hour, partition in df.groupby((df[ts_column] // hour_secs) * hour_secs):
+                file_name = _partition_file(index_name, hour)
+                if os.path.isfile(file_name):
+                    partition = pd.concat([pd.read_pickle(file_name), partition], ignore_index=True)
+                partition.to_pickle(f'{file_name}.tmp')
+                os.replace(f'{file_name}.tmp', file_name)
+        _save_coverage(index_name, _merge(coverage + [[start, end]]))
+    logger.info(f'Cached {new_docs:,} of {len(docs):,} "{index_name}" docs from the '
+                f'[{to_datetime(start)}, {to_datetime(end)}) window.')
+    return True
+
+
+def get(index_name, start, end, with_epochs=False):
+    """
+    Returns the cached docs of the [start, end) window (epoch seconds), sorted by the '@timestamp'.
+    with_epochs: the docs keep the epoch seconds of the '@timestamp' in the ts_column.
+    """
+    import pandas as pd
+
+    frames = []
+    with _lock(index_name, exclusive=False):
+        hour = (start // hour_secs) * hour_secs
+        while hour < end:
+            file_name = _partition_file(index_name, hour)
+            if os.path.isfile(file_name):
+                df = pd.read_pickle(file_name)
+                frames.append(df[(df[ts_column] >= start) & (df[ts_column] < end)])
+            hour += hour_secs
+    if not frames:
+        return []
+    df = pd.concat(frames, ignore_index=True).sort_values(ts_column, kind='stable')
+    if not with_epochs:
+        df = df.drop(columns=ts_column)
+    # the missing fields of the documents are NaN in the DataFrame, they are None in the docs
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+def evict(now=None):
+    """Removes the partitions older than the retention."""
+    cutoff = ((now or time.time()) - params.PH_log_cache_retention_hours * hour_secs) // hour_secs * hour_secs
+    if not os.path.isdir(cache_dir):
+        return
+    for index_name in os.listdir(cache_dir):
+        if not os.path.isdir(_index_dir(index_name)):
+            continue
+        with _lock(index_name):
+            removed = 0
+            for file_name in os.listdir(_index_dir(index_name)):
+                if file_name.endswith('.pkl') and _partition_hour(file_name) < cutoff:
+                    os.remove(f'{_index_dir(index_name)}/{file_name}')
+                    removed += 1
+            coverage = [[max(s, cutoff), e] for s, e in _load_coverage(index_name) if e > cutoff]
+            _save_coverage(index_name, coverage)
+        if removed:
+            logger.info(f'Evicted {removed} "{index_name}" partitions older than {to_datetime(cutoff)}.')
+
+
+def put_downloaded(data_type2docs, start_time, end_time, max_docs=None):
+    """
+    Caches the data of the detection cycle downloaded with the `with_timestamp=True`.
+    end_time: the end of the window or the time of the download start if the window is open.
+    """
+    if not params.PH_log_cache or start_time is None:
+        for docs in data_type2docs.values():
+            for d in docs:
+                d.pop('@timestamp', None)
+        return
+    evict()
+    for index_name in logs:
+        if index_name in data_type2docs:
+            put(index_name, data_type2docs[index_name], to_epoch(start_time), to_epoch(end_time), max_docs)
+
+
+def load_window(es_client, start_time, end_time, max_docs, now=None):
+    """
+    Returns the data of the [start_time, end_time) window in the download_and_aggregate_data format.
+    Only the parts of the window missing in the cache are downloaded from the ES.
+    The open window start means all data: the part older than the retention window is downloaded from the ES.
+    The open window end is now.
+    The data of every index is limited by the max_docs most recent documents: the older, cached and not cached
+    parts are sorted by the '@timestamp' before the limiting.
+    """
+    from . import elastic_api
+
+    now = now or time.time()
+    evict(now)
+    retention_start = (now - params.PH_log_cache_retention_hours * hour_secs) // hour_secs * hour_secs
+    start = to_epoch(start_time) or retention_start
+    end = to_epoch(end_time) or now
+    data_type2docs = {}
+    for index_name in logs:
+        older, not_cached = [], []
+        if start_time is None:  # the data older than the retention window
+            older = _with_epochs(es_client.download_and_aggregate_data(
+                None, to_datetime(min(start, end)), max_docs=max_docs, index_name=index_name, with_timestamp=True,
+                sort_by_time=True).get(index_name, []))
+        window_gaps = gaps(index_name, start, end)
+        for gap_start, gap_end in window_gaps:
+            data = es_client.download_and_aggregate_data(to_datetime(gap_start), to_datetime(gap_end),
+                                                         max_docs=max_docs, index_name=index_name,
+                                                         with_timestamp=True, sort_by_time=True)
+            docs = data.get(index_name, [])
+            timestamps = [d.get('@timestamp') for d in docs]
+            if not put(index_name, docs, gap_start, gap_end, max_docs):
+                not_cached += _with_epochs([{**d, '@timestamp': t} for d, t in zip(docs, timestamps)])
+        docs = sorted(older + get(index_name, start, end, with_epochs=True) + not_cached, key=lambda d: d[ts_column])
+        docs = docs[-max_docs:] if max_docs else docs
+        for d in docs:
+            del d[ts_column]
+        logger.info(f'Loaded {len(docs):,} "{index_name}" docs of the [{to_datetime(start)}, {to_datetime(end)}) '
+                    f'window, {len(window_gaps)} missing intervals downloaded from the ES.')
+        data_type2docs[index_name] = docs
+        if index_name == 'flows':
+            data_type2docs.update(elastic_api.aggregate_samples(docs))
+    return data_type2docs
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import fcntl
+import resource
+import threading
+from contextlib import contextmanager
+import logging
+
+from .globals import APP_NAME, data_dir
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+An in-process metrics registry with the histograms of the cycle stages and the gauges of the alert outbox.
+The train and detection cycles run in the child processes of the scheduler. Each process flushes a snapshot of its
+registry into the metrics_dir as a `<pid>_<start time>.json` file. The API process merges these snapshots with its
+own registry and exposes them in the Prometheus text format. Snapshots of the finished processes are folded into one
+file. The histograms of the processes are summed up, a gauge has the last value set by any process. A process is identified by its pid and its start time, so a reused pid is not taken for the finished process.
+"""
+
+metrics_dir = f'{data_dir}/metrics'
+merged_file_name = '_merged.json'
+
+seconds_buckets = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800)
+rate_buckets = (100, 1000, 5000, 10000, 50000, 100000, 500000, 1000000)
+bytes_buckets = tuple(2 ** p for p in range(26, 35))  # 64MB ... 16GB
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=seconds_buckets):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = {}  # {label_values: [bucket_counts (not cumulative) + [+Inf count], sum, count]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.label_names)
+        with self._lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts, _, _ = state = self.values[key]
+            idx = next((i for i, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+            counts[idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), list(counts), s, c] for k, (counts, s, c) in self.values.items()]
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}  # {label_values: [value, time of the setting]}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.label_names)
+        with self._lock:
+            self.values[key] = [value, time.time()]
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), v, t] for k, (v, t) in self.values.items()]
+
+
+_registry = {h.name: h for h in [
+    Histogram('ph_download_seconds', 'Download time of an index.', ['index']),
+    Histogram('ph_download_docs_per_second', 'Download rate of an index.', ['index'], rate_buckets),
+    Histogram('ph_aggregation_seconds', 'Aggregation time of the downloaded index data.', ['index']),
+    Histogram('ph_train_seconds', 'Training time of a job model.', ['job']),
+    Histogram('ph_score_seconds', 'Scoring (detection) time of a job model.', ['job']),
+    Histogram('ph_model_load_seconds', 'Loading time of a job model.', ['job']),
+    Histogram('ph_alert_write_seconds', 'Latency of writing an alert into the events index.'),
+    Histogram('ph_alert_outbox_lag_seconds', 'Time from the enqueueing of an alert to its writing.'),
+    Histogram('ph_cycle_peak_rss_bytes', 'Peak RSS of a train or detection cycle process.', ['cycle'],
+              bytes_buckets),
+    Gauge('ph_alert_outbox_depth', 'Number of the alerts in the outbox.'),
+    Gauge('ph_alert_outbox_oldest_alert_seconds', 'Age of the oldest alert in the outbox, 0 if it is empty.'),
+]}
+
+
+def observe(name, value, **labels):
+    _registry[name].observe(value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    _registry[name].set(value, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observes the execution time of the block in seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def record_cycle(cycle):
+    """
+    Observes the peak RSS of the cycle process and flushes the registry.
+    Call it at the end of the cycle, the cycle processes end without the atexit handlers.
+    """
+    observe('ph_cycle_peak_rss_bytes', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, cycle=cycle)
+    flush()
+
+
+def reset():
+    for h in _registry.values():
+        h.reset()
+
+
+# a forked process starts with an empty registry, so the parent observations are not counted twice
+os.register_at_fork(after_in_child=reset)
+
+
+def flush():
+    """Saves the registry snapshot of this process into the metrics_dir. The file is replaced atomically."""
+    os.makedirs(metrics_dir, exist_ok=True)
+    file_name = f'{metrics_dir}/{os.getpid()}_{_start_time(os.getpid()) or 0}.json'
+    with open(f'{file_name}.tmp', 'w') as f:
+        json.dump(_snapshot(), f)
+    os.replace(f'{file_name}.tmp', file_name)
+
+
+def _snapshot():
+    return {name: h.snapshot() for name, h in _registry.items()}
+
+
+def _merge(total, snapshot):
+    for name, values in snapshot.items():
+        if isinstance(_registry.get(name), Gauge):  # the last set value
+            merged = {tuple(k): [v, t] for k, v, t in total.get(name, [])}
+            for k, v, t in values:
+                if tuple(k) not in merged or t >= merged[tuple(k)][1]:
+                    merged[tuple(k)] = [v, t]
+            total[name] = [[list(k), v, t] for k, (v, t) in merged.items()]
+            continue
+        merged = {tuple(k): [counts, s, c] for k, counts, s, c in total.get(name, [])}
+        for k, counts, s, c in values:
+            if tuple(k) in merged:
+                m = merged[tuple(k)]
+                m[0] = [a + b for a, b in zip(m[0], counts)]
+                m[1] += s
+                m[2] += c
+            else:
+                merged[tuple(k)] = [list(counts), s, c]
+        total[name] = [[list(k), counts, s, c] for k, (counts, s, c) in merged.items()]
+    return total
+
+
+def _read(file_name):
+    try:
+        with open(file_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _start_time(pid):
+    """The start time of the process in the clock ticks after the boot, None if it is unknown (no /proc)."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _is_alive(pid, start_time=0):
+    """start_time: the start time of the snapshot process, 0 if it is unknown (only the pid is checked)."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return not start_time or _start_time(pid) in (None, start_time)
+
+
+def _collect_snapshots():
+    """
+    Merges the snapshots of all processes. Snapshots of the finished processes are folded into the merged file,
+    so the number of files does not grow with the number of cycles.
+    """
+    if not os.path.isdir(metrics_dir):
+        return {}
+    with open(f'{metrics_dir}/.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            merged_path = f'{metrics_dir}/{merged_file_name}'
+            merged = _read(merged_path)
+            live = {}
+            finished = []
+            for name in os.listdir(metrics_dir):
+                process = name[:-len('.json')].split('_')
+                if not name.endswith('.json') or not all(p.isdigit() for p in process) or len(process) > 2:
+                    continue
+                pid, start_time = int(process[0]), int(process[1]) if len(process) == 2 else 0
+                if pid == os.getpid() and start_time in (0, _start_time(pid) or 0):
+                    continue
+                if _is_alive(pid, start_time):
+                    _merge(live, _read(f'{metrics_dir}/{name}'))
+                else:
+                    _merge(merged, _read(f'{metrics_dir}/{name}'))
+                    finished.append(f'{metrics_dir}/{name}')
+            if finished:
+                with open(f'{merged_path}.tmp', 'w') as f:
+                    json.dump(merged, f)
+                os.replace(f'{merged_path}.tmp', merged_path)
+                _ = [os.remove(f) for f in finished]
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return _merge(merged, live)
+
+
+def _format_labels(label_names, label_values, **extra):
+    pairs = list(zip(label_names, label_values)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{n}="{v}"' for n, v in pairs) + '}'
+
+
+def collect():
+    """
+    Returns all metrics of this process and of the scheduler processes in the Prometheus text format.
+    """
+    total = _merge(_collect_snapshots(), _snapshot())
+    lines = []
+    for name, h in _registry.items():
+        lines += [f'# HELP {name} {h.description}', f'# TYPE {name} {h.type}']
+        if h.type == 'gauge':
+            lines += [f'{name}{_format_labels(h.label_names, label_values)} {v}'
+                      for label_values, v, _ in sorted(total.get(name, []))]
+            continue
+        for label_values, counts, s, c in sorted(total.get(name, [])):
+            cumulative = 0
+            for le, count in zip([str(b) for b in h.buckets] + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(h.label_names, label_values, le=le)} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(h.label_names, label_values)} {s}')
+            lines.append(f'{name}_count{_format_labels(h.label_names, label_values)} {c}')
+    return '\n'.join(lines) + '\n'
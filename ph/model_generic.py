@@ -15,6 +15,7 @@ class L7LatencyModel:
     def __init__(self):
         self.job_name = 'l7_latency'
         self.value_field = 'duration_mean'
+        self.threshold_param = 'PH_L7Latency_IsolationForest_score_threshold'  # anomaly: score < threshold
         self.model = IsolationForest(n_estimators=get_param(self.job_name, 'PH_L7Latency_IsolationForest_n_estimators', param_type=int), random_state=0)
         self.model_name = 'sklearn.ensemble.IsolationForest'
         logger.info(f'Initialized L7LatencyModel as the "{self.model_name}",')
@@ -32,13 +33,19 @@ class L7LatencyModel:
         logger.info(f'    L7LatencyModel: Stop training the {self.model_name} model.')
         return self.model, aggregators
 
-    def find_anomalies(self, model, samples, aggregators):
-        logger.info(f'    L7LatencyModel: Start performance hotspot detection with {self.model_name} model.')
+    def score(self, model, samples):
+        """The anomaly scores of the samples, the lower the more anomalous."""
         x = np.array([s[self.value_field] for s in samples if self.value_field in s]).reshape(-1, 1)
         scores = model.score_samples(x)
         assert len(scores) == len(samples)
+        return scores
+
+    def find_anomalies(self, model, samples, aggregators):
+        logger.info(f'    L7LatencyModel: Start performance hotspot detection with {self.model_name} model.')
+        scores = self.score(model, samples)
+        threshold = get_param(self.job_name, self.threshold_param, param_type=float)
         anomaly_samples = [{**sample, 'score': score} for sample, score in zip(samples, scores, )
-                           if score < get_param(self.job_name, 'PH_L7Latency_IsolationForest_score_threshold', param_type=float)]
+                           if score < threshold]
         anomaly_samples = self._format_anomalies(anomaly_samples, aggregators)
         logger.info(f'    L7LatencyModel: Detected {len(anomaly_samples):,} anomalies with {self.model_name} model.')
         return anomaly_samples
@@ -1,18 +1,29 @@
-import sys
 import os
+import re
+import ast
+import time
+import fcntl
+import bisect
+import calendar
 import pickle
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-import pandas as pd
 import logging
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 from multiprocessing import Lock
 
-from .model_generic import L7LatencyModel
-
-from .globals import APP_NAME, jobs
+from .globals import APP_NAME, jobs, logs, production_namespace
 from . import alert_api
+from . import alert_outbox
+from . import alert_suppression
+from . import elastic_api
 from . import last_timestamp
+from . import log_cache
 from . import self_diagnostics
+from . import metrics
+from . import result_store
+from .instrumentation import traced
 
 logger = logging.getLogger(APP_NAME)
 
@@ -42,38 +53,88 @@ local_jobs = jobs()
 job_name2class_name = {job.name: job.model_name for job in local_jobs}
 job_name2job = {job.name: job for job in local_jobs}
 dynamic_jobs = {job.name for job in local_jobs if job.dynamic_model}
+byte_jobs = {'process_bytes', 'bytes_in', 'bytes_out'}
+
+
+# loaded models per namespace: {namespace: {model_name: (file_mtime_ns, model, aggregators)}}
+_model_caches = defaultdict(dict)
+_cache_locks = defaultdict(threading.Lock)
 
 
-def _save_model(model, aggregators, model_name):
+def namespace_dir(namespace=production_namespace):
+    """
+    Returns the model directory of the namespace. The production models are kept in the model_dir,
+    models of other namespaces (self-diagnostics, API-specified) - in the model_dir sub-folders,
+    so they never replace the production models.
+    """
+    if namespace == production_namespace:
+        return model_dir
+    if not re.fullmatch(r'[A-Za-z0-9_\-]+', namespace or ''):
+        raise ValueError(f'*** Error: wrong model namespace "{namespace}". Use letters, digits, "_" and "-".')
+    return f'{model_dir}/{namespace}'
+
+
+@contextmanager
+def namespace_lock(namespace, exclusive=True):
+    """
+    An inter-process lock of the namespace model files. It is a file lock, so it works for the scheduler processes
+    and the API process. Each namespace has its own lock, so the self-diagnostics never waits for the production.
+    """
+    dir_name = namespace_dir(namespace)
+    os.makedirs(dir_name, exist_ok=True)
+    with open(f'{dir_name}/.models.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _save_model(model, aggregators, model_name, namespace=production_namespace):
     """
     Save a model and an aggregator in any format.
     Save them even when model or/and aggregators is None.
     Aggregator is used mostly to store average values from the training data to present them in alerts.
     We store model and aggregators together because they both use the training data.
+    namespace: the models of different namespaces are saved in different directories. The file is replaced
+    atomically, so a reader never gets a partially written model.
     """
-    file_name = f'{model_dir}/{model_name}.model'
-    with open(file_name, 'wb') as f:
-        out = {'model': model, 'aggregators': aggregators}
-        pickle.dump(out, f, pickle.HIGHEST_PROTOCOL)
-        logger.info(f'    Model {model_name} saved into "{file_name}"')
-
-
-def _load_model(model_name):
+    file_name = f'{namespace_dir(namespace)}/{model_name}.model'
+    out = {'model': model, 'aggregators': aggregators}
+    with namespace_lock(namespace):
+        with open(f'{file_name}.tmp', 'wb') as f:
+            pickle.dump(out, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{file_name}.tmp', file_name)
+        with _cache_locks[namespace]:
+            _model_caches[namespace][model_name] = (os.stat(file_name).st_mtime_ns, model, aggregators)
+    logger.info(f'    Model {model_name} saved into "{file_name}"')
+
+
+def _load_model(model_name, namespace=production_namespace):
     """
     Restore a model and aggregator from a local disc.
+    The model is unpickled only if the file was changed after the last load in this process.
     """
-    file_name = f'{model_dir}/{model_name}.model'
-    if os.path.isfile(file_name):
-        with open(file_name, 'rb') as f:
-            out = pickle.load(f)
-            logger.info(f'    Model {model_name} loaded from "{file_name}"')
-            return out['model'], out['aggregators']
-    else:
+    file_name = f'{namespace_dir(namespace)}/{model_name}.model'
+    if not os.path.isfile(file_name):
         logger.info(f'   Model {model_name} was not created as a "{file_name}" file.')
         return None, None
+    with namespace_lock(namespace, exclusive=False):
+        mtime = os.stat(file_name).st_mtime_ns
+        with _cache_locks[namespace]:
+            cached = _model_caches[namespace].get(model_name)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+        with open(file_name, 'rb') as f:
+            out = pickle.load(f)
+        with _cache_locks[namespace]:
+            _model_caches[namespace][model_name] = (mtime, out['model'], out['aggregators'])
+    logger.info(f'    Model {model_name} loaded from "{file_name}"')
+    return out['model'], out['aggregators']
 
 
-def _save_data(dct_lst, name, timestamp=True):
+@traced(count='dct_lst')
+def _save_data(dct_lst, name, timestamp=True, data_dir=data_dir):
     """
     dct_lst: list of dictionaries.
     By default the file name presented with a timestamp, so we do not rewrite the existed file.
@@ -88,11 +149,24 @@ def _save_data(dct_lst, name, timestamp=True):
         except OSError:
             pass
         return
+    import pandas as pd
     pd.DataFrame(dct_lst).to_csv(file, index=False)
     logger.info(f'Saved {len(dct_lst):,} into "{file}"')
     return
 
 
+def _record(anomaly):
+    """The anomaly record as a dict. The old-style records are the dict strings."""
+    rec = anomaly['record']
+    return ast.literal_eval(re.sub(r'\bnan\b', 'None', rec)) if isinstance(rec, str) else rec
+
+
+def _epoch(t):
+    """The 'start_time'/'end_time' of a record: epoch seconds or a UTC "%Y-%m-%d %H:%M:%S" string."""
+    return float(t) if isinstance(t, (int, float)) else calendar.timegm(time.strptime(t, "%Y-%m-%d %H:%M:%S"))
+
+
+@traced(count='anomalies')
 def aggregate_byte_anomalies(anomalies):
     """
     Aggregate the 'process_bytes' anomalies with the 'bytes_out', 'bytes_in' anomalies in the same
@@ -101,59 +175,57 @@ def aggregate_byte_anomalies(anomalies):
     and 'process_bytes' and 'bytes_out' anomalies.
     Alert description keep the 'bytes_out' or 'bytes_in' log records.
 
-    anomalies:: a list of dictionaries. anomaly['record'] can be a string not a dictionary.
+    anomalies:: a list of dictionaries. anomaly['record'] can be a string not a dictionary, the returned anomalies
+    have the dictionary records.
+    It is an interval join: the 'process_bytes' start times are parsed once and sorted, a 'bytes_in'/'bytes_out'
+    anomaly takes the 'process_bytes' anomaly with the earliest start in its [start_time, end_time) interval,
+    found with the bisect.
     """
-    def timestamp_from_datetime_str(rec, field):
-        return datetime.strptime(rec[field], "%Y-%m-%d %H:%M:%S").timestamp()
-
-    def element_in_interval(rec, tried_dict):
-        for k, v in tried_dict.items():
-            if timestamp_from_datetime_str(rec, 'start_time') <= k < timestamp_from_datetime_str(rec, 'end_time'):
-                return v
-        return None
+    job_names = [a['alert'].split('.')[1] for a in anomalies]
+    if not any(job_name in byte_jobs for job_name in job_names):
+        return anomalies
+    records = [_record(a) for a in anomalies]
 
     # get anomalies for 'process_bytes' indexed by 'start_time'
-    process_bytes_aa = {}
-    for a in anomalies:
-        job_name = a['alert'].split('.')[1]
-        rec = eval(a['record']) if type(a['record']) == str else a['record']
-        if job_name == 'process_bytes':
-            process_bytes_aa[rec['start_time']] = rec
+    process_bytes_aa = {_epoch(rec['start_time']): rec
+                        for job_name, rec in zip(job_names, records) if job_name == 'process_bytes'}
+    starts = sorted(process_bytes_aa)
 
     # leave only anomalies found in the intersections of "process_bytes" and "bytes_in",
     #   "process_bytes" and "bytes_out"
     # ['bytes_out', 'bytes_in'] anomalies replaced by the 'process_bytes' anomalies.
     updated_anomalies = []
-    for a in anomalies:
-        rec = eval(a['record']) if type(a['record']) == str else a['record']
-        job_name = a['alert'].split('.')[1]
+    for a, job_name, rec in zip(anomalies, job_names, records):
         if job_name in ['bytes_out', 'bytes_in']:  # replace by 'process_bytes' record
-            start_ts = timestamp_from_datetime_str(rec, 'start_time')
-            new_record = element_in_interval(rec, process_bytes_aa)
-            if new_record:
+            i = bisect.bisect_left(starts, _epoch(rec['start_time']))
+            if i < len(starts) and starts[i] < _epoch(rec['end_time']):
+                new_record = process_bytes_aa[starts[i]]
                 if job_name == 'bytes_in':
                     a['description'] = f"[anomaly_detection.{job_name}] {new_record['dest_namespace']}/{new_record['dest_service_name']} has a suspicious input of {int(new_record['bytes_in']):,} bytes with {new_record['confidence']} confidence."
                 else:
                     a['description'] = f"[anomaly_detection.{job_name}] {new_record['source_namespace']}/{new_record['source_name_aggr']} has a suspicious output of {int(new_record['bytes_out']):,} bytes with {new_record['confidence']} confidence."
-                a['record'] = str(new_record) if type(a['record']) == str else new_record
+                a['record'] = new_record
                 updated_anomalies.append(a)
         elif job_name == 'process_bytes':  # remove
             continue
         else:  # leave as it is
+            a['record'] = rec
             updated_anomalies.append(a)
     return updated_anomalies
 
 
-def train_job(job_name, samples, lock: Lock = None):
+@traced(count='samples')
+def train_job(job_name, samples, lock: Lock = None, namespace=production_namespace):
     try:
         # logger.info(f'  Start training {job_name} model, Data: {len(samples):,} samples; columns: {len(samples[0])} {list(samples[0])}')
         model_cls = ModelProcessor.str2class(job_name)()
-        model, aggregators = model_cls.train(samples)
+        with metrics.timer('ph_train_seconds', job=job_name):
+            model, aggregators = model_cls.train(samples)
         if lock:
             with lock:
-                _save_model(model, aggregators, job_name)
+                _save_model(model, aggregators, job_name, namespace)
         else:
-            _save_model(model, aggregators, job_name)
+            _save_model(model, aggregators, job_name, namespace)
         if not model:
             logger.info(f'No model created for "{job_name}"')
         # logger.info(f'  Stop training {job_name} model.')
@@ -163,34 +235,54 @@ def train_job(job_name, samples, lock: Lock = None):
         logger.error(msg)
 
 
-def detect(job_name, samples, lock: Lock = None):
+@traced(count='samples')
+def detect(job_name, samples, lock: Lock = None, namespace=production_namespace, raise_errors=False):
+    """
+    raise_errors: re-raise the exception after logging it, so the caller knows the job failed.
+    """
     anomalies = []
     try:
         model, aggregators = None, None
         if job_name2job[job_name].dynamic_model:  # reload only dynamic models
-            if lock:
-                with lock:
-                    model, aggregators = _load_model(job_name)
-            else:
-                model, aggregators = _load_model(job_name)
+            with metrics.timer('ph_model_load_seconds', job=job_name):
+                if lock:
+                    with lock:
+                        model, aggregators = _load_model(job_name, namespace)
+                else:
+                    model, aggregators = _load_model(job_name, namespace)
             if not model:
-                logger.info(f'No model created for "{job_name}", so it cannot be used for detection.')
+                msg = f'No model created for "{job_name}", so it cannot be used for detection.'
+                if raise_errors:  # the caller does not move the last timestamp of the job index
+                    raise Exception(msg)
+                logger.info(msg)
                 return []
 
         model_cls = ModelProcessor.str2class(job_name)()
-        anomalies = model_cls.find_anomalies(model, samples, aggregators)
+        with metrics.timer('ph_score_seconds', job=job_name):
+            anomalies = model_cls.find_anomalies(model, samples, aggregators)
     except Exception as ex:
         sample = samples[0] if samples else {}
         msg = f'  *** Exception: "{str(ex)}". Model: {job_name}. Detection with {len(samples):,} samples; columns: {len(sample)} {list(sample)}'
         logger.error(msg)
+        if raise_errors:
+            raise
     return anomalies
 
 
 
 class ModelProcessor():
-    def __init__(self, es_client):
+    def __init__(self, es_client, namespace=production_namespace, data_dir=data_dir):
+        """
+        namespace: the model namespace. Only the production namespace cycles move the last timestamp.
+        data_dir: the directory for the detected anomalies. The self-diagnostics tests
+        cycle runs concurrently with the real-life cycle, so it uses its own directory.
+        """
         self.es_client = es_client
-        logger.info(f'Initialized ModelProcessor with params: {params}')
+        self.namespace = namespace
+        self.data_dir = data_dir
+        os.makedirs(namespace_dir(self.namespace), exist_ok=True)
+        os.makedirs(self.data_dir, exist_ok=True)
+        logger.info(f'Initialized ModelProcessor with params: {params}, namespace: "{namespace}", data_dir: "{data_dir}"')
 
     def train(self, lock, i, is_test=False):
         """
@@ -212,11 +304,11 @@ class ModelProcessor():
             return
         for job in dynamic_jobs:
             samples = all_samples[job.name if is_test else job.data_type]
-            train_job(job.name, samples, lock)
+            train_job(job.name, samples, lock, self.namespace)
         logger.info(f'STOP {i:,} training {len(dynamic_jobs)} models.')
         return
 
-    def find_anomalies(self, lock, i, is_test):
+    def find_anomalies(self, lock, i, is_test, moves_last_timestamp=True):
         """
         Detects anomalies.
         A lock used to avoid collisions with writing a model file in the train() of a different class instance.
@@ -224,14 +316,21 @@ class ModelProcessor():
         is_test flag is set up for the self-diagnostic mode when we load data not from the ES but from the prepared files.
         i parameter is used to show the detection cycle number. It shows how long the detection works without restarts.
         if is_test==True or i==0, the anomalies are saved in files for analysis.
-        Anomalies also sent as alerts (can be turned off if PH_send_alerts is False).
+        Anomalies also sent as alerts (can be turned off if PH_send_alerts is False). The alerts are enqueued into
+        the alert_outbox, the sender of the scheduler writes them (or sent directly if PH_alert_outbox is False).
+        The tests cycle (is_test==True) and the non-production namespaces do not touch the last timestamp.
+        moves_last_timestamp=False: the production namespace cycle that does not touch the last timestamp either.
+        The self-diagnostics real-life cycle runs concurrently with the scheduled cycles, it does not move their
+        watermarks.
+        The last timestamp (the watermark) of an index is not moved if its job failed (or its model is missing). If its download was truncated,
+        the watermark is moved to the last downloaded document, the next cycle continues from it.
         """
         logger.info(f'START {i:,} searching anomalies with {len(local_jobs)} models.')
         ts = datetime.utcnow()
-        if i == 0: # clean up the last timestamp in the first cycle
-            last_timestamp.remove()
+        moves_last_timestamp = moves_last_timestamp and not is_test and self.namespace == production_namespace
         all_anomalies = []
-        all_samples = self._load_find_anomalies_data(is_test)
+        failed_indices = set()
+        all_samples = self._load_find_anomalies_data(is_test, ts, dedup=moves_last_timestamp)
 
         if any(all_samples.values()):
             for job in local_jobs:
@@ -239,49 +338,104 @@ class ModelProcessor():
                 if not samples:
                     logger.info(f'* STOP {i:,} searching anomalies with {job.model_name} model. No samples - No searching :(')
                     continue
-                all_anomalies += detect(job.name, samples, lock)
+                try:
+                    all_anomalies += detect(job.name, samples, lock, self.namespace, raise_errors=True)
+                except Exception:
+                    failed_indices.add(job.source_log)
             all_anomalies = aggregate_byte_anomalies(all_anomalies)
         else:
             logger.info(f'* STOP {i:,} searching anomalies with {len(local_jobs)} models. No samples - No searching :(')
 
-        last_timestamp.save(ts)
+        if moves_last_timestamp:
+            for index_name in logs:
+                last_timestamp.save(self.truncated.get(index_name, ts), index_name,
+                                    self.scored_keys.get(index_name, ()), advance=index_name not in failed_indices,
+                                    truncated=index_name in self.truncated)
 
         if is_test:
-            _save_data(all_anomalies, self_diagnostics.file_all_detected_anomalies_test, timestamp=False)
+            _save_data(all_anomalies, self_diagnostics.file_all_detected_anomalies_test, timestamp=False,
+                       data_dir=self.data_dir)
         else:  # if params.PH_debug or (i == 0 and not is_test):
-            _save_data(all_anomalies, self_diagnostics.file_all_detected_anomalies, timestamp=False)
+            _save_data(all_anomalies, self_diagnostics.file_all_detected_anomalies, timestamp=False,
+                       data_dir=self.data_dir)
+        try:
+            result_store.save_cycle(self.namespace, i, is_test, ts, (datetime.utcnow() - ts).total_seconds(),
+                                    all_anomalies, failed_indices, self.truncated)
+        except Exception as ex:
+            logger.error(f'  *** Exception: "{str(ex)}". The detection cycle is not saved into the result store.')
         if all_anomalies and params.PH_send_alerts and i:
-            alert_client = alert_api.AlertClient()
-            alert_client.send_alerts(all_anomalies)
+            alerts = alert_suppression.suppress(all_anomalies, self.namespace)
+            if alert_outbox.params.PH_alert_outbox:  # the scheduler sender writes them
+                alert_outbox.enqueue(alerts)
+            else:
+                alert_api.AlertClient().send_alerts(alerts)
         logger.info(f'STOP {i:,} searching anomalies with {len(local_jobs)} models.')
         return all_anomalies
 
     def _load_train_data(self, is_test):
         """
         The output dictionary key is Job.name if is_test else Job.data_type
+        With the log_cache the training window is assembled from the data cached by the detection cycles.
         """
         if is_test:
             return self_diagnostics.load_train_data()
+        elif log_cache.params.PH_log_cache:  # only the windows missed by the detection cycles are downloaded
+            return log_cache.load_window(self.es_client, params.PH_train_start_time, params.PH_train_end_time,
+                                         params.PH_max_docs)
         else:
             return self.es_client.download_and_aggregate_data(start_time=params.PH_train_start_time,
                                                               end_time=params.PH_train_end_time,
                                                               max_docs=params.PH_max_docs)
 
-    def _load_find_anomalies_data(self, is_test):
+    def _load_find_anomalies_data(self, is_test, window_end=None, dedup=True):
         """
         The output dictionary key is Job.name if is_test else Job.data_type
+        Every index is downloaded from its own window: [last timestamp - overlap, window_end).
+        The production namespace skips the already scored documents of the overlap (see last_timestamp.dedup),
+        if dedup is set (the cycle moves the last timestamp).
+        Sets self.truncated: {index_name: the last downloaded document time} of the downloads truncated by the
+        PH_max_docs, the documents are downloaded in the '@timestamp' order,
+        self.scored_keys: {index_name: keys of the scored docs to be saved with the last timestamp}.
+        The downloaded data is put into the log_cache for the training.
         """
+        self.truncated, self.scored_keys = {}, {}
         if is_test:
             return self_diagnostics.load_find_anomalies_data()
-        else:
-            start_time = params.PH_search_start_time if params.PH_search_start_time else last_timestamp.load()
-            return self.es_client.download_and_aggregate_data(start_time=start_time,
-                                                              end_time=params.PH_search_end_time,
-                                                              max_docs=params.PH_max_docs)
+        if params.PH_search_end_time:
+            window_end = log_cache.to_datetime(log_cache.to_epoch(params.PH_search_end_time))
+        window_end = window_end or datetime.utcnow()
+        dedup = dedup and self.namespace == production_namespace and not params.PH_search_start_time
+        data_type2docs = {}
+        for index_name in logs:
+            start_time = params.PH_search_start_time or last_timestamp.window_start(index_name)
+            data = self.es_client.download_and_aggregate_data(start_time=start_time, end_time=window_end,
+                                                              max_docs=params.PH_max_docs, index_name=index_name,
+                                                              with_timestamp=True, sort_by_time=True)
+            docs = data.get(index_name, [])
+            next_watermark = window_end
+            if len(docs) >= params.PH_max_docs:
+                next_watermark = self.truncated[index_name] = last_timestamp.last_doc_time(docs) or window_end
+                logger.warning(f'The "{index_name}" download is truncated by the PH_max_docs: {params.PH_max_docs:,}.'
+                               f' The last timestamp of the index is moved to its last document: {next_watermark}.')
+                if dedup and next_watermark <= start_time:
+                    logger.warning(f'  *** More than PH_max_docs "{index_name}" docs have the same @timestamp, the '
+                                   f'detection does not progress. Increase the PH_max_docs.')
+            new_docs = docs
+            if dedup:
+                new_docs, self.scored_keys[index_name] = last_timestamp.dedup(index_name, docs, next_watermark,
+                                                                              index_name in self.truncated)
+            log_cache.put_downloaded({index_name: docs}, start_time, window_end, params.PH_max_docs)
+            data[index_name] = new_docs
+            if index_name == 'flows' and len(new_docs) < len(docs):  # aggregate only the new flows
+                data.update(elastic_api.aggregate_samples(new_docs))
+            data_type2docs.update(data)
+        return data_type2docs
 
     def str2class(job_name):
         """
         It is a class function.
         Returns a class name symbol.
+        The model module (numpy, pandas, sklearn) is imported here, on the first use, not on the package import.
         """
-        return getattr(sys.modules[__name__], job_name2class_name[job_name])
+        from . import model_generic
+        return getattr(model_generic, job_name2class_name[job_name])
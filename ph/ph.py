@@ -2,19 +2,20 @@
 # import json
 # import argparse
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process, Lock
 import time
 import os
 from collections import namedtuple
 
-from . import model_processor
-from . import elastic_api
-
-from .globals import APP_NAME
+from .globals import APP_NAME, data_dir, production_namespace, diagnostics_namespace
+from . import metrics
+from . import instrumentation
+from . import profiler
 
 import logging
 
-from .self_diagnostics import output_self_diagnostics_report
+from .self_diagnostics import output_self_diagnostics_report, test_data_dir
 
 logging.basicConfig(level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S",
                     format='%(asctime)s : %(levelname)s : %(message)s')
@@ -64,33 +65,76 @@ def validate_env_variables():
     return
 
 
-def train(lock, i, is_test=False):
+def train(lock, i, is_test=False, namespace=production_namespace, data_dir=data_dir):
+    # heavy modules (pandas, sklearn, elasticsearch) are imported only by the processes that use them
+    from . import model_processor, elastic_api
     es_client = elastic_api.ElasticClient()
-    model_proc = model_processor.ModelProcessor(es_client)
-    model_proc.train(lock, i, is_test=is_test)
+    model_proc = model_processor.ModelProcessor(es_client, namespace=namespace, data_dir=data_dir)
+    try:
+        with profiler.armed_profile('train'), \
+                instrumentation.trace(f'train {i} ({namespace}{", test" if is_test else ""})'):
+            model_proc.train(lock, i, is_test=is_test)
+    finally:
+        metrics.record_cycle('train')
 
 
-def find_anomalies(lock, i, is_test=False):
+def find_anomalies(lock, i, is_test=False, namespace=production_namespace, data_dir=data_dir,
+                   moves_last_timestamp=True):
+    from . import model_processor, elastic_api
     es_client = elastic_api.ElasticClient()
-    model_proc = model_processor.ModelProcessor(es_client)
-    model_proc.find_anomalies(lock, i, is_test=is_test)
+    model_proc = model_processor.ModelProcessor(es_client, namespace=namespace, data_dir=data_dir)
+    try:
+        with profiler.armed_profile('detect'), \
+                instrumentation.trace(f'detect {i} ({namespace}{", test" if is_test else ""})'):
+            return model_proc.find_anomalies(lock, i, is_test=is_test, moves_last_timestamp=moves_last_timestamp)
+    finally:
+        metrics.record_cycle('detect')
 
 
-def self_diagnostics(lock, id=0):
-    exc = None
-    # the first self-diagnostics train+detect cycle on the prepared tests datasets
-    train(lock, 0, is_test=True)
-    find_anomalies(lock, 0, is_test=True)
+def _self_diagnostics_tests_cycle():
+    """
+    The self-diagnostics train+detect cycle on the prepared tests datasets.
+    It works with its own model namespace and data directory, so it needs no shared lock.
+    """
+    train(None, 0, is_test=True, namespace=diagnostics_namespace, data_dir=test_data_dir)
+    return find_anomalies(None, 0, is_test=True, namespace=diagnostics_namespace, data_dir=test_data_dir)
 
-    # the second self-diagnostics train+detect cycle on the real-life datasets
-    try:
-        train(lock, 0)
-        find_anomalies(lock, 0)
-    except ConnectionError as ex:
-        # exception must happen when we run self-diagnostics without connection to the ES.
-        # it is OK. We just write this exception in the self-diagnostics report
-        exc = ex
-    output_self_diagnostics_report(exc, id)
+
+def _self_diagnostics_real_life_cycle(lock, namespace):
+    """
+    The self-diagnostics train+detect cycle on the real-life datasets.
+    On the start, it trains the production models, that are used by the detection cycles till the next scheduled
+    training.
+    It runs concurrently with the scheduled detection cycles, so it does not remove or move their last timestamps.
+    """
+    train(lock, 0, namespace=namespace)
+    return find_anomalies(lock, 0, namespace=namespace, moves_last_timestamp=False)
+
+
+def self_diagnostics(lock, id=0, real_life_namespace=production_namespace):
+    """
+    Both self-diagnostics cycles run concurrently. The real-life cycle is mostly waiting for the ES data, so
+    the tests cycle does not make it longer.
+    real_life_namespace: the model namespace of the real-life cycle. The self-diagnostics started by the API
+    uses a non-production namespace, so it never forces a production retrain.
+    A failed cycle does not stop the other one, the report is produced anyway.
+    """
+    exc, test_anomalies, anomalies = None, [], None
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix='self_diagnostics') as executor:
+        tests_cycle = executor.submit(_self_diagnostics_tests_cycle)
+        real_life_cycle = executor.submit(_self_diagnostics_real_life_cycle, lock, real_life_namespace)
+        try:
+            test_anomalies = tests_cycle.result()
+        except Exception as ex:  # no anomalies detected, the tests report shows the failure
+            logger.error(f'  *** Exception: "{str(ex)}". The self-diagnostics tests cycle failed.')
+        try:
+            anomalies = real_life_cycle.result()
+        except Exception as ex:
+            # exception must happen when we run self-diagnostics without connection to the ES.
+            # it is OK. We just write this exception in the self-diagnostics report
+            exc = ex
+    # the report is calculated from the detected anomalies in memory, not from their files
+    output_self_diagnostics_report(exc, id, test_anomalies, anomalies)
 
 
 def start():
@@ -102,6 +146,8 @@ def start():
     The second SD cycle runs on the real data from ES with unknown anomalies.
     The SD is successful if the first cycle detects most of the known anomalies and
     if the second cycle finishes without an exception.
+    The SD runs in a separate process, so the scheduler starts immediately and the SD report is produced
+    asynchronously (see the `test_result.json` file and the `self_diagnostics` history).
     """
     Params = namedtuple('Params', 'PH_train_interval_minutes PH_search_interval_minutes')
     params = Params(
@@ -114,8 +160,14 @@ def start():
 
     validate_env_variables()
 
+    from . import alert_outbox
+    alert_outbox.start_sender()
+
+    from . import last_timestamp
+    last_timestamp.remove()  # clean up the last timestamps before the first cycles
+
     lock = Lock()
-    self_diagnostics(lock)
+    Process(target=self_diagnostics, args=(lock,), name='self_diagnostics').start()
     n, m = 0, 0
     while True:
         cur_minute = int(int(datetime.datetime.utcnow().timestamp()) / 60)
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+
+from .globals import APP_NAME, data_dir
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+A sampling profiler based only on the standard library. A sampler thread takes the stacks of all other threads
+of the process (sys._current_frames()) with a fixed interval and counts them in the collapsed-stack format:
+`thread;frame;frame;... count` lines, ready for the flamegraph tools.
+The train and detection cycles run in the scheduler processes. The API arms the profiling of the next cycle
+with a file in the profiles_dir, the cycle consumes it and saves the collapsed stacks into the profiles_dir
+(the last PH_profiles_number profiles of each target).
+"""
+
+Params = namedtuple('Params', 'PH_profiles_number')
+params = Params(
+    int(os.getenv('PH_profiles_number', 10)),
+)
+
+profiles_dir = f'{data_dir}/profiles'
+cycle_targets = ['train', 'detect']
+default_interval_secs = 0.01
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+class Sampler:
+    def __init__(self, interval=default_interval_secs):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ph-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if names.get(thread_id, '').startswith('ph-profiler'):  # the profiler threads
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def profile(seconds, interval=default_interval_secs):
+    """Samples the stacks of this process for `seconds` seconds. Returns the collapsed stacks."""
+    sampler = Sampler(interval).start()
+    time.sleep(seconds)
+    return sampler.stop().collapsed()
+
+
+def _arm_file(target):
+    return f'{profiles_dir}/arm_{target}.json'
+
+
+def arm(target, seconds, interval=default_interval_secs):
+    """Arms the profiling of the next scheduled cycle: 'train' or 'detect'."""
+    assert target in cycle_targets
+    os.makedirs(profiles_dir, exist_ok=True)
+    with open(f'{_arm_file(target)}.tmp', 'w') as f:
+        json.dump({'seconds': seconds, 'interval': interval, 'armed': datetime.utcnow().isoformat()}, f)
+    os.replace(f'{_arm_file(target)}.tmp', _arm_file(target))
+    logger.info(f'Armed profiling of the next "{target}" cycle for {seconds} seconds.')
+
+
+def _take_arm(target):
+    """Consumes the arm file. Only one process gets it, the rename is atomic."""
+    taken = f'{_arm_file(target)}.{os.getpid()}.{threading.get_ident()}'
+    try:
+        os.rename(_arm_file(target), taken)
+    except OSError:
+        return None
+    try:
+        with open(taken) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+    finally:
+        os.remove(taken)
+
+
+@contextmanager
+def armed_profile(target):
+    """
+    Profiles the block if the API armed the profiling of the target. The profiling stops after the armed number of
+    seconds or at the end of the block. The collapsed stacks are saved into the profiles_dir.
+    """
+    arm_params = _take_arm(target) if os.path.exists(_arm_file(target)) else None
+    if not arm_params:
+        yield
+        return
+    sampler = Sampler(arm_params['interval']).start()
+    timer = threading.Timer(arm_params['seconds'], sampler.stop)
+    timer.name = 'ph-profiler-timer'
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+        sampler.stop()
+        file_name = f'{profiles_dir}/{target}.{datetime.utcnow().strftime("%Y%m%d_%H%M%S")}.collapsed'
+        with open(file_name, 'w') as f:
+            f.write(sampler.collapsed())
+        logger.info(f'Saved the "{target}" profile with {sampler.samples:,} samples into "{file_name}"')
+        # keep only the last profiles
+        for f in _profile_files(target)[:-params.PH_profiles_number]:
+            os.remove(f'{profiles_dir}/{f}')
+
+
+def _profile_files(target):
+    """The collapsed stacks files of the target, the oldest first."""
+    return sorted(f for f in os.listdir(profiles_dir) if f.startswith(f'{target}.') and f.endswith('.collapsed'))
+
+
+def read_profile(target):
+    """Returns the last saved collapsed stacks of the target cycle or None."""
+    if not os.path.isdir(profiles_dir):
+        return None
+    files = _profile_files(target)
+    if not files:
+        return None
+    with open(f'{profiles_dir}/{files[-1]}') as f:
+        return f.read()
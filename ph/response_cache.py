@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import threading
+from collections import namedtuple, OrderedDict
+import logging
+
+from .globals import APP_NAME, job_name2job
+from .log_cache import to_epoch
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+An in-process cache of the /ph/ops/detect responses for the `logs` data_source.
+Dashboards call the detection repeatedly with the same interval, each call downloads the logs and scores them again.
+The cache key is (job, namespace, interval, max_log_records, model version, parameter snapshot, stream chunking):
+  the model version is the modification time of the model files of the jobs, so a retrained model (by the
+    scheduler or the API) makes the old responses unreachable,
+  the parameter snapshot is the current values of the job parameters, so /ph/conf/set_parameters does the same,
+  the stream chunking is the chunk sizes of the streamed response, its confidence is relative to the chunk, so it is
+    not the same as the not streamed response (None) and as the streamed one with other chunk sizes.
+A closed interval (its end is older than the PH_search_overlap_minutes, so no late documents can come) does not
+expire. The interval that includes "now" expires after PH_detect_cache_ttl_seconds.
+The entries are evicted in the LRU order when the cache exceeds the PH_detect_cache_max_entries entries or the
+PH_detect_cache_max_mb size of the JSON-serialized responses.
+"""
+
+Params = namedtuple('Params', 'PH_detect_cache PH_detect_cache_ttl_seconds PH_detect_cache_max_entries '
+                              'PH_detect_cache_max_mb')
+params = Params(
+    eval(os.getenv('PH_detect_cache', 'True')),
+    int(os.getenv('PH_detect_cache_ttl_seconds', 30)),
+    int(os.getenv('PH_detect_cache_max_entries', 256)),
+    int(os.getenv('PH_detect_cache_max_mb', 64)),
+)
+logger.info('Initialized params for the response_cache.py: ' + ', '.join(
+    [f'{n}: {el}' for el, n in zip(params, params._fields)]))
+
+_entries = OrderedDict()  # {key: (expires_at or None, size, anomalies)}
+_cache_lock = threading.Lock()
+_size = 0
+
+
+def model_version(job_names, namespace):
+    """The modification times of the model files of the dynamic jobs, None for a missing model."""
+    from .model_processor import namespace_dir
+
+    version = []
+    for job_name in job_names:
+        if job_name2job[job_name].dynamic_model:
+            file_name = f'{namespace_dir(namespace)}/{job_name}.model'
+            version.append(os.stat(file_name).st_mtime_ns if os.path.isfile(file_name) else None)
+    return tuple(version)
+
+
+def parameter_snapshot(job_names):
+    return tuple((param, os.getenv(param, str(val)))
+                 for job_name in job_names for param, val in sorted(job_name2job[job_name].params.items()))
+
+
+def make_key(job_name, namespace, start, end, max_docs, stream_chunking=None):
+    job_names = list(job_name2job) if job_name == 'all' else [job_name]
+    return (job_name, namespace, to_epoch(start), to_epoch(end), max_docs,
+            model_version(job_names, namespace), parameter_snapshot(job_names), stream_chunking)
+
+
+def ttl(end, now=None):
+    """None (no expiration) for a closed interval, PH_detect_cache_ttl_seconds for an interval including "now"."""
+    from .last_timestamp import params as search_params
+
+    now = now or time.time()
+    if end is not None and to_epoch(end) <= now - search_params.PH_search_overlap_minutes * 60:
+        return None
+    return params.PH_detect_cache_ttl_seconds
+
+
+def get(key):
+    """Returns the cached anomalies or None."""
+    global _size
+    if not params.PH_detect_cache:
+        return None
+    with _cache_lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, anomalies = entry
+        if expires_at is not None and expires_at <= time.time():
+            del _entries[key]
+            _size -= size
+            return None
+        _entries.move_to_end(key)
+        return anomalies
+
+
+def put(key, anomalies, end):
+    """Caches the anomalies of the interval with the `end`. A response larger than the cache is not cached."""
+    global _size
+    if not params.PH_detect_cache:
+        return
+    size = len(json.dumps(anomalies, default=str))
+    max_size = params.PH_detect_cache_max_mb * 2 ** 20
+    if size > max_size:
+        return
+    seconds = ttl(end)
+    with _cache_lock:
+        if key in _entries:
+            _size -= _entries.pop(key)[1]
+        _entries[key] = (None if seconds is None else time.time() + seconds, size, anomalies)
+        _size += size
+        while len(_entries) > params.PH_detect_cache_max_entries or _size > max_size:
+            _, (_, evicted_size, _) = _entries.popitem(last=False)
+            _size -= evicted_size
+
+
+def clear():
+    global _size
+    with _cache_lock:
+        _entries.clear()
+        _size = 0
@@ -0,0 +1,196 @@
+import os
+import json
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+import logging
+
+from .globals import APP_NAME, data_dir, jobs
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+An embedded SQLite store of the results: the self-diagnostics history, the detection cycle summaries and
+the detected anomalies. The API browses them page by page with indexed queries, without loading the files.
+The database is in the WAL mode: the scheduler processes write, the API process reads concurrently, the readers
+never wait for the writer. Each process (and thread) has its own connection.
+The times are UTC ISO strings, so they are ordered as strings. The anomaly `time` is the time of the anomaly record
+('start_time'), the `detected` is the time of the detection cycle.
+The anomaly `namespace` and `service` are the values of the group fields of its job: the first present
+'*namespace' field and the first present '*service_name' or '*name_aggr' field.
+The pages are ordered by the time, the newest first. A page returns the `cursor` of the next page.
+The records older than PH_result_store_retention_days are removed when a cycle is saved.
+"""
+
+Params = namedtuple('Params', 'PH_result_store PH_result_store_retention_days')
+params = Params(
+    eval(os.getenv('PH_result_store', 'True')),
+    int(os.getenv('PH_result_store_retention_days', 30)),
+)
+
+db_file_name = f'{data_dir}/results.sqlite'
+max_page_size = 1000
+
+_schema = """
+CREATE TABLE IF NOT EXISTS history (
+    id TEXT PRIMARY KEY, op TEXT NOT NULL, time TEXT NOT NULL, job TEXT, result TEXT);
+CREATE INDEX IF NOT EXISTS history_op_time ON history (op, time);
+CREATE TABLE IF NOT EXISTS cycles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, time TEXT NOT NULL, namespace TEXT NOT NULL, cycle INTEGER,
+    is_test INTEGER, anomalies INTEGER, duration_secs REAL, failed_indices TEXT, truncated_indices TEXT);
+CREATE INDEX IF NOT EXISTS cycles_time ON cycles (time);
+CREATE INDEX IF NOT EXISTS cycles_namespace_time ON cycles (namespace, time);
+CREATE TABLE IF NOT EXISTS anomalies (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, cycle_id INTEGER REFERENCES cycles (id), time TEXT NOT NULL,
+    detected TEXT NOT NULL, job TEXT NOT NULL, model_namespace TEXT NOT NULL, namespace TEXT, service TEXT,
+    description TEXT, record TEXT);
+CREATE INDEX IF NOT EXISTS anomalies_time ON anomalies (time);
+CREATE INDEX IF NOT EXISTS anomalies_job_time ON anomalies (job, time);
+CREATE INDEX IF NOT EXISTS anomalies_namespace_time ON anomalies (namespace, time);
+CREATE INDEX IF NOT EXISTS anomalies_service_time ON anomalies (service, time);
+CREATE INDEX IF NOT EXISTS anomalies_cycle ON anomalies (cycle_id);
+CREATE INDEX IF NOT EXISTS anomalies_detected ON anomalies (detected);
+"""
+
+# the filter fields of the tables, they are indexed
+filters = {
+    'history': ['op', 'job'],
+    'cycles': ['namespace'],
+    'anomalies': ['job', 'model_namespace', 'namespace', 'service', 'cycle_id'],
+}
+
+# {job name: (the namespace fields, the service fields)} of the anomaly records, in the order of the preference
+_record_fields = {job.name: ([f for f in job.group_fields if f.endswith('namespace')],
+                             [f for suffix in ['service_name', 'name_aggr'] for f in job.group_fields
+                              if f.endswith(suffix)])
+                  for job in jobs()}
+
+_local = threading.local()
+
+
+def _connection():
+    """The connection of this thread. A forked process opens its own connection."""
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and _local.pid == os.getpid() and _local.file_name == db_file_name:
+        return connection
+    os.makedirs(os.path.dirname(db_file_name), exist_ok=True)
+    connection = sqlite3.connect(db_file_name, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(_schema)
+    _local.connection, _local.pid, _local.file_name = connection, os.getpid(), db_file_name
+    return connection
+
+
+def _iso(t):
+    if t is None:
+        return None
+    if isinstance(t, (int, float)):
+        return datetime.fromtimestamp(t, timezone.utc).replace(tzinfo=None).isoformat()
+    if isinstance(t, datetime):
+        return (t.astimezone(timezone.utc).replace(tzinfo=None) if t.tzinfo else t).isoformat()
+    return datetime.fromisoformat(str(t).replace('Z', '+00:00')).replace(tzinfo=None).isoformat()
+
+
+def _json(obj):
+    return json.dumps(obj, default=lambda o: o.item() if hasattr(o, 'item') else str(o))
+
+
+def save_history(op, job, js, id, time=None):
+    if not params.PH_result_store:
+        return
+    with _connection() as connection:
+        connection.execute('INSERT OR REPLACE INTO history (id, op, time, job, result) VALUES (?, ?, ?, ?, ?)',
+                           (id, op, _iso(time or datetime.utcnow()), job, _json(js)))
+
+
+def _anomaly_row(cycle_id, detected, namespace, alert):
+    record = alert['record'] if isinstance(alert['record'], dict) else {}
+    start_time = record.get('start_time')
+    try:
+        time = _iso(start_time) if start_time is not None else detected
+    except (TypeError, ValueError, OverflowError):
+        time = detected
+    job_name = alert['alert'].split('.')[1]
+    namespace_fields, service_fields = _record_fields.get(job_name, ([], []))
+    return (cycle_id, time, detected, job_name, namespace,
+            next((record[f] for f in namespace_fields if record.get(f)), None),
+            next((record[f] for f in service_fields if record.get(f)), None),
+            alert.get('description'), _json(alert['record']))
+
+
+def save_cycle(namespace, cycle, is_test, time, duration_secs, anomalies, failed_indices=(), truncated_indices=()):
+    """
+    Saves the summary and the anomalies (alerts) of the detection cycle in one transaction.
+    Returns: the cycle id.
+    """
+    if not params.PH_result_store:
+        return None
+    detected = _iso(time)
+    with _connection() as connection:
+        cycle_id = connection.execute(
+            'INSERT INTO cycles (time, namespace, cycle, is_test, anomalies, duration_secs, failed_indices, '
+            'truncated_indices) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (detected, namespace, cycle, int(is_test), len(anomalies), duration_secs,
+             _json(sorted(failed_indices)), _json(sorted(truncated_indices)))).lastrowid
+        connection.executemany(
+            'INSERT INTO anomalies (cycle_id, time, detected, job, model_namespace, namespace, service, description, '
+            'record) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [_anomaly_row(cycle_id, detected, namespace, a) for a in anomalies])
+    logger.info(f'Saved the detection cycle {cycle_id} with {len(anomalies):,} anomalies into "{db_file_name}".')
+    evict()
+    return cycle_id
+
+
+def evict(now=None):
+    """Removes the records older than the retention."""
+    cutoff = ((now or datetime.utcnow()) - timedelta(days=params.PH_result_store_retention_days)).isoformat()
+    with _connection() as connection:
+        removed = sum(connection.execute(f'DELETE FROM {table} WHERE {field} < ?', (cutoff,)).rowcount
+                      for table, field in [('anomalies', 'detected'), ('cycles', 'time'), ('history', 'time')])
+    if removed:
+        logger.info(f'Removed {removed:,} results older than {cutoff}.')
+
+
+def page(table, start=None, end=None, limit=100, cursor=None, **filter_values):
+    """
+    Returns a page of the table records: {'items': [...], 'cursor': the cursor of the next page or None}.
+    The records are in the [start, end) time interval, the newest first. filter_values: the `filters` of the table,
+    None values are not used.
+    Raises ValueError if the cursor is not a cursor of a page.
+    """
+    assert table in filters
+    limit = max(1, min(limit, max_page_size))
+    where, args = [], []
+    for name, value in filter_values.items():
+        assert name in filters[table], name
+        if value is not None:
+            where.append(f'{name} = ?')
+            args.append(value)
+    if start is not None:
+        where.append('time >= ?')
+        args.append(_iso(start))
+    if end is not None:
+        where.append('time < ?')
+        args.append(_iso(end))
+    if cursor:
+        time, _, rowid = cursor.rpartition('|')
+        if not time or not rowid.isdigit():
+            raise ValueError(f'*** Error: wrong cursor "{cursor}". Use the `cursor` of the previous page.')
+        where.append('(time < ? OR (time = ? AND rowid < ?))')
+        args += [time, time, int(rowid)]
+    sql = (f'SELECT rowid AS _rowid, * FROM {table} {"WHERE " + " AND ".join(where) if where else ""} '
+           f'ORDER BY time DESC, rowid DESC LIMIT ?')
+    rows = _connection().execute(sql, args + [limit + 1]).fetchall()
+    items = []
+    for row in rows[:limit]:
+        item = dict(row)
+        item.pop('_rowid')
+        for field in ['result', 'record', 'failed_indices', 'truncated_indices']:
+            if item.get(field) is not None:
+                item[field] = json.loads(item[field])
+        items.append(item)
+    next_cursor = f'{rows[limit - 1]["time"]}|{rows[limit - 1]["_rowid"]}' if len(rows) > limit else None
+    return {'items': items, 'cursor': next_cursor}
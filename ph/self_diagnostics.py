@@ -1,19 +1,23 @@
 import os
 import json
 from collections import defaultdict, Counter
-import pandas as pd
 
 from .globals import jobs
 
 import logging
 from .globals import APP_NAME, data_dir
 from .history_storage import save_json_in_line
+from . import result_store
+from . import dataset_cache
 
 logger = logging.getLogger(APP_NAME)
 
 file_all_detected_anomalies_test = 'all_anomalies_test'
 file_all_detected_anomalies = 'all_anomalies'
 file_test_result = 'test_result.json'
+# the tests cycle runs concurrently with the real-life cycle. It keeps its anomalies in this sub-folder,
+# and its models in the `diagnostics` model namespace, so it never replaces the production models.
+test_data_dir = f'{data_dir}/self_diagnostics'
 
 local_jobs = jobs()
 
@@ -21,11 +25,9 @@ local_jobs = jobs()
 def _load_test_datasets():
     """
     Loads all *.test_dataset.csv datasets.
-    It removes the 'anomaly' column when loads.
+    It removes the 'anomaly' column when loads. The datasets are parsed once per process (see dataset_cache).
     """
-    return {job.name: pd.read_csv(f'{data_dir}/{job.name}.test_dataset.csv',
-                                  usecols=lambda col: col != 'anomaly', low_memory=False).to_dict('records')
-            for job in local_jobs}
+    return {job.name: dataset_cache.records(job.name) for job in local_jobs}
 
 
 load_train_data = _load_test_datasets
@@ -51,15 +53,18 @@ def _report_job_statistics(dct_test, dct_detected, verbose=False):
     the whole self diagnostics).
     dct_test: anomalies found in the test datasets.
     dct_test: anomalies found in the real data.
-    dct_x = {'job_name': [{k: anomaly}, ...], ...}
+    dct_x = {'job_name': DataFrame of the anomaly records with the 'key' column (see dataset_cache.label_keys)}
+    The TP, FP, FN are counted with the outer merge of the unique keys.
     """
 
     def dga_test_domains(test_anomalies):
-        return {an['qname']: an['qname'] for an in test_anomalies.values()}
+        return test_anomalies.assign(key=test_anomalies['qname'])
 
     def dga_detected_domains(detected_anomalies):
-        return {d: d for an in detected_anomalies.values()
-                for d in an['domains'].split(',')}
+        return detected_anomalies.assign(key=detected_anomalies['domains'].str.split(',')).explode('key')
+
+    def samples(df, keys, is_in):
+        return df[df['key'].isin(keys) == is_in].drop(columns='key').to_dict('records')
 
     # jobs with detected anomalies are subsets of the jobs from the tests datasets
     for detected_job_name in dct_detected:
@@ -75,20 +80,17 @@ def _report_job_statistics(dct_test, dct_detected, verbose=False):
             # restore aggregated anomalies. They are aggregated for 'dga'.
             test_anomalies = dga_test_domains(test_anomalies)
             detected_anomalies = dga_detected_domains(detected_anomalies)
+        test_anomalies = test_anomalies.drop_duplicates('key', keep='last')
+        detected_anomalies = detected_anomalies.drop_duplicates('key', keep='last')
 
         res = {'name': job_name}
-
-        TP_samples = [v for k, v in detected_anomalies.items() if k in test_anomalies]
-        TP = len(TP_samples)
-        if verbose: res['TP_samples'] = TP_samples
-
-        FN_samples = [v for k, v in test_anomalies.items() if k not in detected_anomalies]
-        FN = len(FN_samples)
-        if verbose: res['FN_samples'] = FN_samples
-
-        FP_samples = [v for k, v in detected_anomalies.items() if k not in test_anomalies]
-        FP = len(FP_samples)
-        if verbose: res['FP_samples'] = FP_samples
+        merged = test_anomalies[['key']].merge(detected_anomalies[['key']], on='key', how='outer', indicator=True)
+        counts = merged['_merge'].value_counts()
+        TP, FN, FP = [int(counts.get(k, 0)) for k in ['both', 'left_only', 'right_only']]
+        if verbose:
+            res['TP_samples'] = samples(detected_anomalies, test_anomalies['key'], True)
+            res['FN_samples'] = samples(test_anomalies, detected_anomalies['key'], False)
+            res['FP_samples'] = samples(detected_anomalies, test_anomalies['key'], False)
 
         res['statistics'] = {
             'TP - Correctly detected': TP,
@@ -105,52 +107,44 @@ def _report_job_statistics(dct_test, dct_detected, verbose=False):
     return result
 
 
-def output_self_diagnostics_report(exc, id):
+def _detected_anomalies(anomalies):
+    """The detected anomalies (alerts) -> {'job_name': DataFrame of the anomaly records with the 'key' column}"""
+    import pandas as pd
+    from .model_processor import _record
+
+    job2group_fields = {job.name: job.group_fields for job in local_jobs}
+    job2records = defaultdict(list)
+    for a in anomalies:
+        job_name = a['alert'].split('.')[1]
+        assert job_name in job2group_fields
+        job2records[job_name].append(_record(a))
+    return {job_name: df.assign(key=dataset_cache.label_keys(df, job2group_fields[job_name]))
+            for job_name, df in ((j, pd.DataFrame(records)) for j, records in job2records.items())}
+
+
+def output_self_diagnostics_report(exc, id, test_anomalies=None, anomalies=None):
     """
     if exc is None, the preliminary train+detect cycle on the real-life datasets was successful;
-    main.find_anomalies() with i=0 and is_test=True saves anomalies in two files:
-    The first one is for the tests dataset, the second one is for the real-life dataset.
+    test_anomalies, anomalies: the anomalies detected by the tests cycle and by the real-life cycle.
+    If they are None, they are read from the files, main.find_anomalies() with i=0 saves anomalies in two files:
+    The first one is for the tests dataset (in the test_data_dir), the second one is for the real-life dataset.
     !!! if exc is not None: raises an exception with the self-diagnostics report as an exception message.
     """
-    # a patch for the port_scan and ip_sweep .test_dataset.csv formats
-    def apply_format_start_time(start_time):
-        return int(pd.to_datetime(start_time).timestamp()) if type(start_time) == str and start_time.count(
-            ':') else start_time
-
-    # read all tests datasets and select all anomalies (labels):
-    test_anomalies = {}
-    for job in local_jobs:
-        df = pd.read_csv(f'{data_dir}/{job.name}.test_dataset.csv')
-        if job.name in ['port_scan', 'ip_sweep']:
-            # these jobs keep the 'start_time' in different format, so we transform it to default format.
-            df['start_time'] = df['start_time'].apply(apply_format_start_time)
-        test_anomalies[job.name] = [{k: v for k, v in a.items() if k != 'anomaly'} for a in
-                                    df[df['anomaly'] != 0].to_dict('records')]
-        test_anomalies[job.name] = {'^'.join([str(v) for k, v in row.items() if k in job.group_fields]): row
-                                    for row in test_anomalies[job.name]}
-
-    # read file_all_detected_anomalies_test
-    job_names = [job.name for job in local_jobs]
-    group_fields = {job.name: job.group_fields for job in local_jobs}
-    all_detected_anomalies_test = pd.read_csv(f'{data_dir}/{file_all_detected_anomalies_test}.csv').to_dict('records')
-    out = defaultdict(list)
-    for a in all_detected_anomalies_test:
-        j_name = a['alert'].split('.')[1]
-        assert j_name in job_names
-        out[j_name].append(eval(a['record'].replace('nan', 'None')))
-    detected_test_anomalies = {}
-    for k, v in out.items():
-        assert k in group_fields
-        detected_test_anomalies[k] = {'^'.join([str(vvv) for kkk, vvv in vv.items() if kkk in group_fields[k]]): vv for
-                                      vv in v}
+    import pandas as pd
+
+    # all anomalies (labels) of the tests datasets:
+    labeled_anomalies = {job.name: dataset_cache.load(job.name).labeled for job in local_jobs}
+
+    if test_anomalies is None:
+        test_anomalies = pd.read_csv(f'{test_data_dir}/{file_all_detected_anomalies_test}.csv').to_dict('records')
 
     # generate tests report:
-    test_report = _report_job_statistics(test_anomalies, detected_test_anomalies, verbose=False)
+    test_report = _report_job_statistics(labeled_anomalies, _detected_anomalies(test_anomalies), verbose=False)
 
     # read file_all_detected_anomalies. They are in the form of alerts!
-    all_detected_anomalies = []
+    all_detected_anomalies = anomalies or []
     file_all_detected_anomalies_file_name = f'{data_dir}/{file_all_detected_anomalies}.csv'
-    if os.path.isfile(file_all_detected_anomalies_file_name):
+    if anomalies is None and os.path.isfile(file_all_detected_anomalies_file_name):
         all_detected_anomalies = pd.read_csv(file_all_detected_anomalies_file_name).to_dict('records')
 
     # check if all jobs found some anomalies
@@ -180,7 +174,8 @@ def output_self_diagnostics_report(exc, id):
         json.dump(total_result, f)
         logger.info(f'Saved test result into "{file_test_result_path}"')
     logger.info(f'Self Diagnostics: {total_result}')
-    save_json_in_line('self_diagnostics', job='all', js=total_result, id=id)
+    id = save_json_in_line('self_diagnostics', job='all', js=total_result, id=id)
+    result_store.save_history('self_diagnostics', job='all', js=total_result, id=id)
     if exc:
         raise Exception(json.dumps(total_result))
     return total_result
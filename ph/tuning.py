@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import logging
+
+from .globals import APP_NAME, data_dir, job_name2job
+
+logger = logging.getLogger(APP_NAME)
+
+"""
+The hyperparameter search of a job model on its labeled test dataset.
+  > python -m ph tune --job l7_latency --mode random --trials 20 --space '{"PH_L7Latency_IsolationForest_n_estimators": [50, 100, 200]}'
+The search space is {param: [candidate values]} over the Job.params. Without the space, it is a few values around
+the defaults of the params. The `grid` mode tries all combinations, the `random` mode tries `trials` random
+combinations (without repeats).
+A trial trains the model with the trial params and detects the anomalies in the same dataset, as the self-diagnostics
+tests cycle does, and it is evaluated with the self-diagnostics F1 (see self_diagnostics._report_job_statistics).
+The trials run in a pool of the spawned processes. The dataset is shared with the workers through one shared memory
+block: the numeric columns as they are, the string columns as the integer codes. It saves the pickling of the
+dataset for every worker, but the models take the samples as records, so each worker rebuilds the DataFrame from
+the block and converts it into its own copy of the samples once.
+The finished trials are checkpointed in the `<run>.jsonl` file of the checkpoint_dir, the run name is the hash of
+the search: the trials, the test dataset version and the values of the not searched job params, so the interrupted
+search resumes with the not finished trials and a changed dataset or param starts a new run.
+Returns the table of the trials ranked by the F1 (then by the fit+score time):
+  [{'rank', 'params', 'F1', 'precision', 'recall', 'anomalies', 'fit_secs', 'score_secs'}]
+"""
+
+Params = namedtuple('Params', 'PH_tune_workers PH_tune_trials')
+params = Params(
+    int(os.getenv('PH_tune_workers', min(4, os.cpu_count() or 1))),
+    int(os.getenv('PH_tune_trials', 20)),
+)
+
+checkpoint_dir = f'{data_dir}/tuning'
+
+_worker_dataset = None  # the Dataset of the worker process
+
+
+def default_space(job_name):
+    """A few values around the default values of the job params."""
+    space = {}
+    for param, value in job_name2job[job_name].params.items():
+        if isinstance(value, int):
+            space[param] = sorted({max(1, value // 2), value, value * 2})
+        else:
+            space[param] = sorted({round(value * f, 6) for f in (0.98, 1, 1.02)})
+    return space
+
+
+def candidates(space, mode='grid', trials=params.PH_tune_trials, seed=0):
+    """The list of the trial params: {param: value}."""
+    grid = [dict(zip(space, values)) for values in itertools.product(*space.values())]
+    if mode == 'random' and trials < len(grid):
+        grid = random.Random(seed).sample(grid, trials)
+    return grid
+
+
+def _share(df):
+    """
+    Copies the DataFrame columns into one shared memory block.
+    Returns: (the shared memory, the columns spec: [(name, dtype, offset, categories or None)], the number of rows)
+    """
+    import numpy as np
+    import pandas as pd
+
+    arrays, spec, offset = [], [], 0
+    for name in df.columns:
+        values, categories = df[name].to_numpy(), None
+        if values.dtype == object:
+            codes, categories = pd.factorize(df[name], use_na_sentinel=True)
+            values, categories = codes.astype(np.int64), list(categories)
+        offset = (offset + 7) // 8 * 8
+        arrays.append((values, offset))
+        spec.append((name, values.dtype.str, offset, categories))
+        offset += values.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for values, start in arrays:
+        np.ndarray(values.shape, values.dtype, buffer=shm.buf, offset=start)[:] = values
+    return shm, spec, len(df)
+
+
+def _attach(shm_name, spec, rows):
+    """Rebuilds the DataFrame shared with _share()."""
+    import numpy as np
+    import pandas as pd
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    columns = {}
+    for name, dtype, offset, categories in spec:
+        values = np.ndarray((rows,), np.dtype(dtype), buffer=shm.buf, offset=offset)
+        if categories is not None:  # -1 is the missed value
+            values = np.append(np.array(categories, dtype=object), [None])[values]
+        columns[name] = values.copy()
+    shm.close()
+    return pd.DataFrame(columns)
+
+
+def _init_worker(job_name, shm_name, spec, rows):
+    global _worker_dataset
+    from . import dataset_cache
+
+    _worker_dataset = dataset_cache.make_dataset(job_name, _attach(shm_name, spec, rows))
+
+
+def trial(job_name, trial_params):
+    """
+    Trains and evaluates the model with the trial params. It runs in a worker process.
+    Returns: the trial row of the table (without the rank).
+    """
+    from .model_processor import ModelProcessor
+    from .self_diagnostics import _detected_anomalies, _report_job_statistics
+
+    os.environ.update({param: str(value) for param, value in trial_params.items()})
+    model_cls = ModelProcessor.str2class(job_name)()
+    start = time.perf_counter()
+    model, aggregators = model_cls.train(_worker_dataset.records)
+    fitted = time.perf_counter()
+    alerts = model_cls.find_anomalies(model, _worker_dataset.records, aggregators)
+    scored = time.perf_counter()
+    report = _report_job_statistics({job_name: _worker_dataset.labeled}, _detected_anomalies(alerts))
+    statistics = report['jobs'][0]['statistics'] if report['jobs'] else {}
+    return {'params': trial_params, 'F1': statistics.get('F1', 0.), 'precision': statistics.get('precision', 0.),
+            'recall': statistics.get('recall', 0.), 'anomalies': len(alerts),
+            'fit_secs': round(fitted - start, 3), 'score_secs': round(scored - fitted, 3)}
+
+
+def _run_name(job_name, space, trials):
+    from . import dataset_cache
+
+    fixed = {param: os.getenv(param, str(value)) for param, value in job_name2job[job_name].params.items()
+             if param not in space}
+    key = json.dumps([job_name, trials, fixed, list(dataset_cache._version(job_name))], sort_keys=True)
+    return f'{job_name}_{hashlib.blake2b(key.encode(), digest_size=8).hexdigest()}'
+
+
+def _load_checkpoint(file_name):
+    if not os.path.isfile(file_name):
+        return []
+    with open(file_name) as f:
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+
+def rank(rows):
+    rows = sorted(rows, key=lambda r: (-r['F1'], r['fit_secs'] + r['score_secs']))
+    return [{'rank': i + 1, **r} for i, r in enumerate(rows)]
+
+
+def tune(job_name, space=None, mode='grid', trials=params.PH_tune_trials, workers=params.PH_tune_workers, seed=0,
+         restart=False, progress=None):
+    """
+    Runs the search. progress: a callback(done, total), called after each finished trial.
+    Returns: the ranked table of the trials.
+    """
+    from . import dataset_cache
+
+    space = space or default_space(job_name)
+    unknown = set(space) - set(job_name2job[job_name].params)
+    if unknown:
+        raise ValueError(f"The '{job_name}' job has no {sorted(unknown)} params.")
+    trial_params = candidates(space, mode, trials, seed)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoint_file = f'{checkpoint_dir}/{_run_name(job_name, space, trial_params)}.jsonl'
+    if restart and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    rows = _load_checkpoint(checkpoint_file)
+    done = {json.dumps(r['params'], sort_keys=True) for r in rows}
+    todo = [p for p in trial_params if json.dumps(p, sort_keys=True) not in done]
+    logger.info(f"Tuning '{job_name}': {len(trial_params):,} trials, {len(todo):,} to run with {workers} workers.")
+
+    if todo:
+        shm, spec, n = _share(dataset_cache.load(job_name).df)
+        try:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(min(workers, len(todo)), mp_context=context, initializer=_init_worker,
+                                     initargs=(job_name, shm.name, spec, n)) as executor, \
+                    open(checkpoint_file, 'a') as f:
+                futures = [executor.submit(trial, job_name, p) for p in todo]
+                for future in as_completed(futures):
+                    row = future.result()
+                    f.write(json.dumps(row) + '\n')
+                    f.flush()
+                    rows.append(row)
+                    logger.info(f"  Trial {len(rows):,}/{len(trial_params):,} of '{job_name}': {row}")
+                    if progress:
+                        progress(len(rows), len(trial_params))
+        finally:
+            shm.close()
+            shm.unlink()
+    return rank(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ph tune',
+                                     description='Searches the job params on the labeled test dataset.')
+    parser.add_argument('--job', required=True, choices=sorted(job_name2job))
+    parser.add_argument('--space', default=None, help='JSON {param: [values]}. Default: around the defaults.')
+    parser.add_argument('--mode', choices=['grid', 'random'], default='grid')
+    parser.add_argument('--trials', type=int, default=params.PH_tune_trials, help='The trials of the random mode.')
+    parser.add_argument('--workers', type=int, default=params.PH_tune_workers)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of the previous run.')
+    args = parser.parse_args(argv)
+
+    table = tune(args.job, json.loads(args.space) if args.space else None, args.mode, args.trials, args.workers,
+                 args.seed, args.restart)
+    print(f'{"rank":>4}  {"F1":>5}  {"precision":>9}  {"recall":>6}  {"fit_secs":>8}  {"score_secs":>10}  params')
+    for r in table:
+        print(f'{r["rank"]:>4}  {r["F1"]:>5}  {r["precision"]:>9}  {r["recall"]:>6}  {r["fit_secs"]:>8}  '
+              f'{r["score_secs"]:>10}  {json.dumps(r["params"])}')
+    return 0
@@ -1,6 +1,7 @@
 from datetime import datetime
 
-from ph.alert_api import unify_time_format, remove_fields
+from ph import alert_api
+from ph.alert_api import unify_time_format, unify_time_formats, remove_fields
 
 
 def test_unify_time_format():
@@ -25,6 +26,21 @@ def test_unify_time_format():
     assert len(tests) == len(set([a['record']['end_time'] for a in alerts]))
 
 
+def test_unify_time_formats():
+    times = ['2020-12-21 08:25:00', '2021-02-03 08:10:00.12', '2021-03-22T16:34:16.228614279Z',
+             '2021-03-22T16:38:45.228614279', '2021-03-22T16:38:45']
+    # the same values as the strptime parsing of the formats
+    expected = [int(datetime.strptime(t.replace('T', ' ').replace('Z', '')[:19], '%Y-%m-%d %H:%M:%S').timestamp())
+                for t in times]
+    failures = alert_api.time_format_failures['end_time']
+    alerts = unify_time_formats([{'record': {'start_time': t, 'end_time': 'not datetime'}} for t in times] +
+                                [{'record': {'start_time': 1615431612}}, {'no_record': 1}], ['start_time', 'end_time'])
+    assert [a['record']['start_time'] for a in alerts[:-1]] == expected + [1615431612]
+    assert alert_api.time_format_failures['end_time'] - failures == len(times)
+    assert alert_api.parse_time('2021-03-22T16:38:45+02:00') == 1616423925
+    assert alert_api.parse_time('22/03/2021') is None
+
+
 def test_remove_fields():
     # ((alert, removed_fields), expected_result)
     tests = [
@@ -0,0 +1,88 @@
+import pytest
+
+from ph import alert_outbox, metrics
+from ph.elastic_api import AlertsNotWritten
+
+
+@pytest.fixture(autouse=True)
+def db_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(alert_outbox, 'db_file_name', str(tmp_path / 'alert_outbox.sqlite'))
+
+
+class FakeAlertClient:
+    def __init__(self, failures=0, failed_services=()):
+        """failed_services: the alerts of these services are never written, the others are written."""
+        self.failures = failures
+        self.failed_services = failed_services
+        self.batches = []
+
+    def send_alerts_in_bulk(self, alerts, ids=None, chunk_size=500):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('the events index is not available')
+        failed_ids = [i for a, i in zip(alerts, ids) if a['record']['dest_service_name'] in self.failed_services]
+        self.batches.append(([a for a, i in zip(alerts, ids) if i not in failed_ids], ids))
+        if failed_ids:
+            raise AlertsNotWritten('mapping error', failed_ids)
+        return len(alerts), 0
+
+
+def _alert(i):
+    return {'type': 'alert', 'alert': 'anomaly_detection.l7_latency', 'severity': 100,
+            'record': {'start_time': 1610736000 + i, 'dest_service_name': f'service-{i}'}, 'time': 1}
+
+
+def test_enqueue_and_drain(monkeypatch):
+    monkeypatch.setattr(alert_outbox, 'params', alert_outbox.params._replace(PH_alert_outbox_batch_size=2))
+    now = 1610736000
+    assert alert_outbox.enqueue([_alert(i) for i in range(5)], now=now) == 5
+    assert alert_outbox.enqueue([_alert(0)], now=now) == 0  # the same alert is not enqueued twice
+    assert alert_outbox.depth()[0] == 5
+
+    # the failed batch is retried after the backoff, the alerts are kept
+    client = FakeAlertClient(failures=1)
+    assert alert_outbox.drain(client, now=now) == 0
+    assert alert_outbox.depth()[0] == 5
+    assert alert_outbox.drain(client, now=now + 1) == 3  # the failed batch is not due yet
+    assert alert_outbox.drain(client, now=now + alert_outbox._backoff(0)) == 2
+    assert alert_outbox.depth()[0] == 0
+    assert [len(alerts) for alerts, _ in client.batches] == [2, 1, 2]
+    sent = [a['record']['dest_service_name'] for alerts, _ in client.batches for a in alerts]
+    assert sorted(sent) == [f'service-{i}' for i in range(5)]
+
+
+def test_bounded_queue(monkeypatch):
+    monkeypatch.setattr(alert_outbox, 'params', alert_outbox.params._replace(PH_alert_outbox_max_alerts=3))
+    alert_outbox.enqueue([_alert(i) for i in range(5)])
+    client = FakeAlertClient()
+    assert alert_outbox.drain(client) == 3
+    assert [a['record']['dest_service_name'] for a in client.batches[0][0]] == ['service-2', 'service-3', 'service-4']
+
+
+def test_partially_written_batch(monkeypatch):
+    """The written alerts of a failed batch are removed, the failed alerts are moved into the dead letters."""
+    monkeypatch.setattr(alert_outbox, 'params', alert_outbox.params._replace(PH_alert_outbox_max_attempts=2))
+    now = 1610736000
+    alert_outbox.enqueue([_alert(i) for i in range(3)], now=now)
+    client = FakeAlertClient(failed_services=['service-1'])
+    assert alert_outbox.drain(client, now=now) == 2
+    assert alert_outbox.depth()[0] == 1
+    assert alert_outbox.drain(client, now=now + alert_outbox._backoff(0)) == 0
+    assert alert_outbox.depth()[0] == 0
+    assert [a['record']['dest_service_name'] for a in alert_outbox.dead_letters()] == ['service-1']
+    assert [len(alerts) for alerts, _ in client.batches] == [2, 0]
+
+
+def test_depth_gauges():
+    metrics.reset()
+    alert_outbox.enqueue([_alert(i) for i in range(2)], now=1610736000)
+    count, age = alert_outbox.depth()
+    text = metrics.collect().split('\n')
+    assert count == 2 and 'ph_alert_outbox_depth 2' in text
+    assert f'ph_alert_outbox_oldest_alert_seconds {age}' in text
+    metrics.reset()
+
+
+def test_backoff():
+    assert [alert_outbox._backoff(a) for a in range(3)] == [5, 10, 20]
+    assert alert_outbox._backoff(100) == alert_outbox.params.PH_alert_outbox_max_retry_seconds
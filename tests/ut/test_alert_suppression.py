@@ -0,0 +1,52 @@
+import pytest
+
+from ph import alert_suppression
+
+
+@pytest.fixture(autouse=True)
+def state_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(alert_suppression, 'file_name', str(tmp_path / 'alert_suppression.json'))
+
+
+def _alert(start_time, service='cart', confidence=0.5):
+    record = {'start_time': start_time, 'dest_name_aggr': service, 'dest_namespace': 'google-store',
+              'dest_service_name': service, 'src_namespace': 'google-store', 'src_name_aggr': 'frontend',
+              'duration_mean': 1000, 'confidence': confidence}
+    return {'type': 'alert', 'alert': 'anomaly_detection.l7_latency', 'severity': 100, 'record': record,
+            'description': f'{service} has a suspicious latency', 'time': 1}
+
+
+def test_coalesce_and_suppress():
+    now = 1610736000
+    alerts = [_alert(now - 60 * i, confidence=0.1 * i) for i in range(1, 4)] + [_alert(now - 60, 'payment')]
+    sent = alert_suppression.suppress(alerts, 'production', now=now)
+    assert [(a['record']['dest_service_name'], a['record']['count']) for a in sent] == [('cart', 3), ('payment', 1)]
+    cart = sent[0]['record']
+    assert (cart['confidence'], cart['first_start_time'], cart['last_start_time']) == (0.1 * 3, now - 180, now - 60)
+    assert 'count' not in alerts[0]['record']  # the input is not changed
+
+    # the same hot spot in the next cycles is suppressed, the other namespace is not
+    assert alert_suppression.suppress([_alert(now + 240)], 'production', now=now + 300) == []
+    assert alert_suppression.suppress([_alert(now + 540)], 'production', now=now + 600) == []
+    assert len(alert_suppression.suppress([_alert(now + 540)], 'ut_namespace', now=now + 600)) == 1
+
+    # after the window the suppressed anomalies are counted in the next alert
+    window = alert_suppression.params.PH_alert_suppression_minutes * 60
+    sent = alert_suppression.suppress([_alert(now + window)], 'production', now=now + window + 60)
+    assert [(a['record']['count'], a['record']['first_start_time'], a['record']['last_start_time'])
+            for a in sent] == [(3, now + 240, now + window)]
+
+
+def test_state_expiration(monkeypatch):
+    now = 1610736000
+    alert_suppression.suppress([_alert(now), _alert(now, 'payment')], 'production', now=now)
+    assert len(alert_suppression._read()) == 2
+    monkeypatch.setattr(alert_suppression, 'params', alert_suppression.params._replace(
+        PH_alert_suppression_max_keys=1))
+    alert_suppression.suppress([_alert(now + 60)], 'production', now=now + 60)
+    assert [k for k in alert_suppression._read()] == [alert_suppression.alert_key(_alert(now), 'production')]
+
+    # the keys not seen for the window expire, the alert is sent again
+    window = alert_suppression.params.PH_alert_suppression_minutes * 60
+    sent = alert_suppression.suppress([_alert(now + window + 120)], 'production', now=now + window + 120)
+    assert [a['record']['count'] for a in sent] == [1]
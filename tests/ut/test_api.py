@@ -455,9 +455,9 @@ def _assert_anomalies(anomalies, job):
 def _assert_train_rs(job, response):
     if job.dynamic_model:
         assert response.status_code == 202
-        assert 'STOP training' in response.text
-        assert job.name in response.text
-        assert 'Retrained model will replace the old model.' in response.text
+        rs = response.json()  # the training job state
+        assert rs['op'] == 'train' and rs['job'] == job.name
+        assert rs['status'] in ['queued', 'running', 'done']
     else:
         assert response.status_code == 404
         # "* NO training of 'dga'. The model is static and we do not train it here."
@@ -0,0 +1,94 @@
+import json
+import shutil
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+from benchmarks import corpora, fake_es
+from ph import response_cache
+from ph.api import app
+from ph.model_processor import train_job, namespace_dir
+
+
+def test_ping_is_not_blocked_by_operations():
+    store = fake_es.Store(latency_secs=0.5)
+    store.load('l7', 1000)
+    rq = {'job': 'l7_latency', 'data_source': 'logs', 'namespace': 'ut_api_async',
+          'data': {'start': '2021-01-15T18:44:00', 'end': '2021-01-15T18:50:00'}}
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host), TestClient(app) as client:
+        # the clients of all threads share the event loop of the app
+        threads = [threading.Thread(target=client.post, args=(url,), kwargs={'json': rq})
+                   for url in ['/ph/ops/train', '/ph/ops/detect']]
+        _ = [t.start() for t in threads]
+        time.sleep(0.2)
+        start = time.perf_counter()
+        assert client.get('/ph/ping').status_code == 200
+        assert time.perf_counter() - start < 0.4
+        assert store.requests
+        _ = [t.join() for t in threads]
+    shutil.rmtree(namespace_dir('ut_api_async'), ignore_errors=True)
+
+
+def test_detect_ndjson_stream():
+    store = fake_es.Store()
+    store.load('l7', 2000)  # the @timestamps: 18:45:00 - 18:48:20
+    train_job('l7_latency', corpora.generate('l7', 2000, seed=1), namespace='ut_api_async')
+    response_cache.clear()
+    rq = {'job': 'l7_latency', 'data_source': 'logs', 'namespace': 'ut_api_async',
+          'data': {'start': '2021-01-15T18:44:00', 'end': '2021-01-15T18:50:00'}}
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        client = TestClient(app)
+        rs = client.post('/ph/ops/detect', json=rq, headers={'Accept': 'application/x-ndjson'})
+        assert rs.headers['content-type'].startswith('application/x-ndjson')
+        streamed = [json.loads(line) for line in rs.text.splitlines()]
+        assert streamed
+        # the same anomalies from the response cache
+        requests = store.requests
+        rs = client.post('/ph/ops/detect', json=rq, headers={'Accept': 'application/x-ndjson'})
+        assert [json.loads(line) for line in rs.text.splitlines()] == streamed
+        assert store.requests == requests
+        # the confidence of the streamed anomalies is relative to their chunks, they are not the not streamed response
+        assert client.post('/ph/ops/detect', json=rq).json()
+        assert store.requests > requests
+    response_cache.clear()
+    shutil.rmtree(namespace_dir('ut_api_async'), ignore_errors=True)
+
+
+def test_detect_stream_chunks(monkeypatch):
+    import asyncio
+    from ph import api
+    from ph.api_classes import OperationDataRq
+
+    async def collect(chunks):
+        return [part async for part in api._stream_anomalies('l7_latency', chunks, 'ut_api_async')]
+
+    store = fake_es.Store(page_size=500)
+    store.load('l7', 2000)
+    train_job('l7_latency', corpora.generate('l7', 2000, seed=1), namespace='ut_api_async')
+    monkeypatch.setenv('PH_L7Latency_IsolationForest_score_threshold', '0')  # all samples are anomalies
+    rq = OperationDataRq(**{'job': 'l7_latency', 'data_source': 'logs', 'namespace': 'ut_api_async',
+                            'data': {'start': '2021-01-15T18:44:00', 'end': '2021-01-15T18:50:00'}})
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        # the logs are scored page by page
+        parts = asyncio.run(collect(api._stream_chunks(rq)))
+        assert [len(p.splitlines()) for p in parts] == [500] * 4
+        assert not store.scrolls
+
+        # the client disconnects after the first part: the download is stopped, its scroll is cleared
+        async def disconnect(chunks):
+            stream = api._stream_anomalies('l7_latency', chunks, 'ut_api_async')
+            part = await stream.__anext__()
+            await stream.aclose()
+            return part
+        requests = store.requests
+        assert len(asyncio.run(disconnect(api._stream_chunks(rq))).splitlines()) == 500
+        assert not store.scrolls and store.requests - requests < 4
+
+    # the prepared samples are scored in chunks
+    monkeypatch.setattr(api, 'params', api.params._replace(PH_api_stream_chunk_size=300))
+    rq = OperationDataRq(**{'job': 'l7_latency', 'data_source': 'request', 'namespace': 'ut_api_async',
+                            'data': {'log_name': 'l7', 'records': corpora.generate('l7', 700, seed=2)}})
+    parts = asyncio.run(collect(api._stream_chunks(rq)))
+    assert [len(p.splitlines()) for p in parts] == [300, 300, 100]
+    shutil.rmtree(namespace_dir('ut_api_async'), ignore_errors=True)
@@ -0,0 +1,83 @@
+import json
+import shutil
+
+from benchmarks import corpora, fake_es
+from ph import backfill, elastic_api
+from ph.model_processor import train_job, namespace_dir
+
+namespace = 'ut_backfill'
+
+
+def test_backfill(tmp_path, monkeypatch):
+    monkeypatch.setattr(backfill, 'checkpoint_dir', str(tmp_path))
+    train_job('l7_latency', corpora.generate('l7', 2000, seed=1), namespace=namespace)
+    store = fake_es.Store()
+    store.load('l7', 2000)  # the @timestamps: 18:45:00 - 18:48:20
+    start, end = '2021-01-15 18:44:00', '2021-01-15 18:50:00'
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        checkpoint = backfill.run(start, end, chunk_minutes=2, workers=2, namespace=namespace)
+        assert sorted(checkpoint['done']) == [str(c[0]) for c in backfill.chunks(
+            backfill.to_epoch(start), backfill.to_epoch(end), 2)]
+        assert not checkpoint['failed']
+        alerts = checkpoint['alerts']
+        assert alerts and sum(c['sent'] for c in checkpoint['done'].values()) == alerts
+        events = elastic_api.ElasticClient().es.count(index=elastic_api.params.indices['events'])['count']
+        assert events == alerts
+        alerts_file = tmp_path / f'{backfill._run_name(backfill.to_epoch(start), 2)}.alerts.jsonl'
+        assert len(open(alerts_file).readlines()) == alerts
+
+        # resumed: nothing to do
+        requests = store.requests
+        assert backfill.run(start, end, chunk_minutes=2, workers=2, namespace=namespace)['done'] == checkpoint['done']
+        assert store.requests == requests
+
+        # restarted: the chunks are processed again, the alerts are not written again
+        checkpoint = backfill.run(start, end, chunk_minutes=2, workers=2, namespace=namespace, restart=True)
+        assert checkpoint['alerts'] == alerts
+        assert elastic_api.ElasticClient().es.count(index=elastic_api.params.indices['events'])['count'] == events
+
+        # a longer run with the same start resumes: only its new chunks and the not finished last chunk are processed
+        last_chunk = str(int(backfill.to_epoch(end)))
+        checkpoint = backfill.run(start, '2021-01-15 18:51:00', chunk_minutes=2, workers=2, namespace=namespace)
+        assert len(checkpoint['done']) == 4 and checkpoint['done'][last_chunk]['end'] == backfill.to_epoch(end) + 60
+        checkpoint = backfill.run(start, '2021-01-15 18:52:00', chunk_minutes=2, workers=2, namespace=namespace)
+        assert len(checkpoint['done']) == 4 and checkpoint['done'][last_chunk]['end'] == backfill.to_epoch(end) + 120
+        assert checkpoint['alerts'] == alerts
+    shutil.rmtree(namespace_dir(namespace), ignore_errors=True)
+
+
+def test_failed_alerts_of_chunk(tmp_path, monkeypatch):
+    """The chunk with the not sent alerts is failed, its alerts are sent on the next run."""
+    from ph import alert_api
+
+    monkeypatch.setattr(backfill, 'checkpoint_dir', str(tmp_path))
+    train_job('l7_latency', corpora.generate('l7', 2000, seed=1), namespace=namespace)
+    store = fake_es.Store()
+    store.load('l7', 2000)
+    start, end = '2021-01-15 18:44:00', '2021-01-15 18:50:00'
+    send_alerts_in_bulk = alert_api.AlertClient.send_alerts_in_bulk
+
+    def failed_send(*args):
+        raise ConnectionError('no connection')
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        monkeypatch.setattr(alert_api.AlertClient, 'send_alerts_in_bulk', failed_send)
+        checkpoint = backfill.run(start, end, chunk_minutes=2, workers=2, namespace=namespace)
+        assert checkpoint['failed'] and not checkpoint['alerts']
+        assert all(c['alerts'] == 0 for c in checkpoint['done'].values())
+
+        monkeypatch.setattr(alert_api.AlertClient, 'send_alerts_in_bulk', send_alerts_in_bulk)
+        checkpoint = backfill.run(start, end, chunk_minutes=2, workers=2, namespace=namespace)
+        assert not checkpoint['failed'] and checkpoint['alerts']
+        events = elastic_api.ElasticClient().es.count(index=elastic_api.params.indices['events'])['count']
+        assert events == checkpoint['alerts']
+    shutil.rmtree(namespace_dir(namespace), ignore_errors=True)
+
+
+def test_chunks_and_alert_id():
+    assert backfill.chunks(0, 250, 2) == [(0, 120), (120, 240), (240, 250)]
+    alert = {'alert': 'anomaly_detection.l7_latency', 'record': {'start_time': 1, 'duration_mean': 2}, 'time': 1}
+    assert backfill.alert_id(alert) == backfill.alert_id({**json.loads(json.dumps(alert)), 'time': 2})
+    assert backfill.alert_id(alert) != backfill.alert_id({**alert, 'record': {'start_time': 2}})
+    start = backfill.to_epoch('2021-01-15 18:00:00')
+    assert backfill.default_end(start, 60, '2021-01-15 20:30:00') == backfill.to_datetime(start + 2 * 3600)
+    assert backfill.default_end(start, 60, '2021-01-15 18:30:00') == backfill.to_datetime(start + 1800)
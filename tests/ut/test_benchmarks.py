@@ -0,0 +1,25 @@
+from benchmarks import bench, corpora
+from ph.elastic_api import filter_paths
+
+
+def test_corpora():
+    for log in corpora.logs:
+        docs = corpora.generate(log, 100)
+        assert len(docs) == 100
+        assert docs == corpora.generate(log, 100)  # reproducible
+        assert [d['start_time'] for d in docs] == sorted(d['start_time'] for d in docs)
+        # only the fields downloaded from the ES
+        fields = {f.split('.')[-1] for f in filter_paths[log]}
+        assert set(docs[0]) <= fields
+
+
+def test_run_and_compare():
+    benchmark = [b for b in bench.benchmarks if b.name == '_aggregate_data'][0]
+    result = bench.run(benchmark, 1000, repeat=2)
+    assert result['name'] == '_aggregate_data'
+    assert result['items'] == 1000
+    assert result['median_secs'] >= result['min_secs'] > 0
+
+    baseline = {'results': [{**result, 'median_secs': result['median_secs'] / 10}]}
+    assert bench.compare({'results': [result]}, baseline, tolerance=0.25)[0]['slowdown'] >= 10
+    assert not bench.compare({'results': [result]}, {'results': [result]}, tolerance=0.25)
@@ -0,0 +1,53 @@
+import os
+import shutil
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+from ph import calibration, dataset_cache
+from ph.api import app
+from ph.model_processor import namespace_dir, train_job
+
+client = TestClient(app)
+
+namespace = 'ut_calibration'
+
+
+def test_sweep():
+    thresholds, precision, recall, f1 = calibration.sweep([-0.4, -0.9, -0.5, -0.8, -0.8], [1, 1, 0, 0, 1])
+    assert np.allclose(thresholds, [-0.85, -0.65, -0.45, -0.4 + 1e-9])
+    assert np.allclose(f1, [2 / 4, 4 / 6, 4 / 7, 6 / 8])
+
+    # the same metrics as the detection with each threshold
+    rng = np.random.default_rng(0)
+    scores, labels = rng.normal(size=500).round(2), rng.random(500) < 0.1
+    thresholds, precision, recall, f1 = calibration.sweep(scores, labels)
+    for i in [0, 10, 100, len(thresholds) - 1]:
+        predicted = scores < thresholds[i]
+        tp = np.sum(predicted & labels)
+        assert (precision[i], recall[i], f1[i]) == (tp / predicted.sum(), tp / labels.sum(),
+                                                    2 * tp / (predicted.sum() + labels.sum()))
+
+
+def test_calibrate_endpoint(monkeypatch):
+    param = 'PH_L7Latency_IsolationForest_score_threshold'
+    monkeypatch.setenv(param, '-0.836')  # restored after the test, the calibration can change it
+    rq = {'job': 'l7_latency', 'namespace': namespace, 'points': 20}
+    assert client.post('/ph/ops/calibrate', json=rq).status_code == 404  # no model
+    train_job('l7_latency', dataset_cache.records('l7_latency'), namespace=namespace)
+    try:
+        rs = client.post('/ph/ops/calibrate', json=rq)
+        assert rs.status_code == 200
+        result = rs.json()
+        assert (result['param'], result['anomalies'], result['applied']) == (param, 72, False)
+        assert len(result['curve']) <= 21 and result['best'] in result['curve']
+        assert result['best']['F1'] >= result['current']['F1'] and result['current']['threshold'] == -0.836
+        assert result['meets_tolerance'] == (result['best']['F1'] >= result['tolerance'])
+
+        rs = client.post('/ph/ops/calibrate', json={**rq, 'apply': True}).json()
+        assert rs['applied'] == rs['meets_tolerance']
+        if rs['applied']:
+            assert float(os.environ[param]) == rs['best']['threshold']
+        assert client.post('/ph/ops/calibrate', json={**rq, 'job': 'all'}).status_code == 400
+    finally:
+        shutil.rmtree(namespace_dir(namespace), ignore_errors=True)
@@ -0,0 +1,44 @@
+import os
+
+import pandas as pd
+import pytest
+
+from ph import dataset_cache
+
+
+@pytest.fixture(autouse=True)
+def dataset_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset_cache, 'data_dir', str(tmp_path))
+    dataset_cache.clear()
+    yield tmp_path
+    dataset_cache.clear()
+
+
+def _write(anomalies):
+    pd.DataFrame([{'start_time': 1610736000 + i, 'dest_name_aggr': 'cart', 'dest_namespace': 'google-store',
+                   'dest_service_name': 'cart', 'duration_max': 100, 'duration_mean': 50 + i,
+                   'src_name_aggr': 'frontend', 'src_namespace': 'google-store', 'anomaly': int(i in anomalies)}
+                  for i in range(10)]).to_csv(dataset_cache.file_name('l7_latency'), index=False)
+
+
+def test_load(monkeypatch):
+    _write(anomalies=[3, 7])
+    dataset = dataset_cache.load('l7_latency')
+    assert len(dataset.records) == 10 and 'anomaly' not in dataset.records[0]
+    assert dataset.labeled['duration_mean'].tolist() == [53, 57]
+    assert dataset.labeled['key'].iloc[0] == '1610736003^cart^google-store^cart^google-store^frontend^53'
+    assert dataset_cache.load('l7_latency') is dataset  # parsed once
+    records = dataset_cache.records('l7_latency')
+    records.clear()
+    assert len(dataset_cache.records('l7_latency')) == 10
+
+    # the other process reads the persisted DataFrame, the CSV is not parsed again
+    dataset_cache.clear()
+    with monkeypatch.context() as m:
+        m.setattr(pd, 'read_csv', lambda *args, **kwargs: pytest.fail('the CSV is parsed'))
+        assert dataset_cache.load('l7_latency').records == dataset.records
+
+    # a changed CSV is parsed again
+    _write(anomalies=[1])
+    os.utime(dataset_cache.file_name('l7_latency'), ns=(1, 1))
+    assert dataset_cache.load('l7_latency').labeled['duration_mean'].tolist() == [51]
@@ -0,0 +1,69 @@
+import pytest
+from elasticsearch import helpers
+from elasticsearch.exceptions import ConflictError
+
+from benchmarks import fake_es
+from ph import elastic_api
+from ph.alert_api import AlertClient
+
+
+@pytest.fixture(scope='module')
+def store():
+    store = fake_es.Store(page_size=300)
+    store.load('l7', 2000)
+    store.load('flows', 1000)
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host) as params:
+        elastic_api.params = params._replace(query_size=500)
+        yield store
+
+
+def test_download_with_scroll(store):
+    client = elastic_api.ElasticClient()
+    requests = store.requests
+    data = client.download_and_aggregate_data(None, None, index_name='l7')
+    assert len(data['l7']) == 2000
+    # 7 pages of the 300 max page size, the last empty page and the clearing of the scroll
+    assert store.requests - requests == 9 and not store.scrolls
+    assert set(data['l7'][0]) == {f.split('.')[-1] for f in elastic_api.filter_path_l7_latency} - {'_scroll_id'}
+
+    data = client.download_and_aggregate_data('2021-01-15 18:46:00', '2021-01-15 18:47:00')
+    expected = [d for d in store.indices[fake_es.index_name('l7')].docs
+                if '2021-01-15T18:46:00' <= d['@timestamp'] < '2021-01-15T18:47:00']
+    assert 0 < len(data['l7']) == len(expected) < 2000
+    assert data['flows'] == []  # the flows are earlier
+    assert data['dns'] == []  # no index
+
+    assert len(client.download_and_aggregate_data(None, None, max_docs=600, index_name='l7')['l7']) == 600
+
+
+def test_point_in_time_and_search_after(store):
+    es = elastic_api.ElasticClient().es
+    pit = es.open_point_in_time(index=elastic_api.params.indices['l7'], keep_alive='1m')
+    store.index(fake_es.index_name('l7')).add({'@timestamp': '2021-01-15T18:46:00'})  # not in the point in time
+    sort = [{'@timestamp': 'asc'}, {'_shard_doc': 'asc'}]
+    hits, after = [], None
+    while True:
+        body = {'size': 700, 'pit': {'id': pit['id'], 'keep_alive': '1m'}, 'sort': sort}
+        if after:
+            body['search_after'] = after
+        page = es.search(body=body)['hits']['hits']
+        if not page:
+            break
+        hits += page
+        after = page[-1]['sort']
+    assert len(hits) == 2000
+    assert [h['sort'] for h in hits] == sorted(h['sort'] for h in hits)
+    es.close_point_in_time(body={'id': pit['id']})
+    assert not store.pits
+
+
+def test_write_alerts(store):
+    AlertClient().send_alerts([{'type': 'alert', 'time': 1610736000, 'record': {'start_time': 1610736000}}] * 3)
+    es = elastic_api.ElasticClient().es
+    events = elastic_api.params.indices['events']
+    assert es.count(index=events)['count'] == 3
+
+    assert helpers.bulk(es, [{'_index': events, '_id': f'bulk-{i}', 'time': i} for i in range(50)]) == (50, [])
+    assert es.count(index=events)['count'] == 53
+    with pytest.raises(ConflictError):
+        es.create(index=events, id='bulk-0', body={}, doc_type='_doc')
@@ -0,0 +1,56 @@
+import json
+import os
+
+import pytest
+
+from ph import history_storage
+
+op = 'ut_history'
+
+
+@pytest.fixture(autouse=True)
+def history_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(history_storage, 'data_dir', str(tmp_path))
+    monkeypatch.setattr(history_storage, 'PH_HISTORY_RETENTION_NUMBER', 5)
+    history_storage._indices.clear()
+    yield tmp_path
+    history_storage._indices.clear()
+
+
+def _wait_compaction():
+    for thread in history_storage.threading.enumerate():
+        if thread.name.startswith('ph_compact_'):
+            thread.join()
+
+
+def test_save_read_compact(history_dir):
+    assert history_storage.read_id_json(op) == {} and history_storage.read_job_jsons(op) == []
+    ids = [history_storage.save_json_in_line(op, job=f'job{i % 2}', js={'n': i}) for i in range(9)]
+    assert history_storage.read_id_json(op, ids[6])['result'] == {'n': 6}
+    assert history_storage.read_id_json(op, '-1')['id'] == ids[-1]
+    assert history_storage.read_id_json(op, '-2')['id'] == ids[-2]
+    # only the retained records are visible, an unknown id is the last record
+    assert history_storage.read_id_json(op, ids[0])['id'] == ids[-1]
+    assert [r['id'] for r in history_storage.read_job_jsons(op)] == ids[-5:]
+    assert [r['result']['n'] for r in history_storage.read_job_jsons(op, job='job0')] == [4, 6, 8]
+
+    ids.append(history_storage.save_json_in_line(op, job='job0', js={'n': 9}))  # 10 records: compacted
+    _wait_compaction()
+    with open(history_storage.get_file_name(op)) as f:
+        assert [json.loads(line)['id'] for line in f] == ids[-5:]
+    assert history_storage.read_id_json(op, ids[7])['result'] == {'n': 7}
+    assert [r['id'] for r in history_storage.read_job_jsons(op)] == ids[-5:]
+
+
+def test_crash_safety(history_dir):
+    ids = [history_storage.save_json_in_line(op, job='all', js={'n': i}) for i in range(3)]
+    # a partially written record and an old history file without the index
+    with open(history_storage.get_file_name(op), 'a') as f:
+        f.write('{"id": "partial", "ti')
+    os.remove(history_storage._index_file_name(op))
+    history_storage._indices.clear()
+    assert history_storage.read_id_json(op)['id'] == ids[-1]
+    ids.append(history_storage.save_json_in_line(op, job='all', js={'n': 3}))
+    assert [r['id'] for r in history_storage.read_job_jsons(op)] == ids
+    with open(history_storage.get_file_name(op)) as f:
+        assert len(f.readlines()) == 4
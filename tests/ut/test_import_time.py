@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+# The import-time budget of the scheduler entry point, measured with `python -X importtime`.
+# The heavy modules are loaded only in the code paths that need them (train, detection, API).
+IMPORT_TIME_BUDGET_US = 300000
+ENTRY_POINT_MODULES = ['ph.ph', 'ph.model_processor', 'ph.alert_api', 'ph.self_diagnostics', 'ph.history_storage']
+HEAVY_MODULES = ['pandas', 'numpy', 'sklearn', 'elasticsearch', 'fastapi', 'uvicorn', 'pydantic']
+
+
+def _import_times(modules):
+    """
+    Runs a fresh interpreter with `-X importtime` and parses its report.
+    Returns: {module_name: (self_us, cumulative_us, nesting_level)}
+    """
+    code = f'import {", ".join(modules)}'
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        times[name.strip()] = (int(self_us), int(cumulative_us), level)
+    return times
+
+
+def test_no_heavy_modules_on_import():
+    times = _import_times(ENTRY_POINT_MODULES)
+    loaded = [m for m in HEAVY_MODULES if m in times]
+    assert not loaded, f'Heavy modules loaded on import: {loaded}'
+
+
+def test_import_time_budget():
+    times = _import_times(ENTRY_POINT_MODULES)
+    # only the top-level entries of the report, their cumulative times include all nested imports
+    total_us = sum(cumulative for name, (_, cumulative, level) in times.items()
+                   if level == 0 and name.split('.')[0] == 'ph')
+    print(f'ph import time: {total_us:,} us, budget: {IMPORT_TIME_BUDGET_US:,} us')
+    assert total_us < IMPORT_TIME_BUDGET_US
@@ -0,0 +1,64 @@
+import shutil
+
+import pytest
+from fastapi.testclient import TestClient
+
+from ph import instrumentation
+from ph.instrumentation import trace, span, traced, read_traces
+from ph.api import app
+
+client = TestClient(app)
+
+
+@traced(count='docs')
+def _aggregate(docs):
+    return docs[:1]
+
+
+@traced('detection', count=len)
+def _detect(samples):
+    return [s for s in samples if s > 1]
+
+
+def test_span_tree():
+    shutil.rmtree(instrumentation.traces_dir, ignore_errors=True)
+    with trace('ut cycle'):
+        _aggregate([1, 2, 3])
+        with span('scoring') as s:
+            _detect([1, 2, 3])
+            s.add_items(3)
+
+    js = read_traces(1)[0]
+    assert js['name'] == 'ut cycle'
+    root = js['spans']
+    assert [c['name'] for c in root['children']] == ['_aggregate', 'scoring']
+    assert root['children'][0]['items'] == 3
+    scoring = root['children'][1]
+    assert scoring['items'] == 3
+    assert scoring['children'][0] == {**scoring['children'][0], 'name': 'detection', 'items': 2, 'error': None}
+    assert root['duration_secs'] >= scoring['duration_secs'] >= 0
+
+
+def test_no_trace_no_spans():
+    shutil.rmtree(instrumentation.traces_dir, ignore_errors=True)
+    instrumentation._traces.clear()
+    assert _detect([1, 2, 3]) == [2, 3]
+    assert read_traces() == []
+
+
+def test_error_and_ring_buffer():
+    shutil.rmtree(instrumentation.traces_dir, ignore_errors=True)
+    with pytest.raises(ValueError):
+        with trace('failed cycle'):
+            raise ValueError('no data')
+    assert read_traces(1)[0]['spans']['error'] == 'no data'
+
+    for i in range(instrumentation.params.PH_traces_number + 5):
+        with trace(f'cycle {i}'):
+            pass
+    traces = read_traces()
+    assert len(traces) == instrumentation.params.PH_traces_number
+    rs = client.get('/ph/ops/traces', params={'limit': 2})
+    assert rs.status_code == 200
+    assert len(rs.json()) == 2
+    shutil.rmtree(instrumentation.traces_dir, ignore_errors=True)
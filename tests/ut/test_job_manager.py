@@ -0,0 +1,77 @@
+import os
+import shutil
+import time
+
+from fastapi.testclient import TestClient
+
+from ph.api import app
+from ph.model_processor import namespace_dir
+
+client = TestClient(app)
+
+namespace = 'ut_jobs'
+
+
+def _wait(job_id, timeout=120):
+    end = time.time() + timeout
+    while time.time() < end:
+        state = client.get(f'/ph/ops/jobs/{job_id}').json()
+        if state['status'] in ('done', 'failed'):
+            return state
+        time.sleep(0.2)
+    raise TimeoutError(job_id)
+
+
+def test_train_and_detect_jobs():
+    rq = {'job': 'l7_latency', 'data_source': 'test_dataset', 'max_log_records': 3000, 'namespace': namespace}
+    rs = client.post('/ph/ops/train', json=rq)
+    assert rs.status_code == 202
+    job = rs.json()
+    assert job['op'] == 'train' and job['job'] == 'l7_latency' and job['status'] in ('queued', 'running')
+    # the identical in-flight request gets the same job
+    assert client.post('/ph/ops/train', json=rq).json()['id'] == job['id']
+
+    state = _wait(job['id'])
+    assert state['status'] == 'done', state['error']
+    assert state['duration_secs'] is not None and state['started'] and state['finished']
+    assert os.path.isfile(f'{namespace_dir(namespace)}/l7_latency.model')
+    # the finished request is run again
+    retrained = client.post('/ph/ops/train', json=rq).json()
+    assert retrained['id'] != job['id']
+
+    rs = client.post('/ph/ops/detect', params={'background': True}, json=rq)
+    assert rs.status_code == 202
+    state = _wait(rs.json()['id'])
+    assert state['status'] == 'done', state['error']
+    assert state['result'] and state['result'][0]['job'] == 'l7_latency'
+    assert [j['id'] for j in client.get('/ph/ops/jobs').json()][0] == state['id']
+    assert client.get('/ph/ops/jobs/no-such-job').status_code == 404
+    assert _wait(retrained['id'])['status'] == 'done'
+    shutil.rmtree(namespace_dir(namespace), ignore_errors=True)
+
+
+def test_job_parameters_and_train_dedup(monkeypatch):
+    from ph import job_manager
+    from ph.model_processor import _load_model
+
+    # the workers are started before the parameter is set
+    executor = job_manager._get_executor()
+    _ = [f.result() for f in [executor.submit(time.sleep, 0.5) for _ in range(job_manager.params.PH_job_workers)]]
+    monkeypatch.setenv('PH_L7Latency_IsolationForest_n_estimators', '7')
+
+    rq = {'job': 'l7_latency', 'data_source': 'test_dataset', 'max_log_records': 3000, 'namespace': namespace}
+    job = client.post('/ph/ops/train', json=rq).json()
+    # a different training request of the same namespace and job gets the in-flight job
+    assert client.post('/ph/ops/train', json={**rq, 'max_log_records': 2000}).json()['id'] == job['id']
+    state = _wait(job['id'])
+    assert state['status'] == 'done', state['error']
+    model, _ = _load_model('l7_latency', namespace)
+    assert model.n_estimators == 7
+    shutil.rmtree(namespace_dir(namespace), ignore_errors=True)
+
+
+def test_reserved_namespaces():
+    rq = {'job': 'l7_latency', 'data_source': 'test_dataset', 'max_log_records': 3000}
+    for reserved in ['diagnostics', 'diagnostics_real_life']:
+        assert client.post('/ph/ops/train', json={**rq, 'namespace': reserved}).status_code == 400
+        assert client.post('/ph/ops/detect', json={**rq, 'namespace': reserved}).status_code == 400
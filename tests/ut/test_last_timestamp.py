@@ -4,16 +4,16 @@ from datetime import datetime, timedelta
 from time import sleep
 from random import randint
 
-from ph.last_timestamp import params, file_name, load, save, remove
+from ph.last_timestamp import params, file_name, load, save, remove, dedup, window_start
 
 
 def test_params():
     attributes = params._fields
-    for at in 'AD_search_interval_minutes'.split(
+    for at in 'PH_search_interval_minutes PH_search_overlap_minutes'.split(
             ' '):
         assert at in attributes
     assert params
-    assert type(params.AD_search_interval_minutes) == int
+    assert type(params.PH_search_interval_minutes) == int
 
 
 def test_timestamp_protocol():
@@ -22,13 +22,13 @@ def test_timestamp_protocol():
     remove()
     assert not os.path.exists(file_name)
 
-    # - load a default value: utcnow() - params.AD_search_interval_minutes*2):
+    # - load a default value: utcnow() - params.PH_search_interval_minutes*2):
     ts = load()
     assert isinstance(ts, datetime)
     #
     delay = randint(0, 3)
     sleep(delay)
-    last_timestamp_now = datetime.utcnow() - timedelta(minutes=params.AD_search_interval_minutes*2)
+    last_timestamp_now = datetime.utcnow() - timedelta(minutes=params.PH_search_interval_minutes*2)
     assert (last_timestamp_now - ts).seconds == delay
 
     # 2. save - load:
@@ -41,3 +41,48 @@ def test_timestamp_protocol():
     # remove it
     remove()
     assert not os.path.exists(file_name)
+
+
+def _docs(start, minutes):
+    return [{'@timestamp': (start + timedelta(minutes=m)).isoformat(), 'duration_mean': 100} for m in minutes]
+
+
+def test_watermarks_and_dedup():
+    remove()
+    t0 = datetime(2021, 1, 15, 18, 0)
+    t1 = t0 + timedelta(minutes=30)
+    save(t0)
+    assert window_start('l7') == t0 - timedelta(minutes=params.PH_search_overlap_minutes)
+
+    # the first window [t0 - overlap, t1): the docs of its end overlap are remembered
+    docs = _docs(t0, range(-params.PH_search_overlap_minutes, 30))
+    new_docs, keys = dedup('l7', docs, t1)
+    assert new_docs == docs
+    assert len(keys) == params.PH_search_overlap_minutes
+    save(t1, 'l7', keys)
+    assert load('l7') == t1 and load('flows') == t0 and load() == t0
+
+    # the next window: the overlap docs are not scored again, the late doc is scored
+    t2 = t1 + timedelta(minutes=30)
+    docs = _docs(t1, range(-params.PH_search_overlap_minutes, 30)) + _docs(t1, [-1.5])
+    new_docs, keys = dedup('l7', docs, t2)
+    assert new_docs == docs[params.PH_search_overlap_minutes:]
+
+    # the truncated window: the watermark is the last doc time, the next window starts at it without the overlap,
+    # only the docs of the last doc time are remembered
+    last = t1 + timedelta(minutes=10)
+    new_docs, keys = dedup('l7', [d for d in new_docs if d['@timestamp'] <= last.isoformat()], last, truncated=True)
+    assert len(keys) == 1
+    save(last, 'l7', keys, truncated=True)
+    assert load('l7') == last and window_start('l7') == last
+    assert dedup('l7', _docs(last, range(0, 3)), t2)[0] == _docs(last, range(1, 3))
+
+    # the watermark of a failed window is not moved
+    save(t2, 'l7', [], advance=False)
+    assert load('l7') == last
+
+    # the advanced watermark drops the keys of the old windows
+    save(t2, 'l7', [])
+    assert load('l7') == t2 and window_start('l7') == t2 - timedelta(minutes=params.PH_search_overlap_minutes)
+    assert dedup('l7', docs, t2)[0] == docs
+    remove()
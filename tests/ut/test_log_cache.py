@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+from benchmarks import fake_es
+from ph import elastic_api
+from ph import log_cache
+from ph.log_cache import to_epoch
+
+hour = to_epoch('2021-01-15 18:00:00')
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(log_cache, 'cache_dir', str(tmp_path))
+    # the test data is of 2021, it is not evicted
+    monkeypatch.setattr(log_cache, 'params', log_cache.params._replace(PH_log_cache_retention_hours=10 ** 6))
+    return tmp_path
+
+
+def _docs(start, n, step):
+    return [{'@timestamp': log_cache.to_datetime(start + i * step).isoformat(), 'start_time': int(start + i * step),
+             'duration_mean': i} for i in range(n)]
+
+
+def test_put_get_gaps(cache_dir):
+    docs = _docs(hour, 90, 60)  # 1.5 hours
+    assert log_cache.put('l7', docs, hour, hour + 5400)
+    assert '@timestamp' not in docs[0]
+    assert sorted(os.listdir(cache_dir / 'l7')) == ['.lock', '2021011518.pkl', '2021011519.pkl', 'coverage.json']
+    assert log_cache.gaps('l7', hour - 1800, hour + 7200) == [(hour - 1800, hour), (hour + 5400, hour + 7200)]
+
+    # the overlapped window adds only the new docs, a missing field is None
+    docs = _docs(hour + 5400 - 600, 20, 60)
+    docs[-1].pop('duration_mean')
+    assert log_cache.put('l7', docs, hour + 5400 - 600, hour + 7200)
+    cached = log_cache.get('l7', hour, hour + 7200)
+    assert [d['start_time'] for d in cached] == list(range(int(hour), int(hour) + 6000, 60))
+    assert cached[-1]['duration_mean'] is None and cached[0]['duration_mean'] == 0
+    assert [d['start_time'] for d in log_cache.get('l7', hour + 600, hour + 720)] == [hour + 600, hour + 660]
+
+    # the truncated download is not cached
+    assert not log_cache.put('l7', _docs(hour + 7200, 10, 60), hour + 7200, hour + 10800, max_docs=10)
+    assert log_cache.gaps('l7', hour, hour + 10800) == [(hour + 7200, hour + 10800)]
+
+    log_cache.evict(now=hour + 3600 + 10 ** 6 * 3600)
+    assert not os.path.exists(cache_dir / 'l7' / '2021011518.pkl')
+    assert log_cache.gaps('l7', hour, hour + 7200) == [(hour, hour + 3600)]
+
+
+def test_train_window_from_cache():
+    store = fake_es.Store()
+    store.load('l7', 20000)  # the @timestamps: 18:45:00 - 19:18:20
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        client = elastic_api.ElasticClient()
+        start, end = '2021-01-15 18:00:00', '2021-01-15 20:00:00'
+        expected = client.download_and_aggregate_data(start, end, index_name='l7')['l7']
+
+        # a detection cycle
+        detection_start = log_cache.to_datetime(to_epoch('2021-01-15 19:00:00'))
+        data = client.download_and_aggregate_data(detection_start, None, with_timestamp=True)
+        log_cache.put_downloaded(data, detection_start, log_cache.to_datetime(to_epoch(end)), max_docs=10 ** 6)
+        assert '@timestamp' not in data['l7'][0]
+
+        # the training downloads only [18:00, 19:00) of the l7
+        data = log_cache.load_window(client, start, end, max_docs=10 ** 6)
+        assert sorted(d['start_time'] for d in data['l7']) == sorted(d['start_time'] for d in expected)
+        assert set(data) == {'flows', 'source', 'dest', 'l7', 'dns'}
+
+        # the window is cached completely
+        requests = store.requests
+        data = log_cache.load_window(client, start, end, max_docs=10 ** 6)
+        assert store.requests == requests
+        assert sorted(d['start_time'] for d in data['l7']) == sorted(d['start_time'] for d in expected)
+        assert set(data['l7'][0]) == set(expected[0])
+
+
+def test_cached_field_types():
+    docs = _docs(hour, 3, 60)
+    docs[1]['duration_mean'] = None
+    docs[2].pop('duration_mean')
+    assert log_cache.put('l7', docs, hour, hour + 3600)
+    cached = log_cache.get('l7', hour, hour + 3600)
+    assert [d['duration_mean'] for d in cached] == [0, None, None]
+    assert type(cached[0]['duration_mean']) == int and type(cached[0]['start_time']) == int
+
+
+def test_open_train_window(monkeypatch):
+    store = fake_es.Store()
+    store.load('l7', 20000)  # the @timestamps: 18:45:00 - 19:18:20
+    monkeypatch.setattr(log_cache, 'params', log_cache.params._replace(PH_log_cache_retention_hours=1))
+    now = to_epoch('2021-01-15 20:00:00')  # the retention window starts at 19:00
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        client = elastic_api.ElasticClient()
+        expected = client.download_and_aggregate_data(None, None, index_name='l7')['l7']
+        detection_start = log_cache.to_datetime(to_epoch('2021-01-15 19:00:00'))
+        data = client.download_and_aggregate_data(detection_start, None, with_timestamp=True)
+        log_cache.put_downloaded(data, detection_start, log_cache.to_datetime(now), max_docs=10 ** 6)
+
+        # the open start is all data: the data older than the retention window is downloaded from the ES
+        data = log_cache.load_window(client, None, None, max_docs=10 ** 6, now=now)
+        assert sorted(d['start_time'] for d in data['l7']) == sorted(d['start_time'] for d in expected)
+        assert log_cache.gaps('l7', to_epoch('2021-01-15 18:00:00'), now) == [
+            (to_epoch('2021-01-15 18:00:00'), to_epoch('2021-01-15 19:00:00'))]
+
+
+def test_window_limited_by_most_recent_docs(monkeypatch):
+    """The not cached part of the window is older than its cached part, the most recent docs are kept."""
+    store = fake_es.Store()
+    store.load('l7', 20000)  # the @timestamps: 18:45:00 - 19:18:20
+    monkeypatch.setattr(log_cache, 'params', log_cache.params._replace(PH_log_cache_retention_hours=1))
+    now = to_epoch('2021-01-15 20:00:00')  # the retention window starts at 19:00
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        client = elastic_api.ElasticClient()
+        cached_start = log_cache.to_datetime(to_epoch('2021-01-15 19:10:00'))
+        data = client.download_and_aggregate_data(cached_start, None, with_timestamp=True)
+        log_cache.put_downloaded(data, cached_start, log_cache.to_datetime(now), max_docs=10 ** 6)
+        cached = log_cache.get('l7', to_epoch(cached_start), now)
+
+        # the [19:00, 19:10) download is truncated by the max_docs, it is not cached
+        docs = log_cache.load_window(client, None, None, max_docs=len(cached) + 500, now=now)['l7']
+        assert len(docs) == len(cached) + 500 and docs[-len(cached):] == cached
+        assert log_cache.gaps('l7', to_epoch('2021-01-15 19:00:00'), now) == [
+            (to_epoch('2021-01-15 19:00:00'), to_epoch('2021-01-15 19:10:00'))]
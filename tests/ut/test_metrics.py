@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+from multiprocessing import Process
+
+from fastapi.testclient import TestClient
+
+from ph import metrics
+from ph.api import app
+
+client = TestClient(app)
+
+
+def _observe_in_child():
+    metrics.observe('ph_train_seconds', 2.0, job='child_job')
+    metrics.record_cycle('train')
+
+
+def test_collect_format():
+    metrics.reset()
+    metrics.observe('ph_train_seconds', 0.07, job='ut_job')
+    metrics.observe('ph_train_seconds', 100, job='ut_job')
+    with metrics.timer('ph_alert_write_seconds'):
+        pass
+
+    text = metrics.collect()
+    assert '# TYPE ph_train_seconds histogram' in text
+    assert 'ph_train_seconds_bucket{job="ut_job",le="0.05"} 0' in text
+    assert 'ph_train_seconds_bucket{job="ut_job",le="0.1"} 1' in text
+    assert 'ph_train_seconds_bucket{job="ut_job",le="+Inf"} 2' in text
+    assert 'ph_train_seconds_count{job="ut_job"} 2' in text
+    assert 'ph_train_seconds_sum{job="ut_job"} 100.07' in text
+    assert 'ph_alert_write_seconds_count 1' in text
+    metrics.reset()
+
+
+def test_gauges():
+    """A gauge has the last set value, also of the other processes."""
+    metrics.reset()
+    metrics.set_gauge('ph_alert_outbox_depth', 5)
+    metrics.set_gauge('ph_alert_outbox_depth', 3)
+    text = metrics.collect()
+    assert '# TYPE ph_alert_outbox_depth gauge' in text
+    assert 'ph_alert_outbox_depth 3' in text.split('\n')
+
+    snapshot = {'ph_alert_outbox_depth': [[[], 7, 0.0]]}  # an older snapshot of another process
+    assert metrics._merge(snapshot, metrics._snapshot())['ph_alert_outbox_depth'][0][1] == 3
+    metrics.reset()
+
+
+def test_child_process_metrics():
+    """
+    A finished child process reports its metrics through the metrics_dir. Its snapshot is folded into the merged file.
+    """
+    shutil.rmtree(metrics.metrics_dir, ignore_errors=True)
+    metrics.reset()
+    child = Process(target=_observe_in_child)
+    child.start()
+    child.join()
+
+    text = metrics.collect()
+    assert 'ph_train_seconds_count{job="child_job"} 1' in text
+    assert 'ph_cycle_peak_rss_bytes_count{cycle="train"} 1' in text
+    assert {f for f in os.listdir(metrics.metrics_dir) if f.endswith('.json')} == {metrics.merged_file_name}
+    with open(f'{metrics.metrics_dir}/{metrics.merged_file_name}') as f:
+        assert 'ph_train_seconds' in json.load(f)
+
+    # the collected metrics are not counted twice
+    assert 'ph_train_seconds_count{job="child_job"} 1' in metrics.collect()
+    shutil.rmtree(metrics.metrics_dir, ignore_errors=True)
+
+
+def test_metrics_endpoint():
+    metrics.observe('ph_score_seconds', 0.2, job='ut_job')
+    rs = client.get('/ph/metrics')
+    assert rs.status_code == 200
+    assert rs.headers['content-type'].startswith('text/plain')
+    assert 'ph_score_seconds_count{job="ut_job"} 1' in rs.text
+    metrics.reset()
+
+
+def test_reused_pid_snapshot():
+    """The snapshot of a finished process is folded, even if its pid is reused by a live process."""
+    shutil.rmtree(metrics.metrics_dir, ignore_errors=True)
+    metrics.reset()
+    os.makedirs(metrics.metrics_dir)
+    metrics.observe('ph_train_seconds', 2.0, job='reused_pid_job')
+    snapshot = metrics._snapshot()
+    metrics.reset()
+    live_pid = os.getppid()
+    start_time = metrics._start_time(live_pid)
+    for name in [f'{live_pid}_{start_time + 1}.json', f'{live_pid}_{start_time}.json']:
+        with open(f'{metrics.metrics_dir}/{name}', 'w') as f:
+            json.dump(snapshot, f)
+
+    assert 'ph_train_seconds_count{job="reused_pid_job"} 2' in metrics.collect()
+    assert {f for f in os.listdir(metrics.metrics_dir) if f.endswith('.json')} == {
+        metrics.merged_file_name, f'{live_pid}_{start_time}.json'}
+    shutil.rmtree(metrics.metrics_dir, ignore_errors=True)
@@ -4,8 +4,9 @@ from pytest_mock import mocker
 from multiprocessing import Lock
 import glob
 import os
+import shutil
 
-from ph.model_processor import ModelProcessor
+from ph.model_processor import ModelProcessor, namespace_dir, _save_model, _load_model
 
 # NOTE: we have additional dependencies! See imports below.
 from ph.elastic_api import ElasticClient
@@ -83,4 +84,135 @@ def test_detect_in_test_datasets(model_processor):
     if verbose: print('FINISH test_model_processor_find_anomalies()')
 
 
+def test_tests_cycle_in_own_namespace(model_processor, es_client, tmp_path):
+    """
+    The self-diagnostics tests cycle keeps its models and anomalies in its own namespace and directory.
+    It does not replace the production models.
+    """
+    production_models = {f: os.path.getmtime(f) for f in glob.glob(model_pattern)}
+    namespace, test_data_dir = 'ut_tests_cycle', str(tmp_path / 'data')
+    test_model_processor = ModelProcessor(es_client, namespace=namespace, data_dir=test_data_dir)
+
+    test_model_processor.train(None, 0, is_test=True)
+    anomalies = test_model_processor.find_anomalies(None, 0, is_test=True)
+
+    assert len([j for j in local_jobs if j.dynamic_model]) == len(glob.glob(f'{namespace_dir(namespace)}/*.model'))
+    assert anomalies
+    assert os.path.isfile(f'{test_data_dir}/{file_all_detected_anomalies_test}.csv')
+    assert production_models == {f: os.path.getmtime(f) for f in glob.glob(model_pattern)}
+    shutil.rmtree(namespace_dir(namespace))
+
 
+def test_model_namespaces():
+    """
+    Namespaces keep models independently. A model is not reloaded from disc if its file did not change.
+    """
+    _save_model('production model', {'mean': 1}, 'ut_model')
+    _save_model('diagnostics model', {'mean': 2}, 'ut_model', namespace='ut_diagnostics')
+    assert _load_model('ut_model') == ('production model', {'mean': 1})
+    assert _load_model('ut_model', namespace='ut_diagnostics') == ('diagnostics model', {'mean': 2})
+    assert _load_model('ut_model', namespace='ut_empty') == (None, None)
+
+    # the cached model is returned till the file is replaced
+    model, _ = _load_model('ut_model', namespace='ut_diagnostics')
+    assert model is _load_model('ut_model', namespace='ut_diagnostics')[0]
+
+    with pytest.raises(ValueError):
+        namespace_dir('../production')
+    os.remove(f'{namespace_dir()}/ut_model.model')
+    _ = [shutil.rmtree(namespace_dir(ns), ignore_errors=True) for ns in ['ut_diagnostics', 'ut_empty']]
+
+
+def test_watermarks_of_detection_cycle(tmp_path, monkeypatch):
+    from datetime import datetime
+    from benchmarks import fake_es
+    from ph import last_timestamp, log_cache, model_processor
+
+    monkeypatch.setattr(log_cache, 'cache_dir', str(tmp_path / 'log_cache'))
+    store = fake_es.Store()
+    store.load('l7', 2000)  # the @timestamps: 18:45:00 - 18:48:20
+    t0 = datetime(2021, 1, 15, 18, 40)
+    last_timestamp.remove()
+    last_timestamp.save(t0)
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        processor = ModelProcessor(ElasticClient(), data_dir=str(tmp_path))
+        processor.find_anomalies(None, 1, is_test=False)
+        assert last_timestamp.load('l7') > t0
+        assert not processor.truncated
+
+        # the truncated downloads move the last timestamp to their last docs, the next cycle gets the new docs
+        last_timestamp.remove()
+        last_timestamp.save(t0)
+        store.page_size = 100
+        monkeypatch.setattr(model_processor, 'params', model_processor.params._replace(PH_max_docs=100))
+        dedup, new_docs = last_timestamp.dedup, []
+
+        def recorded_dedup(*args):
+            result = dedup(*args)
+            new_docs.append(result[0])
+            return result
+        monkeypatch.setattr(last_timestamp, 'dedup', recorded_dedup)
+        watermarks = []
+        for _ in range(2):
+            processor.find_anomalies(None, 1, is_test=False)
+            assert set(processor.truncated) == {'l7'}
+            watermarks.append(last_timestamp.load('l7'))
+        assert watermarks == [datetime(2021, 1, 15, 18, 45, 9), datetime(2021, 1, 15, 18, 45, 19)]
+        assert last_timestamp.load('dns') > watermarks[-1]
+        # the second cycle starts at the first watermark, only the docs of the watermark time are scored already
+        l7_new_docs = [len(docs) for docs in new_docs if docs]
+        assert l7_new_docs[0] == 100 and 90 <= l7_new_docs[1] < 100
+        assert list(last_timestamp._read()['l7']['scored']) == [watermarks[-1].isoformat()]
+    last_timestamp.remove()
+
+
+def test_watermarks_of_self_diagnostics_and_missing_model(tmp_path, monkeypatch):
+    """
+    The self-diagnostics real-life cycle does not move the watermarks of the scheduled cycles.
+    A missing dynamic model fails its index, its watermark is not moved.
+    """
+    from datetime import datetime
+    from benchmarks import fake_es
+    from ph import last_timestamp, log_cache, model_processor
+
+    monkeypatch.setattr(log_cache, 'cache_dir', str(tmp_path / 'log_cache'))
+    store = fake_es.Store()
+    store.load('l7', 200)
+    t0 = datetime(2021, 1, 15, 18, 40)
+    last_timestamp.remove()
+    last_timestamp.save(t0)
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        processor = ModelProcessor(ElasticClient(), data_dir=str(tmp_path))
+        processor.find_anomalies(None, 0, is_test=False, moves_last_timestamp=False)
+        assert last_timestamp.load('l7') == t0 and last_timestamp.load('dns') == t0
+
+        monkeypatch.setattr(model_processor, '_load_model', lambda *args: (None, None))
+        processor.find_anomalies(None, 1, is_test=False)
+        assert last_timestamp.load('l7') == t0
+        assert last_timestamp.load('dns') > t0  # no samples, no job failed
+    last_timestamp.remove()
+
+
+def test_aggregate_byte_anomalies():
+    from ph.model_processor import aggregate_byte_anomalies
+
+    def alert(job_name, start, end, **fields):
+        record = {'start_time': start, 'end_time': end, 'source_namespace': 'ns', 'source_name_aggr': 'src',
+                  'dest_namespace': 'ns', 'dest_service_name': 'svc', 'bytes_in': 0, 'bytes_out': 0,
+                  'confidence': 0.9, **fields}
+        return {'alert': f'anomaly_detection.{job_name}', 'record': record, 'description': ''}
+
+    anomalies = [
+        alert('process_bytes', '2021-01-15 18:07:00', '2021-01-15 18:12:00', bytes_in=7000),
+        alert('process_bytes', '2021-01-15 18:02:00', '2021-01-15 18:07:00', bytes_in=2000, bytes_out=3000),
+        alert('bytes_in', '2021-01-15 18:00:00', '2021-01-15 18:05:00'),
+        alert('bytes_out', '2021-01-15 18:00:00', '2021-01-15 18:05:00'),
+        alert('bytes_in', '2021-01-15 18:20:00', '2021-01-15 18:25:00'),  # no process_bytes in the interval
+        {**alert('l7_latency', 1610733600, 1610733900), 'record': str({'start_time': 1610733600, 'x': float('nan')})},
+    ]
+    aggregated = aggregate_byte_anomalies(anomalies)
+    assert [a['alert'] for a in aggregated] == ['anomaly_detection.bytes_in', 'anomaly_detection.bytes_out',
+                                                'anomaly_detection.l7_latency']
+    assert aggregated[0]['record']['bytes_in'] == 2000 and 'input of 2,000 bytes' in aggregated[0]['description']
+    assert 'output of 3,000 bytes' in aggregated[1]['description']
+    assert aggregated[2]['record'] == {'start_time': 1610733600, 'x': None}  # the string records are parsed
@@ -0,0 +1,77 @@
+import os
+import shutil
+import time
+
+from fastapi.testclient import TestClient
+
+from ph import profiler
+from ph.api import app
+
+client = TestClient(app)
+
+
+def _busy_loop(secs):
+    end = time.time() + secs
+    while time.time() < end:
+        pass
+
+
+def test_armed_profile():
+    shutil.rmtree(profiler.profiles_dir, ignore_errors=True)
+
+    # not armed: nothing is profiled
+    with profiler.armed_profile('detect'):
+        _busy_loop(0.1)
+    assert profiler.read_profile('detect') is None
+
+    # armed: only the next cycle is profiled
+    profiler.arm('detect', seconds=10)
+    with profiler.armed_profile('detect'):
+        _busy_loop(0.3)
+    assert not os.path.exists(f'{profiler.profiles_dir}/arm_detect.json')
+    collapsed = profiler.read_profile('detect')
+    # the idle executor threads of the API are sampled as well
+    assert any(line.startswith('MainThread;') and '_busy_loop (test_profiler.py:' in line
+               for line in collapsed.splitlines())
+    for line in collapsed.splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert not stack.startswith('ph-profiler')
+        assert int(count) > 0
+    assert profiler.read_profile('train') is None
+    shutil.rmtree(profiler.profiles_dir, ignore_errors=True)
+
+
+def test_profile_endpoints():
+    shutil.rmtree(profiler.profiles_dir, ignore_errors=True)
+    rs = client.get('/ph/ops/profile', params={'target': 'api', 'seconds': 1})
+    assert rs.status_code == 200
+    assert rs.text
+
+    rs = client.get('/ph/ops/profile/train/last')
+    assert rs.status_code == 404
+
+    rs = client.get('/ph/ops/profile', params={'target': 'train', 'seconds': 5})
+    assert rs.status_code == 202
+    assert os.path.exists(f'{profiler.profiles_dir}/arm_train.json')
+    with profiler.armed_profile('train'):
+        _busy_loop(0.1)
+    rs = client.get('/ph/ops/profile/train/last')
+    assert rs.status_code == 200
+    assert '_busy_loop' in rs.text
+    shutil.rmtree(profiler.profiles_dir, ignore_errors=True)
+
+
+def test_profiles_retention(monkeypatch):
+    shutil.rmtree(profiler.profiles_dir, ignore_errors=True)
+    os.makedirs(profiler.profiles_dir)
+    monkeypatch.setattr(profiler, 'params', profiler.params._replace(PH_profiles_number=2))
+    for name in ['detect.20210101_000000.collapsed', 'detect.20210102_000000.collapsed',
+                 'train.20210101_000000.collapsed']:
+        open(f'{profiler.profiles_dir}/{name}', 'w').close()
+    profiler.arm('detect', seconds=1)
+    with profiler.armed_profile('detect'):
+        _busy_loop(0.05)
+    files = sorted(os.listdir(profiler.profiles_dir))
+    assert len(files) == 3 and files[0] == 'detect.20210102_000000.collapsed'
+    assert files[-1] == 'train.20210101_000000.collapsed'
+    shutil.rmtree(profiler.profiles_dir, ignore_errors=True)
@@ -0,0 +1,65 @@
+import shutil
+import time
+
+from fastapi.testclient import TestClient
+
+from benchmarks import corpora, fake_es
+from ph import response_cache
+from ph.log_cache import to_datetime
+from ph.api import app
+from ph.model_processor import train_job, namespace_dir
+
+client = TestClient(app)
+
+namespace = 'ut_response_cache'
+param = 'PH_L7Latency_IsolationForest_score_threshold'
+
+
+def test_detect_response_cache(monkeypatch):
+    response_cache.clear()
+    train_job('l7_latency', corpora.generate('l7', 2000, seed=1), namespace=namespace)
+    store = fake_es.Store()
+    store.load('l7', 2000)  # the @timestamps: 18:45:00 - 18:48:20
+    rq = {'job': 'l7_latency', 'data_source': 'logs', 'namespace': namespace,
+          'data': {'start': '2021-01-15T18:44:00', 'end': '2021-01-15T18:50:00'}}
+    with fake_es.serve(store) as host, fake_es.elastic_client_params(host):
+        anomalies = client.post('/ph/ops/detect', json=rq).json()
+        assert anomalies
+        requests = store.requests
+        assert client.post('/ph/ops/detect', json=rq).json() == anomalies
+        assert store.requests == requests
+
+        # a changed parameter is a different key
+        monkeypatch.setenv(param, '-0.9')
+        client.post('/ph/ops/detect', json=rq)
+        assert store.requests > requests
+        monkeypatch.delenv(param)
+        requests = store.requests
+        assert client.post('/ph/ops/detect', json=rq).json() == anomalies
+        assert store.requests == requests
+
+        # a retrained model is a different key
+        time.sleep(0.01)
+        train_job('l7_latency', corpora.generate('l7', 2000, seed=1), namespace=namespace)
+        client.post('/ph/ops/detect', json=rq)
+        assert store.requests > requests
+    response_cache.clear()
+    shutil.rmtree(namespace_dir(namespace), ignore_errors=True)
+
+
+def test_ttl_and_eviction(monkeypatch):
+    response_cache.clear()
+    now = time.time()
+    assert response_cache.ttl('2021-01-15 18:50:00', now) is None
+    assert response_cache.ttl(None, now) == response_cache.params.PH_detect_cache_ttl_seconds
+    assert response_cache.ttl(to_datetime(now - 60), now) == \
+        response_cache.params.PH_detect_cache_ttl_seconds
+
+    monkeypatch.setattr(response_cache, 'params', response_cache.params._replace(PH_detect_cache_max_entries=2,
+                                                                                 PH_detect_cache_ttl_seconds=0))
+    for key in 'abc':
+        response_cache.put(key, [{'job': key}], '2021-01-15 18:50:00')
+    assert response_cache.get('a') is None and response_cache.get('c') == [{'job': 'c'}]
+    response_cache.put('open', [], None)  # expires at once
+    assert response_cache.get('open') is None
+    response_cache.clear()
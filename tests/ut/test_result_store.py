@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+from ph import result_store
+from ph.api import app
+
+client = TestClient(app)
+
+
+@pytest.fixture(autouse=True)
+def db_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_store, 'db_file_name', str(tmp_path / 'results.sqlite'))
+    return tmp_path / 'results.sqlite'
+
+
+def _alert(start_time, service, duration):
+    record = {'start_time': start_time, 'dest_namespace': 'google-store', 'dest_service_name': service,
+              'duration_mean': duration}
+    return {'type': 'alert', 'alert': 'anomaly_detection.l7_latency', 'severity': 100, 'record': record,
+            'description': f'{service} has a suspicious latency', 'time': 1}
+
+
+def test_save_and_page():
+    now = datetime.utcnow().replace(microsecond=0)
+    anomalies = [_alert(int(now.timestamp()) - 60 * i, ['cart', 'payment'][i % 2], i) for i in range(5)]
+    cycle_id = result_store.save_cycle('production', 1, False, now, 1.5, anomalies, {'dns'}, set())
+    result_store.save_cycle('ut_namespace', 1, False, now + timedelta(seconds=1), 0.5, [])
+    result_store.save_history('self_diagnostics', 'all', {'result': 'Success'}, 'id-1')
+
+    rs = client.get('/ph/results/cycles', params={'namespace': 'production'}).json()
+    assert [(c['id'], c['anomalies'], c['failed_indices']) for c in rs['items']] == [(cycle_id, 5, ['dns'])]
+    assert [c['namespace'] for c in client.get('/ph/results/cycles').json()['items']] == ['ut_namespace',
+                                                                                         'production']
+
+    # the pages of the anomalies, the newest first
+    durations, cursor = [], None
+    while True:
+        rs = client.get('/ph/results/anomalies', params={'limit': 2, 'cycle_id': cycle_id,
+                                                          **({'cursor': cursor} if cursor else {})}).json()
+        durations += [a['record']['duration_mean'] for a in rs['items']]
+        cursor = rs['cursor']
+        if not cursor:
+            break
+    assert durations == [0, 1, 2, 3, 4]
+    rs = client.get('/ph/results/anomalies', params={'service': 'payment', 'job': 'l7_latency'}).json()
+    assert [a['record']['duration_mean'] for a in rs['items']] == [1, 3]
+    start = (now - timedelta(seconds=150)).isoformat()
+    rs = client.get('/ph/results/anomalies', params={'namespace': 'google-store', 'start': start}).json()
+    assert [a['record']['duration_mean'] for a in rs['items']] == [0, 1, 2]
+
+    rs = client.get('/ph/results/history').json()
+    assert rs['items'][0]['id'] == 'id-1' and rs['items'][0]['result'] == {'result': 'Success'}
+
+    result_store.evict(now + timedelta(days=result_store.params.PH_result_store_retention_days, seconds=1))
+    assert result_store.page('cycles')['items'][0]['namespace'] == 'ut_namespace'
+    assert not result_store.page('anomalies')['items']
+
+
+def test_record_fields_and_wrong_cursor():
+    """The namespace and service of an anomaly are from the group fields of its job."""
+    now = datetime.utcnow().replace(microsecond=0)
+    alert = _alert(int(now.timestamp()), 'cart', 0)
+    alert['record'] = {'start_time': int(now.timestamp()), 'src_namespace': 'frontend', 'src_name_aggr': 'web-*',
+                       'duration_mean': 0}
+    result_store.save_cycle('production', 1, False, now, 1.5, [alert])
+    [anomaly] = result_store.page('anomalies')['items']
+    assert (anomaly['namespace'], anomaly['service']) == ('frontend', 'web-*')
+
+    for cursor in ['no-separator', f'{now.isoformat()}|x', '|1']:
+        rs = client.get('/ph/results/anomalies', params={'cursor': cursor})
+        assert rs.status_code == 400
@@ -5,8 +5,9 @@ from shutil import copyfile
 
 from ph.globals import data_dir
 from ph.globals import job_name2job
+from ph import dataset_cache
 from ph.self_diagnostics import output_self_diagnostics_report, file_all_detected_anomalies_test, \
-    file_all_detected_anomalies
+    file_all_detected_anomalies, test_data_dir, _detected_anomalies, _report_job_statistics
 
 
 def test_output_self_diagnostics_report():
@@ -17,9 +18,10 @@ def test_output_self_diagnostics_report():
     Note: we run ut not from the test/ut dir but from app root dir.
     """
 
-    def recreate_file(source_name):
+    def recreate_file(source_name, dest_dir=data_dir):
         source_file_name = f'tests/ut/{source_name}.csv'
-        dest_file_name = f'{data_dir}/{source_name}.csv'
+        dest_file_name = f'{dest_dir}/{source_name}.csv'
+        os.makedirs(dest_dir, exist_ok=True)
         assert os.path.exists(source_file_name), f'file "{source_file_name}" should be here.'
         if not os.path.exists(dest_file_name):
             copyfile(source_file_name, dest_file_name)
@@ -29,13 +31,13 @@ def test_output_self_diagnostics_report():
             print(f'"{dest_file_name}" file exist.')
             return False
 
-    def remove_file_if_created(source_name, is_file_all_detected_anomalies_test_created):
-        dest_file_name = f'{data_dir}/{source_name}.csv'
+    def remove_file_if_created(source_name, is_file_all_detected_anomalies_test_created, dest_dir=data_dir):
+        dest_file_name = f'{dest_dir}/{source_name}.csv'
         if is_file_all_detected_anomalies_test_created:
             _remove_file(dest_file_name)
 
     # if file_all_detected_anomalies_test does not exist, create it
-    is_file_all_detected_anomalies_test_created = recreate_file(file_all_detected_anomalies_test)
+    is_file_all_detected_anomalies_test_created = recreate_file(file_all_detected_anomalies_test, test_data_dir)
 
     # if file_all_detected_anomalies does not exist, create it
     is_file_all_detected_anomalies_created = recreate_file(file_all_detected_anomalies)
@@ -53,10 +55,29 @@ def test_output_self_diagnostics_report():
         _assert_sd_report(js)
 
     # remove anomalies files if we created them in this test
-    remove_file_if_created(file_all_detected_anomalies_test, is_file_all_detected_anomalies_test_created)
+    remove_file_if_created(file_all_detected_anomalies_test, is_file_all_detected_anomalies_test_created,
+                           test_data_dir)
     remove_file_if_created(file_all_detected_anomalies, is_file_all_detected_anomalies_created)
 
 
+def test_report_job_statistics():
+    dataset = dataset_cache.load('l7_latency')
+    labeled = dataset.labeled.drop(columns='key').to_dict('records')
+    group_fields = job_name2job['l7_latency'].group_fields
+    not_labeled = list({tuple(r[f] for f in group_fields): r for r in dataset.records[:1000]
+                        if r not in labeled}.values())[:10]
+    # the detected records have the additional fields, as 'score' and 'confidence'
+    anomalies = [{'alert': 'anomaly_detection.l7_latency', 'record': {**r, 'score': -0.7, 'confidence': 0.9}}
+                 for r in labeled[:50] + not_labeled]
+    report = _report_job_statistics({'l7_latency': dataset.labeled}, _detected_anomalies(anomalies), verbose=True)
+    job = report['jobs'][0]
+    statistics = job['statistics']
+    assert (statistics['TP - Correctly detected'], statistics['FP - Falsely detected'],
+            statistics['FN - Falsely Not detected']) == (50, 10, len(labeled) - 50)
+    assert [s['duration_mean'] for s in job['FP_samples']] == [r['duration_mean'] for r in not_labeled]
+    assert len(job['TP_samples']) == 50 and len(job['FN_samples']) == len(labeled) - 50
+
+
 def _assert_sd_report(js):
     def assert_result(k, v):
         assert k == 'result'
@@ -110,3 +131,18 @@ def _remove_file(file_name):
         os.remove(file_name)
         print(f'Removed the "{file_name}" file.')
         assert not os.path.exists(file_name)
+
+
+def test_self_diagnostics_with_failed_cycles(monkeypatch):
+    """The report is produced if any of the self-diagnostics cycles fails."""
+    from ph import ph
+
+    def failed_cycle(*args):
+        raise ValueError('failed cycle')
+    reports = []
+    monkeypatch.setattr(ph, '_self_diagnostics_tests_cycle', failed_cycle)
+    monkeypatch.setattr(ph, '_self_diagnostics_real_life_cycle', failed_cycle)
+    monkeypatch.setattr(ph, 'output_self_diagnostics_report', lambda *args: reports.append(args))
+    ph.self_diagnostics(None)
+    [(exc, _, test_anomalies, anomalies)] = reports
+    assert isinstance(exc, ValueError) and test_anomalies == [] and anomalies is None
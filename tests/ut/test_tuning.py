@@ -0,0 +1,86 @@
+import os
+import time
+
+import pandas as pd
+from fastapi.testclient import TestClient
+
+from ph import dataset_cache, tuning
+from ph.api import app
+
+client = TestClient(app)
+
+n_estimators = 'PH_L7Latency_IsolationForest_n_estimators'
+threshold = 'PH_L7Latency_IsolationForest_score_threshold'
+
+
+def test_candidates():
+    space = tuning.default_space('l7_latency')
+    assert space[n_estimators] == [50, 100, 200] and -0.836 in space[threshold]
+    assert len(tuning.candidates(space)) == 9
+    trials = tuning.candidates(space, 'random', 4, seed=1)
+    assert len(trials) == 4 and trials == tuning.candidates(space, 'random', 4, seed=1)
+    assert len({tuple(t.values()) for t in trials}) == 4
+
+
+def test_shared_dataset():
+    df = pd.DataFrame({'start_time': [1, 2, 3], 'name': ['a', None, 'a'], 'value': [0.5, 1.5, 2.5]})
+    shm, spec, rows = tuning._share(df)
+    try:
+        shared = tuning._attach(shm.name, spec, rows)
+    finally:
+        shm.close()
+        shm.unlink()
+    assert shared.to_dict('records') == df.to_dict('records')
+    assert shared.dtypes.tolist() == df.dtypes.tolist()
+
+
+def test_tune(tmp_path, monkeypatch):
+    monkeypatch.setattr(tuning, 'checkpoint_dir', str(tmp_path))
+    space = {n_estimators: [10, 20], threshold: [-0.836]}
+    table = tuning.tune('l7_latency', space, workers=2)
+    assert [r['rank'] for r in table] == [1, 2] and table[0]['F1'] >= table[1]['F1']
+    assert {r['params'][n_estimators] for r in table} == {10, 20}
+    assert all(r['fit_secs'] > 0 and r['score_secs'] > 0 for r in table)
+
+    # the finished trials are not run again
+    monkeypatch.setattr(tuning, 'ProcessPoolExecutor', None)
+    assert tuning.tune('l7_latency', space) == table
+
+
+def test_run_name(monkeypatch):
+    space = {n_estimators: [10, 20]}
+    trials = tuning.candidates(space)
+    name = tuning._run_name('l7_latency', space, trials)
+    assert tuning._run_name('l7_latency', space, trials) == name
+    # the not searched param is changed
+    monkeypatch.setenv(threshold, '-0.5')
+    assert tuning._run_name('l7_latency', space, trials) != name
+    monkeypatch.delenv(threshold)
+    # the test dataset is changed
+    monkeypatch.setattr(dataset_cache, '_version', lambda job_name: (0, 0))
+    assert tuning._run_name('l7_latency', space, trials) != name
+
+
+def test_tune_job():
+    space = {n_estimators: [10, 20], threshold: [-0.836]}
+    checkpoint_file = f"{tuning.checkpoint_dir}/{tuning._run_name('l7_latency', space, tuning.candidates(space))}.jsonl"
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    rs = client.post('/ph/ops/tune', json={'job': 'l7_latency', 'space': space, 'workers': 2})
+    assert rs.status_code == 202
+    job = rs.json()
+    assert job['op'] == 'tune' and job['job'] == 'l7_latency'
+    end = time.time() + 120
+    while client.get(f'/ph/ops/jobs/{job["id"]}').json()['status'] not in ('done', 'failed') and time.time() < end:
+        time.sleep(0.2)
+    state = client.get(f'/ph/ops/jobs/{job["id"]}').json()
+    assert state['status'] == 'done', state['error']
+    assert [r['rank'] for r in state['result']] == [1, 2]
+    assert {r['params'][n_estimators] for r in state['result']} == {10, 20}
+    os.remove(checkpoint_file)
+
+
+def test_tune_endpoint_validation():
+    rs = client.post('/ph/ops/tune', json={'job': 'l7_latency', 'space': {'PH_no_such_param': [1]}})
+    assert rs.status_code == 400
+    assert client.post('/ph/ops/tune', json={'job': 'all'}).status_code == 400